@@ -0,0 +1,53 @@
+"""Add person events log and projection checkpoints
+
+Revision ID: 3f1c2a9d8e47
+Revises: 767efaa6b483
+Create Date: 2026-10-19 09:12:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "3f1c2a9d8e47"
+down_revision: Union[str, None] = "767efaa6b483"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Append-only: rows are never updated or deleted, so the table is not
+    # system-versioned
+    op.create_table(
+        "person_events",
+        sa.Column("id", sa.BigInteger(), autoincrement=True, nullable=False),
+        sa.Column("person_id", sa.String(length=36), nullable=False),
+        sa.Column("payload_type", sa.String(length=32), nullable=False),
+        sa.Column("name", sa.String(length=255), nullable=True),
+        sa.Column("event_timestamp", sa.DateTime(), nullable=True),
+        sa.Column(
+            "received_at",
+            sa.DateTime(),
+            server_default=sa.text("CURRENT_TIMESTAMP"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_table(
+        "projection_checkpoints",
+        sa.Column("name", sa.String(length=64), nullable=False),
+        sa.Column("position", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+    op.execute(
+        "INSERT INTO projection_checkpoints (name, position) VALUES ('people', 0)"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("projection_checkpoints")
+    op.drop_table("person_events")
@@ -0,0 +1,33 @@
+"""Add a version column to people for optimistic concurrency
+
+Revision ID: 9b4e7d1c6a20
+Revises: 3f1c2a9d8e47
+Create Date: 2026-10-19 10:05:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9b4e7d1c6a20"
+down_revision: Union[str, None] = "3f1c2a9d8e47"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # MariaDB refuses to alter system-versioned tables unless told to
+    op.execute("SET @@system_versioning_alter_history = 1")
+    op.add_column(
+        "people",
+        sa.Column("version", sa.Integer(), server_default="1", nullable=False),
+    )
+
+
+def downgrade() -> None:
+    op.execute("SET @@system_versioning_alter_history = 1")
+    op.drop_column("people", "version")
@@ -0,0 +1,58 @@
+"""Add incrementally maintained aggregates of people and their events
+
+Revision ID: c5a8e2f4b913
+Revises: 9b4e7d1c6a20
+Create Date: 2026-10-19 11:20:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "c5a8e2f4b913"
+down_revision: Union[str, None] = "9b4e7d1c6a20"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Created empty, and unused by NL queries until filled with
+    # `python -m app.aggregates rebuild`
+    op.create_table(
+        "people_stats",
+        sa.Column("name", sa.String(length=32), nullable=False),
+        sa.Column("slot", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("value", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("name", "slot"),
+    )
+    op.create_table(
+        "daily_event_counts",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("event_type", sa.String(length=32), nullable=False),
+        sa.Column("slot", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("count", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("day", "event_type", "slot"),
+    )
+    op.create_table(
+        "first_name_counts",
+        sa.Column("first_name", sa.String(length=255), nullable=False),
+        sa.Column("count", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("first_name"),
+    )
+    op.create_index(
+        op.f("ix_first_name_counts_count"),
+        "first_name_counts",
+        ["count"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_first_name_counts_count"), table_name="first_name_counts")
+    op.drop_table("first_name_counts")
+    op.drop_table("daily_event_counts")
+    op.drop_table("people_stats")
@@ -0,0 +1,34 @@
+"""Add hashes of people id ranges for anti-entropy reconciliation
+
+Revision ID: e7d3b1a06c52
+Revises: c5a8e2f4b913
+Create Date: 2026-10-19 13:40:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e7d3b1a06c52"
+down_revision: Union[str, None] = "c5a8e2f4b913"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Created empty: fill it with `python -m app.reconcile rebuild`
+    op.create_table(
+        "people_hash_buckets",
+        sa.Column("bucket", sa.String(length=8), nullable=False),
+        sa.Column("hash", sa.BigInteger(), nullable=False),
+        sa.Column("count", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("bucket"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("people_hash_buckets")
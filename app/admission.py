@@ -0,0 +1,243 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional, Tuple
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app import metrics
+from app.config import get_settings
+from app.responses import FastJSONResponse
+
+# Route classes, highest priority first
+WEBHOOK, LOOKUP, NL = "webhook", "lookup", "nl"
+PRIORITY = (WEBHOOK, LOOKUP, NL)
+
+ROUTE_CLASSES = {
+    "/accept_webhook": WEBHOOK,
+    "/get_name": LOOKUP,
+    "/execute_custom_nl_query": NL,
+}
+
+# Over its queue, a class is answered with this status
+_REJECT_STATUS = {WEBHOOK: 503, LOOKUP: 503, NL: 429}
+
+# Clients whose token buckets are kept, least recently seen evicted first
+_MAX_CLIENTS = 10_000
+
+metrics.describe(
+    "admission_rejected_total",
+    "Requests turned away by admission control, by route class and reason.",
+)
+metrics.describe(
+    "admission_queued_total", "Requests that waited for a slot, by route class."
+)
+
+
+class Rejected(Exception):
+    """Raised when a request cannot be admitted."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class PriorityLimiter:
+    """
+    Concurrency slots shared by the route classes, handed out by priority.
+
+    At most `capacity` requests run at once, and at most `limits[cls]` of a
+    given class, so that the lower classes can never take every slot. A
+    request that cannot run waits in its class's bounded queue; whenever a
+    slot frees up it goes to the oldest waiter of the highest-priority class
+    able to run.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        limits: Dict[str, int],
+        queue_sizes: Dict[str, int],
+        queue_timeouts: Dict[str, float],
+    ):
+        self.capacity = capacity
+        self.limits = limits
+        self.queue_sizes = queue_sizes
+        self.queue_timeouts = queue_timeouts
+        self.active = 0
+        self.active_by_class: Dict[str, int] = {cls: 0 for cls in PRIORITY}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {
+            cls: deque() for cls in PRIORITY
+        }
+
+    def _can_run(self, cls: str) -> bool:
+        limit = self.limits.get(cls, self.capacity)
+        return self.active < self.capacity and self.active_by_class[cls] < limit
+
+    def _grant(self, cls: str):
+        self.active += 1
+        self.active_by_class[cls] += 1
+
+    def _dispatch(self):
+        for cls in PRIORITY:
+            waiters = self._waiters[cls]
+            while waiters and self._can_run(cls):
+                self._grant(cls)
+                waiters.popleft().set_result(None)
+
+    async def acquire(self, cls: str):
+        """
+        Wait for a slot for a request of the given class.
+
+        Args:
+            cls (str): The route class.
+
+        Raises:
+            Rejected: If the class's queue is full, or the wait timed out.
+        """
+        waiters = self._waiters[cls]
+        # Freed slots are handed to waiters on release, so a class with
+        # nobody waiting can take a free slot without overtaking anyone
+        if not waiters and self._can_run(cls):
+            self._grant(cls)
+            return
+
+        if len(waiters) >= self.queue_sizes.get(cls, 0):
+            raise Rejected("queue_full", 1)
+        metrics.inc("admission_queued_total", route_class=cls)
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        timeout = self.queue_timeouts.get(cls)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Granted just as the wait timed out: give the slot back
+                self.release(cls)
+            else:
+                waiter.cancel()
+                waiters.remove(waiter)
+            raise Rejected("queue_timeout", max(1, math.ceil(timeout or 1)))
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(cls)
+            else:
+                waiter.cancel()
+                waiters.remove(waiter)
+            raise
+
+    def release(self, cls: str):
+        """
+        Free a slot taken by a request of the given class.
+
+        Args:
+            cls (str): The route class.
+        """
+        self.active -= 1
+        self.active_by_class[cls] -= 1
+        self._dispatch()
+
+
+class TokenBuckets:
+    """
+    Per-client token buckets, refilled at `rate` tokens a second up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def take(self, client: str) -> Optional[int]:
+        """
+        Take a token from a client's bucket.
+
+        Args:
+            client (str): The client key.
+
+        Returns:
+            Optional[int]: None if a token was taken, otherwise the number of
+                seconds until one is available.
+        """
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = None
+        else:
+            wait = max(1, math.ceil((1 - tokens) / self.rate))
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > _MAX_CLIENTS:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class AdmissionMiddleware:
+    """
+    Admission control in front of the API routes.
+
+    Webhooks outrank name lookups, which outrank NL queries, for the
+    concurrency slots of the worker (see PriorityLimiter), and NL queries are
+    also rate limited per client. Requests that cannot be admitted are turned
+    away at once with a Retry-After header, rather than piling up behind
+    the slow ones.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        settings = get_settings()
+        self.enabled = settings.admission_max_concurrency > 0
+        self.limiter = PriorityLimiter(
+            settings.admission_max_concurrency,
+            settings.admission_concurrency,
+            settings.admission_queue_size,
+            settings.admission_queue_timeout,
+        )
+        self.client_header = settings.admission_client_header
+        self.nl_rate_limit = (
+            TokenBuckets(
+                settings.nl_rate_limit_per_second, settings.nl_rate_limit_burst
+            )
+            if settings.nl_rate_limit_per_second > 0
+            else None
+        )
+
+    def _client(self, scope: Scope) -> str:
+        if self.client_header:
+            name = self.client_header.lower().encode()
+            for key, value in scope["headers"]:
+                if key == name:
+                    return value.decode("latin-1")
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        cls = ROUTE_CLASSES.get(scope["path"]) if scope["type"] == "http" else None
+        if not self.enabled or cls is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            if cls == NL and self.nl_rate_limit is not None:
+                wait = self.nl_rate_limit.take(self._client(scope))
+                if wait is not None:
+                    raise Rejected("rate_limited", wait)
+            await self.limiter.acquire(cls)
+        except Rejected as e:
+            metrics.inc("admission_rejected_total", route_class=cls, reason=e.reason)
+            status = 429 if e.reason == "rate_limited" else _REJECT_STATUS[cls]
+            response = FastJSONResponse(
+                {"detail": "Too many requests, retry later"},
+                status_code=status,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release(cls)
@@ -0,0 +1,398 @@
+import argparse
+import logging
+import operator
+import random
+import re
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+
+from app import metrics
+from app.config import get_settings
+from app.db import merge_rows
+from app.models import DailyEventCount, FirstNameCount, PeopleStat, Person, PersonEvent
+
+logger = logging.getLogger(__name__)
+
+PEOPLE = "people"
+# People stat set when the aggregates were last rebuilt, in epoch seconds
+REBUILT = "rebuilt"
+ADDED, RENAMED, REMOVED = "PersonAdded", "PersonRenamed", "PersonRemoved"
+
+# Most first names returned by a "top N" question
+_MAX_TOP_NAMES = 100
+# First names written per statement by a rebuild
+_REBUILD_CHUNK = 1000
+
+# Whether the aggregates are known to have been rebuilt at least once
+_rebuilt = False
+
+metrics.describe(
+    "nl_aggregate_answers_total",
+    "NL queries answered from the aggregates instead of the LLM, by question.",
+)
+
+# Every version of every person; current rows end in the future, so their
+# end is reported as NULL
+_HISTORY_QUERY = text(
+    """
+    SELECT id, ROW_START AS row_start,
+        CASE WHEN ROW_END <= NOW(6) THEN ROW_END END AS row_end
+    FROM people FOR SYSTEM_TIME ALL
+    """
+)
+
+# Questions answered from the aggregates, matched against the whole question
+# once lowercased, with its whitespace collapsed and its final "?" dropped
+_PREFIX = (
+    r"(?:(?:what(?:'s| is| are)|which are|show(?: me)?|list|give me|tell me) )?"
+    r"(?:the )?"
+)
+_PEOPLE_COUNT = re.compile(
+    _PREFIX + r"(?:how many (?:people|persons) (?:are there|do we have|exist"
+    r"|are stored|are in the database)|(?:total )?(?:number|count) of people"
+    r"|count (?:of )?(?:all )?(?:the )?people)"
+)
+_EVENT_COUNT = re.compile(
+    r"how many (?:(?P<noun>renames|name changes|additions|removals|deletions)"
+    r"|(?:people|persons) (?:were|have been) (?P<verb>renamed|added|removed))"
+    r"(?: (?:happened|occurred|were there|were made|have there been))?"
+    r" (?P<period>today|this week|this month|in the (?:last|past) (?P<days>\d+) days)"
+)
+_TOP_FIRST_NAMES = re.compile(
+    _PREFIX + r"(?:top (?P<top>\d+)(?: most (?:common|popular|frequent))?"
+    r"|(?:(?P<count>\d+) )?most (?:common|popular|frequent)) first names?"
+)
+_EVENT_TYPES = {
+    "renames": RENAMED,
+    "name changes": RENAMED,
+    "renamed": RENAMED,
+    "additions": ADDED,
+    "added": ADDED,
+    "removals": REMOVED,
+    "deletions": REMOVED,
+    "removed": REMOVED,
+}
+
+
+def first_name(name: Optional[str]) -> Optional[str]:
+    """
+    Take the first name out of a full name.
+
+    Args:
+        name (Optional[str]): The full name.
+
+    Returns:
+        Optional[str]: Its first word, or None for a missing or blank name.
+    """
+    words = name.split() if name else None
+    return words[0] if words else None
+
+
+def record_changes(
+    db: Session,
+    events: Dict[str, int],
+    changes: List[Tuple[str, Optional[str], Optional[str]]],
+):
+    """
+    Update the aggregates with changes made to people, in their transaction.
+
+    Called by the write paths of app.services before they commit, so that the
+    aggregates always agree with the people table. Nothing is committed.
+
+    Args:
+        db (Session): The database session.
+        events (Dict[str, int]): How many additions, renames and removals
+            made the changes, by payload type.
+        changes (List[Tuple[str, Optional[str], Optional[str]]]): (person id,
+            name before, name after) of each changed person, None standing
+            for a missing person.
+    """
+    settings = get_settings()
+    if not settings.aggregates_enabled:
+        return
+    slot = random.randrange(max(1, settings.aggregate_counter_slots))
+    people_delta = sum(
+        (after is not None) - (before is not None) for _, before, after in changes
+    )
+
+    if people_delta:
+        merge_rows(
+            db,
+            PeopleStat,
+            [{"name": PEOPLE, "slot": slot, "value": people_delta}],
+            {"value": operator.add},
+        )
+
+    today = datetime.now(timezone.utc).date()
+    merge_rows(
+        db,
+        DailyEventCount,
+        [
+            {"day": today, "event_type": event_type, "slot": slot, "count": count}
+            for event_type, count in events.items()
+            if count
+        ],
+        {"count": operator.add},
+    )
+
+    first_names: Counter = Counter()
+    for _, before, after in changes:
+        first_names[first_name(before)] -= 1
+        first_names[first_name(after)] += 1
+    merge_rows(
+        db,
+        FirstNameCount,
+        [
+            {"first_name": name, "count": delta}
+            for name, delta in first_names.items()
+            if name is not None and delta
+        ],
+        {"count": operator.add},
+    )
+
+
+def count_people(db: Session) -> int:
+    """
+    Read the number of people from the aggregates.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        int: The number of people.
+    """
+    total = (
+        db.query(func.sum(PeopleStat.value)).filter(PeopleStat.name == PEOPLE).scalar()
+    )
+    return int(total or 0)
+
+
+def count_events(db: Session, event_type: str, since: date) -> int:
+    """
+    Read the number of events of a type applied since a day from the aggregates.
+
+    Args:
+        db (Session): The database session.
+        event_type (str): The payload type.
+        since (date): The first day counted (UTC).
+
+    Returns:
+        int: The number of events.
+    """
+    total = (
+        db.query(func.sum(DailyEventCount.count))
+        .filter(DailyEventCount.event_type == event_type, DailyEventCount.day >= since)
+        .scalar()
+    )
+    return int(total or 0)
+
+
+def top_first_names(db: Session, limit: int) -> List[Tuple[str, int]]:
+    """
+    Read the most common first names from the aggregates.
+
+    Args:
+        db (Session): The database session.
+        limit (int): How many first names to return.
+
+    Returns:
+        List[Tuple[str, int]]: (first name, number of people), most common
+            first, ties broken alphabetically.
+    """
+    rows = (
+        db.query(FirstNameCount.first_name, FirstNameCount.count)
+        .filter(FirstNameCount.count > 0)
+        .order_by(FirstNameCount.count.desc(), FirstNameCount.first_name)
+        .limit(limit)
+    )
+    return [(name, int(count)) for name, count in rows]
+
+
+def aggregates_rebuilt(db: Session) -> bool:
+    """
+    Check whether the aggregates were rebuilt since their tables were created.
+
+    The tables are created empty by their migration, and only hold the
+    changes made since until `python -m app.aggregates rebuild` runs. Once
+    seen, the rebuild is remembered for the lifetime of the process.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        bool: True if the aggregates can be used to answer questions.
+    """
+    global _rebuilt
+    if not _rebuilt:
+        _rebuilt = (
+            db.query(PeopleStat.value).filter(PeopleStat.name == REBUILT).first()
+            is not None
+        )
+    return _rebuilt
+
+
+def _period_start(period: str, days: Optional[str], today: date) -> date:
+    if period == "today":
+        return today
+    if period == "this week":
+        return today - timedelta(days=today.weekday())
+    if period == "this month":
+        return today.replace(day=1)
+    return today - timedelta(days=max(1, int(days)) - 1)
+
+
+def answer_from_aggregates(
+    db: Session, question: str
+) -> Optional[Tuple[List[str], List[Sequence]]]:
+    """
+    Answer a natural language question from the aggregates, if it is one of
+    the common questions they cover.
+
+    Covers the number of people, the number of additions, renames or removals
+    today, this week, this month or in the last N days (UTC), and the most
+    common first names. Anything else returns None, to go through the LLM, as
+    does every question until the aggregates were first rebuilt.
+
+    Args:
+        db (Session): The database session.
+        question (str): The natural language question.
+
+    Returns:
+        Optional[Tuple[List[str], List[Sequence]]]: The column names and the
+            result rows, as execute_sql returns them, or None.
+    """
+    if not get_settings().aggregates_enabled:
+        return None
+    normalized = " ".join(question.lower().split()).rstrip("?.! ")
+    people_count, event_count, top_names = (
+        pattern.fullmatch(normalized)
+        for pattern in (_PEOPLE_COUNT, _EVENT_COUNT, _TOP_FIRST_NAMES)
+    )
+    if not (people_count or event_count or top_names) or not aggregates_rebuilt(db):
+        return None
+
+    if people_count:
+        metrics.inc("nl_aggregate_answers_total", question="people_count")
+        return ["count"], [(count_people(db),)]
+
+    if event_count:
+        event_type = _EVENT_TYPES[event_count["noun"] or event_count["verb"]]
+        today = datetime.now(timezone.utc).date()
+        since = _period_start(event_count["period"], event_count["days"], today)
+        metrics.inc("nl_aggregate_answers_total", question="event_count")
+        return ["count"], [(count_events(db, event_type, since),)]
+
+    limit = int(top_names["top"] or top_names["count"] or 10)
+    metrics.inc("nl_aggregate_answers_total", question="top_first_names")
+    return ["first_name", "count"], top_first_names(db, min(limit, _MAX_TOP_NAMES))
+
+
+def history_event_counts(rows: Iterable) -> Counter:
+    """
+    Count the additions, renames and removals recorded in people row versions.
+
+    A version starting as another version of the same person ends is a
+    rename, any other version an addition; a version ending without a
+    successor is a removal.
+
+    Args:
+        rows (Iterable): (id, row_start, row_end) row versions, as selected by
+            _HISTORY_QUERY, row_end being None for current rows.
+
+    Returns:
+        Counter: The number of events by (day, payload type).
+    """
+    rows = list(rows)
+    starts = {(person_id, row_start) for person_id, row_start, _ in rows}
+    ends = {(person_id, row_end) for person_id, _, row_end in rows if row_end}
+    counts: Counter = Counter()
+    for person_id, row_start, row_end in rows:
+        kind = RENAMED if (person_id, row_start) in ends else ADDED
+        counts[(row_start.date(), kind)] += 1
+        if row_end is not None and (person_id, row_end) not in starts:
+            counts[(row_end.date(), REMOVED)] += 1
+    return counts
+
+
+def _event_counts(db: Session) -> Counter:
+    """
+    Count the events applied to people by day and type, from their source.
+
+    The event log in the "event_store" storage mode, otherwise the history of
+    the people table on MariaDB. SQLite keeps neither, so no events.
+    """
+    if get_settings().storage_mode == "event_store":
+        rows = db.query(
+            func.date(PersonEvent.received_at), PersonEvent.payload_type, func.count()
+        ).group_by(func.date(PersonEvent.received_at), PersonEvent.payload_type)
+        return Counter(
+            {(date.fromisoformat(str(day)), kind): count for day, kind, count in rows}
+        )
+    if db.get_bind(mapper=Person.__mapper__).dialect.name in ("mysql", "mariadb"):
+        return history_event_counts(db.execute(_HISTORY_QUERY))
+    logger.warning("No event history to rebuild the daily event counts from")
+    return Counter()
+
+
+def rebuild_aggregates(db: Session):
+    """
+    Recompute the aggregates from scratch. Nothing is committed.
+
+    The people count and first names come from the people table, the daily
+    event counts from the event log or history (see _event_counts); in the
+    "event_store" storage mode, events the projection skipped are counted too.
+
+    Args:
+        db (Session): The database session.
+    """
+    for model in (PeopleStat, DailyEventCount, FirstNameCount):
+        db.query(model).delete(synchronize_session=False)
+
+    # With sharding, each shard returns its own groups: add them up
+    people = 0
+    first_names: Counter = Counter()
+    for name, count in db.query(Person.name, func.count()).group_by(Person.name):
+        people += count
+        first_names[first_name(name)] += count
+    first_names.pop(None, None)
+
+    db.add(PeopleStat(name=PEOPLE, slot=0, value=people))
+    db.add(PeopleStat(name=REBUILT, slot=0, value=int(time.time())))
+    db.add_all(
+        DailyEventCount(day=day, event_type=kind, slot=0, count=count)
+        for (day, kind), count in _event_counts(db).items()
+    )
+    db.flush()
+    # Merged rather than added: first names differing only in case or accents
+    # share a row under the database's collation, as in record_changes
+    rows = [{"first_name": name, "count": count} for name, count in first_names.items()]
+    for start in range(0, len(rows), _REBUILD_CHUNK):
+        merge_rows(
+            db,
+            FirstNameCount,
+            rows[start : start + _REBUILD_CHUNK],
+            {"count": operator.add},
+        )
+    logger.info(
+        "Rebuilt aggregates",
+        extra={"people": people, "first_names": len(first_names)},
+    )
+
+
+if __name__ == "__main__":
+    from app.db import session_scope
+
+    parser = argparse.ArgumentParser(
+        description="Maintain the aggregates answering common NL questions."
+    )
+    parser.add_argument("command", choices=["rebuild"])
+    parser.parse_args()
+
+    with session_scope() as db:
+        rebuild_aggregates(db)
+        db.commit()
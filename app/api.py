@@ -1,34 +1,74 @@
-from fastapi import APIRouter, Body, Depends, HTTPException
-from pydantic import UUID4, ValidationError
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import UUID4
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from app.db import get_db
+from app.aggregates import answer_from_aggregates
+from app.changefeed import (
+    ResumeUnavailable,
+    fetch_history_changes,
+    get_change_feed,
+    stream_changes,
+)
+from app.config import get_settings
+from app.db import conflict_kind, get_db, session_scope
 from app.docs import (
-    accept_webhook_examples,
+    accept_webhook_request_body,
     accept_webhook_responses,
+    changes_responses,
     execute_custom_nl_query_examples,
     execute_custom_nl_query_responses,
     get_name_responses,
+    range_hashes_responses,
+)
+from app.merkle import (
+    BUCKET_DIGITS,
+    HEX_DIGITS,
+    range_hash,
+    read_leaves,
+    subrange_hashes,
 )
 from app.models import (
     GetNameResponse,
-    PersonAdded,
-    PersonRemoved,
-    PersonRenamed,
     QueryRequest,
     QueryResponse,
     WebhookPayload,
+    webhook_payload_adapter,
+)
+from app.recorder import NLTrace
+from app.replica import get_name_replica
+from app.responses import (
+    ARROW_STREAM,
+    COLUMNAR_JSON,
+    RESULT_MEDIA_TYPES,
+    FastJSONResponse,
+    arrow_response,
+    columnar_response,
+    entity_tag,
+    etag_matches,
+    negotiate_media_type,
 )
 from app.services import (
     add_person,
+    append_events,
+    execute_sql,
     format_and_execute_sql,
-    get_person,
+    get_person_name,
     parse_openai_response,
     remove_person,
     rename_person,
     translate_nl_to_sql,
 )
+from app.spool import get_webhook_spool
+from app.webhooks import webhook_payload
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
@@ -37,17 +77,27 @@ router = APIRouter()
     "/accept_webhook",
     responses=accept_webhook_responses,
     summary="Process Webhook Payload",
-    description="Processes incoming webhook payloads and performs specific actions based on the payload type.",
+    description="Processes incoming webhook payloads and performs specific actions based on the payload type. Accepts JSON or MessagePack bodies, optionally gzip-compressed.",
+    openapi_extra=accept_webhook_request_body,
 )
 def accept_webhook(
-    payload: WebhookPayload = Body(..., examples=accept_webhook_examples),
+    response: Response,
+    payload: WebhookPayload = Depends(webhook_payload),
     db: Session = Depends(get_db),
 ):
     """
     Process incoming webhook payloads and perform actions based on the payload type.
 
+    When the webhook spool is enabled, the payload is only appended to it and
+    acknowledged with a 202; it is applied to the database in the background.
+    In the "event_store" storage mode, the payload is appended to the event
+    log and acknowledged with a 202; it is projected into the people table in
+    the background.
+
     Args:
-        payload (WebhookPayload): The payload sent by the webhook.
+        response (Response): The response, to set a 202 status on.
+        payload (WebhookPayload): The payload sent by the webhook, already
+            validated against the model matching its payload type.
         db (Session): The database session.
 
     Returns:
@@ -56,25 +106,45 @@ def accept_webhook(
     Raises:
         HTTPException: When an error occurs (specified by status code and detail).
     """
+    spool = get_webhook_spool()
+    if spool is not None:
+        try:
+            spool.append(webhook_payload_adapter.dump_json(payload))
+        except OSError as e:
+            logger.exception("Failed to spool webhook")
+            raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
+        response.status_code = 202
+        return {"detail": "Webhook accepted for processing"}
+
+    if get_settings().storage_mode == "event_store":
+        try:
+            append_events(db, [payload])
+        except SQLAlchemyError as e:
+            logger.exception("Failed to append webhook to the event log")
+            raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
+        response.status_code = 202
+        return {"detail": "Webhook accepted for processing"}
+
     try:
         if payload.payload_type == "PersonAdded":
-            person_data = PersonAdded(**payload.payload_content)
-            add_person(db, person_data)
+            add_person(db, payload.payload_content)
         elif payload.payload_type == "PersonRenamed":
-            person_data = PersonRenamed(**payload.payload_content)
-            if not rename_person(db, person_data):
+            if not rename_person(db, payload.payload_content):
                 raise HTTPException(status_code=404, detail="Person not found")
         elif payload.payload_type == "PersonRemoved":
-            person_data = PersonRemoved(**payload.payload_content)
-            if not remove_person(db, person_data):
+            if not remove_person(db, payload.payload_content):
                 raise HTTPException(status_code=404, detail="Person not found")
-        else:
-            raise HTTPException(status_code=400, detail="Invalid input")
-    except ValidationError:
-        raise HTTPException(status_code=400, detail="Invalid input")
     except HTTPException:
         raise
     except Exception as e:
+        if conflict_kind(e) is not None:
+            logger.warning("Webhook kept conflicting with concurrent writers: %s", e)
+            raise HTTPException(
+                status_code=503,
+                detail="Conflicting concurrent update, retry later",
+                headers={"Retry-After": "1"},
+            )
+        logger.exception("Failed to process webhook")
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
     return {"detail": "Webhook processed successfully"}
@@ -87,30 +157,54 @@ def accept_webhook(
     summary="Fetch Person Name",
     description="Fetches the name of a person by their UUID.",
 )
-async def get_name(person_id: UUID4, db: Session = Depends(get_db)):
+def get_name(
+    person_id: UUID4,
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
     """
     Fetch the name of a person by their UUID.
 
+    A plain function, run in the threadpool, as a replica miss queries the
+    database. The response carries an ETag derived from the name, so that
+    clients can revalidate their copy with If-None-Match and get an empty 304
+    if it is still current.
+
     Args:
         person_id (UUID4): The UUID of the person.
+        if_none_match (Optional[str]): The If-None-Match header.
         db (Session): The database session.
 
     Returns:
-        GetNameResponse: The name of the person if found.
+        GetNameResponse: The name of the person if found, or a 304.
 
     Raises:
         HTTPException: When an error occurs (specified by status code and detail).
     """
     try:
-        person = get_person(db, person_id)
-        if not person:
+        # Serve from the shared-memory replica when enabled, misses fall back
+        # to the database
+        found = False
+        replica = get_name_replica()
+        if replica is not None:
+            found, name = replica.lookup(person_id)
+        if not found:
+            found, name = get_person_name(db, person_id)
+        if not found:
             raise HTTPException(status_code=404, detail="Person not found")
-        return {"name": person.name}
     except HTTPException:
         raise
     except Exception:
+        logger.exception("Failed to fetch person name")
         raise HTTPException(status_code=500, detail="Server error")
 
+    content = {"name": name}
+    # Cached copies must be revalidated, as names change at any time
+    headers = {"ETag": entity_tag(content), "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, [headers["ETag"]]):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(content, headers=headers)
+
 
 @router.post(
     "/execute_custom_nl_query",
@@ -119,15 +213,28 @@ async def get_name(person_id: UUID4, db: Session = Depends(get_db)):
     summary="Execute Custom Natural Language Query",
     description="Executes a custom natural language query and returns the result.",
 )
-async def execute_custom_nl_query(
+def execute_custom_nl_query(
     query_request: QueryRequest = Body(..., examples=execute_custom_nl_query_examples),
+    accept: Optional[str] = Header(None),
     db: Session = Depends(get_db),
 ):
     """
     Execute a custom natural language query.
 
+    Common questions (number of people, of additions, renames or removals
+    over a period, most common first names) are answered from the
+    aggregates, without the LLM or a scan; others are translated to SQL.
+
+    The result is returned as a list of rows by default. Clients can instead
+    ask for a columnar JSON layout or an Arrow IPC stream through the Accept
+    header. When enabled, the query and its stage timings are recorded for
+    offline replay (see app.recorder). A plain function, run in the
+    threadpool, so that the blocking LLM call and query never hold up the
+    event loop, and with it the admission of webhooks.
+
     Args:
         query_request (QueryRequest): The natural language query.
+        accept (Optional[str]): The Accept header, used to pick the output format.
         db (Session): The database session.
 
     Returns:
@@ -136,19 +243,183 @@ async def execute_custom_nl_query(
     Raises:
         HTTPException: When an error occurs (specified by status code and detail).
     """
+    media_type = negotiate_media_type(accept, RESULT_MEDIA_TYPES)
+
+    trace = NLTrace(query_request.natural_language_query)
     try:
-        # Convert natural language to SQL
-        sql_info_raw = translate_nl_to_sql(query_request.natural_language_query)
+        # Answer common questions from the aggregates
+        with trace.stage("aggregates"):
+            answer = answer_from_aggregates(db, query_request.natural_language_query)
 
-        # Parse OpenAI response
-        sql_info = parse_openai_response(sql_info_raw)
+        if answer is None:
+            # Convert natural language to SQL
+            with trace.stage("translate"):
+                sql_info_raw = translate_nl_to_sql(query_request.natural_language_query)
+            trace.record["raw_response"] = sql_info_raw
 
-        # Format and Execute the SQL query
-        result = format_and_execute_sql(db, sql_info)
-        return {"result": result}
+            # Parse OpenAI response
+            with trace.stage("parse"):
+                sql_info = parse_openai_response(sql_info_raw)
+            trace.record.update(sql_info)
+
+            # Execute the SQL query
+            with trace.stage("execute"):
+                if media_type in (COLUMNAR_JSON, ARROW_STREAM):
+                    answer = execute_sql(db, sql_info)
+                else:
+                    result = format_and_execute_sql(db, sql_info)
+            if answer is None:
+                trace.record["rows"] = len(result) if isinstance(result, list) else 0
+                # Rows come straight from the database: skip per-row model validation
+                return FastJSONResponse({"result": result})
+        else:
+            trace.record["source"] = "aggregates"
+
+        # Render the result in the negotiated format
+        columns, rows = answer
+        trace.record["rows"] = len(rows)
+        if media_type == COLUMNAR_JSON:
+            return columnar_response(columns, rows)
+        if media_type == ARROW_STREAM:
+            return arrow_response(columns, rows)
+        return FastJSONResponse({"result": [dict(zip(columns, row)) for row in rows]})
+    except HTTPException:
+        raise
     except ValueError as e:
+        logger.warning("Invalid NL query translation: %s", e)
         raise HTTPException(status_code=400, detail=f"Invalid input: {str(e)}")
     except SQLAlchemyError as e:
+        logger.warning("NL query execution failed: %s", e)
         raise HTTPException(status_code=400, detail=f"SQL execution error: {str(e)}")
     except Exception as e:
+        logger.exception("Failed to execute NL query")
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
+    finally:
+        trace.save()
+
+
+@router.get(
+    "/range_hashes",
+    responses=range_hashes_responses,
+    summary="Fetch People Range Hashes",
+    description="Fetches the hash of a range of person ids and of its subranges, for peers to find where their copy of people differs.",
+)
+def get_range_hashes(prefix: str = "", db: Session = Depends(get_db)):
+    """
+    Fetch the hash of a range of person ids and of its 16 subranges.
+
+    Ranges are the ids starting with given hex digits, and form a tree down
+    to ranges of ``depth`` digits. A range hash is the XOR of the hashes of
+    its rows (see app.merkle.row_hash), so a peer computing the same tree
+    over its copy of people can descend into the subranges whose hash
+    differs, from the root (the empty prefix) down, and only exchange the
+    rows of the leaves that differ.
+
+    Args:
+        prefix (str): The range, in lowercase hex, shorter than ``depth``.
+        db (Session): The database session.
+
+    Returns:
+        dict: The range's prefix, hash, row count and the tree depth, and
+            the same for each subrange.
+
+    Raises:
+        HTTPException: If the prefix is invalid or range hashes are disabled.
+    """
+    if not get_settings().range_hashes_enabled:
+        raise HTTPException(status_code=503, detail="Range hashes unavailable")
+    if len(prefix) >= BUCKET_DIGITS or any(c not in HEX_DIGITS for c in prefix):
+        raise HTTPException(status_code=400, detail="Invalid prefix")
+
+    leaves = read_leaves(db)
+    digest, count = range_hash(leaves, prefix)
+    return FastJSONResponse(
+        {
+            "prefix": prefix,
+            "hash": f"{digest:016x}",
+            "count": count,
+            "depth": BUCKET_DIGITS,
+            "ranges": subrange_hashes(leaves, prefix),
+        }
+    )
+
+
+def _backfill(since: datetime):
+    with session_scope() as db:
+        return fetch_history_changes(db, since)
+
+
+@router.get(
+    "/changes",
+    response_class=StreamingResponse,
+    responses=changes_responses,
+    summary="Stream Name Changes",
+    description="Streams every add, rename and removal of a person as server-sent events, optionally resuming from an earlier event or point in time.",
+)
+async def stream_name_changes(
+    after: Optional[str] = None,
+    since: Optional[datetime] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Stream the changes to people as server-sent events.
+
+    Each event carries the change (``upsert`` with the new name, or
+    ``delete``) and, as its id, a cursor to resume from. Clients resume with
+    ``after`` (or the Last-Event-ID header sent by EventSource) from the
+    buffer of recent changes of the worker that produced the cursor; on any
+    other worker, or once the changes left the buffer, they resume with
+    ``since``, backfilled from the history of the people table. Changes may
+    be delivered more than once around a resume point. Clients too slow to
+    keep up receive an ``overflow`` event and are disconnected.
+
+    Args:
+        after (Optional[str]): The cursor of the last change received.
+        since (Optional[datetime]): Send the changes made after this time.
+        last_event_id (Optional[str]): The Last-Event-ID header, used when
+            `after` is not set.
+
+    Returns:
+        StreamingResponse: The event stream.
+
+    Raises:
+        HTTPException: If the feed is not running, or the changes since the
+            resume point are no longer available.
+    """
+    feed = get_change_feed()
+    if feed is None:
+        raise HTTPException(status_code=503, detail="Change feed unavailable")
+
+    cursor = after or last_event_id
+    after_seq = feed.parse_cursor(cursor) if cursor else None
+    subscriber = None
+    backlog = []
+    try:
+        if after_seq is not None:
+            try:
+                subscriber, backlog = feed.subscribe(after_seq)
+            except ResumeUnavailable:
+                if since is None:
+                    raise
+        if subscriber is None:
+            if cursor and since is None:
+                raise ResumeUnavailable("Cursor from another feed")
+            # Subscribe before backfilling, so that nothing falls in between
+            subscriber, _ = feed.subscribe()
+            if since is not None:
+                if since.tzinfo is not None:
+                    since = since.astimezone(timezone.utc).replace(tzinfo=None)
+                backlog = await run_in_threadpool(_backfill, since)
+    except ResumeUnavailable:
+        if subscriber is not None:
+            feed.unsubscribe(subscriber)
+        raise HTTPException(
+            status_code=410,
+            detail="Cannot resume from this point, resynchronize and subscribe again",
+        )
+
+    return StreamingResponse(
+        stream_changes(feed, subscriber, backlog, get_settings().change_feed_keepalive),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,399 @@
+import asyncio
+import itertools
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Deque, Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app import metrics
+from app.config import get_settings
+from app.db import get_engines, session_scope
+from app.services import add_change_listener, remove_change_listener
+
+logger = logging.getLogger(__name__)
+
+UPSERT, DELETE = "upsert", "delete"
+
+_feed: Optional["ChangeFeed"] = None
+
+metrics.describe(
+    "change_feed_disconnects_total",
+    "Change feed subscribers disconnected for falling behind.",
+)
+
+# Versions of people that started or ended after a point in time; current
+# rows end in the future, so their end is reported as NULL
+_HISTORY_QUERY = text(
+    """
+    SELECT id, name, ROW_START AS row_start,
+        CASE WHEN ROW_END <= NOW(6) THEN ROW_END END AS row_end
+    FROM people FOR SYSTEM_TIME ALL
+    WHERE ROW_START > :since OR (ROW_END > :since AND ROW_END <= NOW(6))
+    """
+)
+
+
+def _utc_isoformat(timestamp: datetime) -> str:
+    # Naive times are the database's, which runs in UTC (see stream_name_changes)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc).isoformat()
+
+
+class ResumeUnavailable(Exception):
+    """Raised when the changes since a resume point are no longer available."""
+
+
+def history_changes(rows: Iterable, since: datetime) -> List[Dict]:
+    """
+    Turn people row versions into the changes made after a point in time.
+
+    A version starting after `since` is an upsert; a version ending after it
+    is a delete, unless another version of the same person starts at that
+    instant (a rename).
+
+    Args:
+        rows (Iterable): (id, name, row_start, row_end) row versions, as
+            selected by _HISTORY_QUERY, row_end being None for current rows.
+        since (datetime): The point in time.
+
+    Returns:
+        List[Dict]: The changes, oldest first, without sequence numbers,
+            timestamped in UTC like the changes published live.
+    """
+    rows = list(rows)
+    starts = {(row[0], row[2]) for row in rows}
+    changes = []
+    for person_id, name, row_start, row_end in rows:
+        if row_start > since:
+            changes.append((row_start, 0, UPSERT, person_id, name))
+        if (
+            row_end is not None
+            and row_end > since
+            and (person_id, row_end) not in starts
+        ):
+            changes.append((row_end, 1, DELETE, person_id, None))
+    changes.sort(key=lambda change: change[:2])
+    return [
+        {
+            "op": op,
+            "person_id": person_id,
+            "name": name,
+            "timestamp": _utc_isoformat(timestamp),
+        }
+        for timestamp, _, op, person_id, name in changes
+    ]
+
+
+def fetch_history_changes(db: Session, since: datetime) -> List[Dict]:
+    """
+    Read the changes made to people after a point in time from their history.
+
+    Only available on MariaDB, whose system-versioned people table keeps
+    every past version of each row.
+
+    Args:
+        db (Session): The database session.
+        since (datetime): The point in time, in the database's time zone.
+
+    Returns:
+        List[Dict]: The changes, oldest first.
+
+    Raises:
+        ResumeUnavailable: If the database keeps no history.
+    """
+    if db.get_bind().dialect.name not in ("mysql", "mariadb"):
+        raise ResumeUnavailable("History is only kept by MariaDB")
+    rows = db.execute(_HISTORY_QUERY, {"since": since}).fetchall()
+    db.commit()
+    return history_changes(rows, since)
+
+
+class Subscriber:
+    """A change feed consumer, with its bounded buffer of pending changes."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, buffer_size: int):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(buffer_size)
+        self.overflowed = False
+
+    def offer(self, change: Dict):
+        """Queue a change, or flag the subscriber as too slow. Loop thread only."""
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            metrics.inc("change_feed_disconnects_total")
+
+
+class ChangeFeed:
+    """
+    In-process feed of the changes committed to people.
+
+    Each change gets a sequence number and is kept in a ring buffer of the
+    latest changes, from which subscribers can resume, then pushed to every
+    subscriber's buffer. A subscriber whose buffer is full is disconnected
+    rather than slowing down the writers or the other subscribers.
+
+    Sequence numbers are local to the process: the feed id tells subscribers
+    whether a sequence number they resume from came from this feed.
+    """
+
+    def __init__(self, buffer_size: int, subscriber_buffer_size: int):
+        self.id = f"{datetime.now(timezone.utc):%Y%m%d%H%M%S}-{id(self):x}"
+        self.subscriber_buffer_size = subscriber_buffer_size
+        self._buffer: Deque[Dict] = deque(maxlen=buffer_size)
+        self._seq = itertools.count(1)
+        self._subscribers: List[Subscriber] = []
+        self._lock = threading.Lock()
+        # Whether the feed is fed by polling the people history, and its
+        # progress through it
+        self.polls_history = False
+        self.history_position: Optional[datetime] = None
+        self.history_seen: Dict[Tuple[str, str, str], str] = {}
+
+    def publish(self, changes: List[Tuple[str, Optional[str], bool]]):
+        """
+        Publish committed changes. Called by app.services on the writing thread.
+
+        Args:
+            changes (List[Tuple[str, Optional[str], bool]]): (person id, name,
+                deleted) for each changed person.
+        """
+        timestamp = datetime.now(timezone.utc).isoformat()
+        self.publish_changes(
+            {
+                "op": DELETE if deleted else UPSERT,
+                "person_id": person_id,
+                "name": None if deleted else name,
+                "timestamp": timestamp,
+            }
+            for person_id, name, deleted in changes
+        )
+
+    def publish_changes(self, changes: Iterable[Dict]):
+        """
+        Number, buffer and push changes to the subscribers.
+
+        Args:
+            changes (Iterable[Dict]): The changes, without sequence numbers.
+        """
+        with self._lock:
+            numbered = []
+            for change in changes:
+                change = {"seq": next(self._seq), **change}
+                self._buffer.append(change)
+                numbered.append(change)
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            for change in numbered:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, change)
+
+    def subscribe(self, after_seq: Optional[int] = None) -> Tuple[Subscriber, List]:
+        """
+        Register a subscriber, from the current position or a sequence number.
+
+        Args:
+            after_seq (Optional[int]): Replay the buffered changes following
+                this sequence number.
+
+        Returns:
+            Tuple[Subscriber, List]: The subscriber, and the changes to send
+                before those it receives.
+
+        Raises:
+            ResumeUnavailable: If changes following `after_seq` have already
+                left the buffer.
+        """
+        subscriber = Subscriber(asyncio.get_running_loop(), self.subscriber_buffer_size)
+        with self._lock:
+            backlog = []
+            if after_seq is not None:
+                oldest = self._buffer[0]["seq"] if self._buffer else None
+                if oldest is not None and oldest > after_seq + 1:
+                    raise ResumeUnavailable("Changes have left the buffer")
+                backlog = [c for c in self._buffer if c["seq"] > after_seq]
+            self._subscribers.append(subscriber)
+        return subscriber, backlog
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """
+        Stop pushing changes to a subscriber.
+
+        Args:
+            subscriber (Subscriber): The subscriber.
+        """
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s is not subscriber]
+
+    def cursor(self, change: Dict) -> Optional[str]:
+        """
+        Build the resume cursor of a change: the feed id and sequence number.
+
+        Args:
+            change (Dict): A published change.
+
+        Returns:
+            Optional[str]: The cursor, or None for a change not from this feed.
+        """
+        return f"{self.id}:{change['seq']}" if "seq" in change else None
+
+    def parse_cursor(self, cursor: str) -> Optional[int]:
+        """
+        Find the sequence number a cursor points to.
+
+        Args:
+            cursor (str): A cursor built by `cursor`.
+
+        Returns:
+            Optional[int]: The sequence number, or None if the cursor is from
+                another feed (another worker, or before a restart).
+        """
+        feed_id, _, seq = cursor.rpartition(":")
+        if feed_id != self.id or not seq.isdigit():
+            return None
+        return int(seq)
+
+
+def _event(feed: ChangeFeed, change: Dict, event: str = "change") -> bytes:
+    lines = f"event: {event}\n"
+    cursor = feed.cursor(change)
+    if cursor is not None:
+        lines += f"id: {cursor}\n"
+    return lines.encode() + b"data: " + orjson.dumps(change) + b"\n\n"
+
+
+async def stream_changes(
+    feed: ChangeFeed,
+    subscriber: Subscriber,
+    backlog: List[Dict],
+    keepalive: float,
+) -> AsyncIterator[bytes]:
+    """
+    Render a subscription as server-sent events.
+
+    Args:
+        feed (ChangeFeed): The feed subscribed to.
+        subscriber (Subscriber): The subscriber.
+        backlog (List[Dict]): Changes to send before the live ones.
+        keepalive (float): Seconds of silence after which a comment is sent,
+            to keep proxies from closing the connection.
+
+    Yields:
+        bytes: The events.
+    """
+    try:
+        for change in backlog:
+            yield _event(feed, change)
+        while True:
+            try:
+                change = await asyncio.wait_for(subscriber.queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if subscriber.overflowed:
+                yield _event(feed, {"detail": "Subscriber fell behind"}, "overflow")
+                return
+            yield _event(feed, change)
+    finally:
+        feed.unsubscribe(subscriber)
+
+
+def poll_change_history():
+    """
+    Publish the changes found in the people history since the last poll.
+
+    Lets every worker feed the changes made by all of them, on MariaDB. The
+    history is read again from `change_feed_poll_overlap` seconds back, as a
+    version's start time is when its transaction started, not when it
+    committed; changes already published are skipped.
+    """
+    feed = _feed
+    if feed is None:
+        return
+    overlap = timedelta(seconds=get_settings().change_feed_poll_overlap)
+    with session_scope() as db:
+        now = db.execute(text("SELECT NOW(6)")).scalar()
+        db.commit()
+        if feed.history_position is None:
+            feed.history_position = now
+            return
+        changes = fetch_history_changes(db, feed.history_position - overlap)
+
+    horizon = _utc_isoformat(now - overlap)
+    fresh = []
+    for change in changes:
+        key = (change["op"], change["person_id"], change["timestamp"])
+        if key not in feed.history_seen:
+            feed.history_seen[key] = change["timestamp"]
+            fresh.append(change)
+    feed.history_seen = {
+        key: timestamp
+        for key, timestamp in feed.history_seen.items()
+        if timestamp >= horizon
+    }
+    feed.history_position = now
+    feed.publish_changes(fresh)
+
+
+def open_change_feed() -> Optional[ChangeFeed]:
+    """
+    Start feeding the changes made to people to subscribers, if it can feed
+    every one of them.
+
+    With CHANGE_FEED_SINGLE_WRITER, this process is declared the only one
+    writing people, and its writes are published as they commit. Otherwise
+    the changes of every worker (and command line tool) are read from the
+    people history every CHANGE_FEED_POLL_INTERVAL seconds, which only
+    MariaDB keeps. Failing both, no feed is opened and GET /changes answers
+    503, rather than stream the changes of this worker alone.
+
+    Returns:
+        Optional[ChangeFeed]: The feed, or None if it could miss changes.
+    """
+    global _feed
+    settings = get_settings()
+    feed = ChangeFeed(
+        settings.change_feed_buffer_size, settings.change_feed_subscriber_buffer
+    )
+    keeps_history = get_engines()[0].dialect.name in ("mysql", "mariadb")
+    if settings.change_feed_single_writer:
+        add_change_listener(feed.publish)
+    elif settings.change_feed_poll_interval > 0 and keeps_history:
+        feed.polls_history = True
+    else:
+        logger.warning(
+            "Change feed disabled: it would only carry this worker's changes. "
+            "Poll the people history on MariaDB (CHANGE_FEED_POLL_INTERVAL), or "
+            "set CHANGE_FEED_SINGLE_WRITER if this process is the only writer"
+        )
+        return None
+    _feed = feed
+    return _feed
+
+
+def get_change_feed() -> Optional[ChangeFeed]:
+    """
+    Return the change feed, if open.
+
+    Returns:
+        Optional[ChangeFeed]: The feed, or None.
+    """
+    return _feed
+
+
+def close_change_feed():
+    """
+    Stop feeding changes.
+    """
+    global _feed
+    if _feed is not None:
+        remove_change_listener(_feed.publish)
+        _feed = None
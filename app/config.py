@@ -1,4 +1,5 @@
-from typing import Optional
+from functools import lru_cache
+from typing import Dict, List, Literal, Optional
 
 from pydantic_settings import BaseSettings
 
@@ -16,8 +17,126 @@ class Settings(BaseSettings):
     mariadb_password: Optional[str] = "default_password"
     mariadb_database: Optional[str] = "default_database"
 
+    # Optional sharding of people across databases by consistent hashing of
+    # their id; the first database also holds every other table. Databases
+    # should only ever be appended, see app.sharding
+    shard_database_urls: List[str] = []
+    shard_virtual_nodes: int = 100
+
+    # Admission control: at most admission_max_concurrency requests run at
+    # once (0 disables it), webhooks first, then name lookups, then NL
+    # queries, each class within its own cap and bounded waiting queue
+    admission_max_concurrency: int = 64
+    admission_concurrency: Dict[str, int] = {"webhook": 64, "lookup": 48, "nl": 8}
+    admission_queue_size: Dict[str, int] = {"webhook": 1000, "lookup": 200, "nl": 16}
+    admission_queue_timeout: Dict[str, float] = {
+        "webhook": 10.0,
+        "lookup": 2.0,
+        "nl": 1.0,
+    }
+    # Per-client rate limit of NL queries (0 disables it); clients are told
+    # apart by this header if set, e.g. an API key, else by address
+    nl_rate_limit_per_second: float = 0.0
+    nl_rate_limit_burst: int = 10
+    admission_client_header: Optional[str] = None
+
+    # Database connection pool
+    db_pool_size: int = 10
+    db_max_overflow: int = 10
+    db_pool_warm_connections: int = 2
+    # Retries of write transactions that conflict with another writer, with a
+    # jittered exponential backoff starting at db_retry_base_delay seconds
+    db_write_retries: int = 3
+    db_retry_base_delay: float = 0.02
+
+    # NL translation: "structured" asks the model for JSON matching a strict
+    # schema, "fenced" for ```sql / ```json blocks (for models without
+    # structured outputs)
+    openai_model: str = "gpt-4o-mini"
+    translation_mode: Literal["structured", "fenced"] = "structured"
+    translation_max_tokens: int = 200
+
+    # NL translation cache, optionally preloaded at startup
+    translation_cache_size: int = 256
+    warmup_nl_queries: List[str] = []
+
+    # "direct" applies webhooks to the people table, "event_store" appends them
+    # to the person_events log, from which people is projected in the background
+    storage_mode: Literal["direct", "event_store"] = "direct"
+    projection_interval: float = 0.5
+    projection_batch_size: int = 1000
+    # How long a gap in the event ids may be an uncommitted insert
+    projection_gap_timeout: float = 5.0
+
+    # Change feed: recent changes kept for resuming, changes buffered per
+    # subscriber before it is dropped as too slow, and seconds between
+    # keepalives. Every worker feeds the changes of all of them, polled from
+    # the history (MariaDB only), unless this process is declared the only
+    # writer of people, whose writes are then published as they commit
+    change_feed_buffer_size: int = 10_000
+    change_feed_subscriber_buffer: int = 1000
+    change_feed_keepalive: float = 15.0
+    change_feed_single_writer: bool = False
+    change_feed_poll_interval: float = 1.0
+    change_feed_poll_overlap: float = 5.0
+
+    # Aggregates kept up to date by the webhook write paths, answering common
+    # NL questions without the LLM or a scan. Hot counters are striped over
+    # this many rows, for concurrent writers not to queue on one row lock
+    aggregates_enabled: bool = True
+    aggregate_counter_slots: int = 8
+
+    # Hashes of the ranges of people ids, kept up to date by the write paths
+    # for reconciling against phonebook snapshots (see app.reconcile)
+    range_hashes_enabled: bool = True
+
+    # Optional JSON Lines recording of the NL queries served (questions, raw
+    # LLM answers, templates, stage timings), replayed by benchmarks/replay.py
+    nl_record_path: Optional[str] = None
+    nl_record_sample_rate: float = 1.0
+
+    # Largest webhook body accepted, after decompression
+    webhook_max_body_bytes: int = 1024 * 1024
+
+    # Durable local spool for webhooks, enabled by setting its directory
+    webhook_spool_dir: Optional[str] = None
+    webhook_spool_fsync_interval: float = 0.002
+    webhook_spool_segment_bytes: int = 64 * 1024 * 1024
+    webhook_spool_batch_size: int = 500
+
+    # Shared-memory replica of the current names, e.g. /dev/shm/elysian-names
+    name_replica_path: Optional[str] = None
+    name_replica_check_interval: float = 60.0
+    name_replica_recheck_delay: float = 1.0
+
+    # Frontend assets, served from memory (defaults to the repo's frontend/)
+    frontend_dir: Optional[str] = None
+    static_cache_control: str = "no-cache"
+
+    # Logging
+    log_level: str = "INFO"
+    log_json: bool = True
+    log_result_sample_rate: float = 0.01
+    log_result_max_chars: int = 1000
+
     class Config:
         env_file = ".env"
 
 
-settings = Settings()
+@lru_cache
+def get_settings() -> Settings:
+    """
+    Load the settings on first use.
+
+    Returns:
+        Settings: The application settings.
+    """
+    return Settings()
+
+
+def __getattr__(name: str):
+    # Keep `from app.config import settings` working without loading the
+    # settings at import time
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
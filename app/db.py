@@ -1,12 +1,45 @@
-from sqlalchemy import MetaData, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
 
-from app.config import settings
+from sqlalchemy import MetaData, create_engine, text
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import metrics
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
 
-database_url = settings.database_url
 metadata = MetaData()
 Base = declarative_base()
 
+_engine: Optional[Engine] = None
+# Engine of each shard, when people are sharded across databases
+_shard_engines: Dict[str, Engine] = {}
+
+T = TypeVar("T")
+
+# MariaDB error codes worth retrying the transaction for
+_MYSQL_LOCK_WAIT_TIMEOUT = 1205
+_MYSQL_DEADLOCK = 1213
+
+metrics.describe("db_writes_total", "Write transactions attempted, by operation.")
+metrics.describe(
+    "db_write_conflicts_total",
+    "Write transactions rolled back by a concurrent writer, by operation and kind.",
+)
+metrics.describe(
+    "db_write_retries_exhausted_total",
+    "Write transactions that still conflicted after every retry, by operation.",
+)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
 
 def engine_factory(database_url, **kwargs):
     if not kwargs:
@@ -15,12 +48,224 @@ def engine_factory(database_url, **kwargs):
         return create_engine(database_url, **kwargs)
 
 
+def get_engine() -> Engine:
+    """
+    Return the application's engine, creating it on first use.
+
+    Returns:
+        Engine: The engine bound to the configured database.
+    """
+    global _engine, SessionLocal
+    if _engine is None:
+        settings = get_settings()
+        urls = settings.shard_database_urls or [settings.database_url]
+        engines = []
+        for url in urls:
+            kwargs = {"pool_pre_ping": True}
+            if not url.startswith("sqlite"):
+                kwargs["pool_size"] = settings.db_pool_size
+                kwargs["max_overflow"] = settings.db_max_overflow
+            engines.append(engine_factory(url, **kwargs))
+        _engine = engines[0]
+
+        if settings.shard_database_urls:
+            from app.sharding import HashRing, make_sharded_sessionmaker, shard_names
+
+            names = shard_names(len(engines))
+            _shard_engines.update(zip(names, engines))
+            SessionLocal = make_sharded_sessionmaker(
+                _shard_engines,
+                HashRing(names, settings.shard_virtual_nodes),
+                autocommit=False,
+                autoflush=False,
+            )
+        else:
+            SessionLocal.configure(bind=_engine)
+    return _engine
+
+
+def get_engines() -> List[Engine]:
+    """
+    Return the engines of every database, one per shard when sharded.
+
+    Returns:
+        List[Engine]: The engines, the primary one first.
+    """
+    engine = get_engine()
+    return list(_shard_engines.values()) or [engine]
+
+
+def dispose_engine():
+    """
+    Close the pooled connections and drop the application's engine.
+    """
+    global _engine
+    for engine in list(_shard_engines.values()) or [_engine]:
+        if engine is not None:
+            engine.dispose()
+    _shard_engines.clear()
+    _engine = None
+
+
+def warm_up_pool(engine: Engine, connections: int):
+    """
+    Open pooled connections ahead of the first requests.
+
+    The connections are held open together, so that the pool ends up with
+    that many distinct connections idling until the first requests use them.
+
+    Args:
+        engine (Engine): The engine whose pool to fill.
+        connections (int): The number of connections to open.
+    """
+    opened = []
+    try:
+        for _ in range(connections):
+            connection = engine.connect()
+            opened.append(connection)
+            connection.execute(text("SELECT 1"))
+    finally:
+        for connection in opened:
+            connection.close()
+
+
 def get_db():
-    SessionLocal = sessionmaker(
-        autocommit=False, autoflush=False, bind=engine_factory(database_url)
-    )
+    get_engine()
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    Provide a session for work done outside of a request, such as background
+    tasks.
+
+    Yields:
+        Session: A session bound to the application's engine.
+    """
+    get_engine()
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def conflict_kind(error: Exception) -> Optional[str]:
+    """
+    Tell whether an error was caused by a concurrent writer.
+
+    Args:
+        error (Exception): The error raised by a write transaction.
+
+    Returns:
+        Optional[str]: "stale" for a failed compare-and-swap on a version
+            column, "deadlock" or "lock_wait_timeout" for the MariaDB errors of
+            the same name, or None if retrying would not help.
+    """
+    if isinstance(error, StaleDataError):
+        return "stale"
+    if isinstance(error, OperationalError):
+        code = (
+            error.orig.args[0] if error.orig is not None and error.orig.args else None
+        )
+        if code == _MYSQL_DEADLOCK:
+            return "deadlock"
+        if code == _MYSQL_LOCK_WAIT_TIMEOUT:
+            return "lock_wait_timeout"
+    return None
+
+
+def run_with_retries(db: Session, operation: str, func: Callable[[], T]) -> T:
+    """
+    Run a write transaction, retrying it when it conflicts with another writer.
+
+    `func` must run the whole transaction, reading what it modifies, so that
+    a retry starts over from the current rows. Between attempts the session
+    is rolled back and the caller sleeps for a random ("full jitter") share of
+    an exponentially growing delay, so that the writers that collided do not
+    collide again.
+
+    Args:
+        db (Session): The database session used by `func`.
+        operation (str): The name of the operation, for the metrics.
+        func (Callable[[], T]): Runs and commits the transaction.
+
+    Returns:
+        T: What `func` returned.
+
+    Raises:
+        Exception: What `func` raised, once retries are exhausted or if the
+            error is not a conflict.
+    """
+    settings = get_settings()
+    attempt = 0
+    while True:
+        metrics.inc("db_writes_total", operation=operation)
+        try:
+            return func()
+        except Exception as e:
+            kind = conflict_kind(e)
+            if kind is None:
+                raise
+            db.rollback()
+            metrics.inc("db_write_conflicts_total", operation=operation, kind=kind)
+            if attempt >= settings.db_write_retries:
+                metrics.inc("db_write_retries_exhausted_total", operation=operation)
+                raise
+            delay = random.uniform(0, settings.db_retry_base_delay * 2**attempt)
+            logger.info(
+                "Write conflicted with a concurrent writer, retrying",
+                extra={"operation": operation, "kind": kind, "retry_in": delay},
+            )
+            time.sleep(delay)
+            attempt += 1
+
+
+def merge_rows(
+    db: Session, model, rows: List[Dict], merge: Dict[str, Callable[[Any, Any], Any]]
+):
+    """
+    Insert rows, merging them into the existing rows with the same key.
+
+    Rows are written in key order, so that concurrent transactions lock them
+    in the same order rather than deadlocking. Nothing is committed.
+
+    Args:
+        db (Session): The database session.
+        model: The mapped class of the table, which must live on the primary
+            shard.
+        rows (List[Dict]): The rows, with their key columns.
+        merge (Dict[str, Callable[[Any, Any], Any]]): For each non-key column,
+            a function building its merged value from the existing column and
+            the inserted value, e.g. ``operator.add`` for a counter.
+    """
+    if not rows:
+        return
+    table = model.__table__
+    keys = [key.name for key in table.primary_key]
+    rows = sorted(rows, key=lambda row: [row[key] for key in keys])
+    mapper = model.__mapper__
+    if db.get_bind(mapper=mapper).dialect.name in ("mysql", "mariadb"):
+        statement = mysql.insert(table).values(rows)
+        statement = statement.on_duplicate_key_update(
+            {
+                column: combine(table.c[column], statement.inserted[column])
+                for column, combine in merge.items()
+            }
+        )
+    else:
+        statement = sqlite.insert(table).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=keys,
+            set_={
+                column: combine(table.c[column], statement.excluded[column])
+                for column, combine in merge.items()
+            },
+        )
+    # Binding to the model routes the statement to the primary shard
+    db.execute(statement, bind_arguments={"mapper": mapper})
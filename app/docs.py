@@ -1,5 +1,7 @@
 # Documentation examples and responses for endpoints
 
+from app.models import webhook_payload_adapter
+
 accept_webhook_examples = {
     "PersonAdded": {
         "summary": "A request example for a person added event",
@@ -38,6 +40,27 @@ accept_webhook_examples = {
     },
 }
 
+# The webhook body is read by a dependency rather than declared as a body
+# parameter, so its schema is documented explicitly. The models it refers to
+# are added to the OpenAPI components in app.main.
+webhook_payload_schema = webhook_payload_adapter.json_schema(
+    ref_template="#/components/schemas/{model}"
+)
+webhook_payload_schema_defs = webhook_payload_schema.pop("$defs", {})
+
+accept_webhook_request_body = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": webhook_payload_schema,
+                "examples": accept_webhook_examples,
+            },
+            "application/msgpack": {"schema": webhook_payload_schema},
+        },
+    }
+}
+
 execute_custom_nl_query_examples = {
     "Example 1": {
         "summary": "A custom user query example",
@@ -57,6 +80,14 @@ accept_webhook_responses = {
             }
         },
     },
+    202: {
+        "description": "Webhook spooled or appended to the event log, to be processed in the background",
+        "content": {
+            "application/json": {
+                "example": {"detail": "Webhook accepted for processing"}
+            }
+        },
+    },
     400: {
         "description": "Invalid input",
         "content": {"application/json": {"example": {"detail": "Invalid input"}}},
@@ -65,6 +96,16 @@ accept_webhook_responses = {
         "description": "Person not found",
         "content": {"application/json": {"example": {"detail": "Person not found"}}},
     },
+    413: {
+        "description": "Payload too large",
+        "content": {"application/json": {"example": {"detail": "Payload too large"}}},
+    },
+    415: {
+        "description": "Unsupported media type or content encoding",
+        "content": {
+            "application/json": {"example": {"detail": "Unsupported media type"}}
+        },
+    },
     500: {
         "description": "Server error",
         "content": {
@@ -73,6 +114,71 @@ accept_webhook_responses = {
             }
         },
     },
+    503: {
+        "description": "Overloaded, or the write kept conflicting with concurrent writers, retry later",
+        "content": {
+            "application/json": {
+                "example": {"detail": "Conflicting concurrent update, retry later"}
+            }
+        },
+    },
+}
+
+changes_responses = {
+    200: {
+        "description": "Server-sent events stream of the changes to people",
+        "content": {
+            "text/event-stream": {
+                "example": 'event: change\nid: 20240617120000-7f3a:42\ndata: {"seq": 42, "op": "upsert", "person_id": "123e4567-e89b-12d3-a456-426614174000", "name": "John Doe", "timestamp": "2024-06-17T12:00:00+00:00"}\n\n'
+            }
+        },
+    },
+    410: {
+        "description": "The changes since the resume point are no longer available",
+        "content": {
+            "application/json": {
+                "example": {
+                    "detail": "Cannot resume from this point, resynchronize and subscribe again"
+                }
+            }
+        },
+    },
+    503: {
+        "description": "The change feed is not running, or could not carry every change",
+        "content": {
+            "application/json": {"example": {"detail": "Change feed unavailable"}}
+        },
+    },
+}
+
+range_hashes_responses = {
+    200: {
+        "description": "Hashes of the range and of its 16 subranges",
+        "content": {
+            "application/json": {
+                "example": {
+                    "prefix": "a",
+                    "hash": "1f3c2a9d8e47b650",
+                    "count": 62,
+                    "depth": 3,
+                    "ranges": [
+                        {"prefix": "a0", "hash": "0b61c3e8f2d49a17", "count": 4},
+                        {"prefix": "a1", "hash": "0000000000000000", "count": 0},
+                    ],
+                }
+            }
+        },
+    },
+    400: {
+        "description": "Invalid prefix",
+        "content": {"application/json": {"example": {"detail": "Invalid prefix"}}},
+    },
+    503: {
+        "description": "Range hashes are disabled",
+        "content": {
+            "application/json": {"example": {"detail": "Range hashes unavailable"}}
+        },
+    },
 }
 
 get_name_responses = {
@@ -80,6 +186,7 @@ get_name_responses = {
         "description": "Name fetched successfully",
         "content": {"application/json": {"example": {"name": "John Doe"}}},
     },
+    304: {"description": "The name matching If-None-Match is still current"},
     404: {
         "description": "Person not found",
         "content": {"application/json": {"example": {"detail": "Person not found"}}},
@@ -100,13 +207,40 @@ execute_custom_nl_query_responses = {
         "content": {
             "application/json": {
                 "example": {"result": [{"column1": "value1", "column2": "value2"}]}
-            }
+            },
+            "application/vnd.elysian.columnar+json": {
+                "example": {
+                    "columns": ["column1", "column2"],
+                    "values": [["value1"], ["value2"]],
+                }
+            },
+            "application/vnd.apache.arrow.stream": {
+                "schema": {"type": "string", "format": "binary"}
+            },
         },
     },
     400: {
         "description": "Invalid input",
         "content": {"application/json": {"example": {"detail": "Invalid input"}}},
     },
+    406: {
+        "description": "Requested output format not supported",
+        "content": {
+            "application/json": {
+                "example": {
+                    "detail": "Not acceptable, supported media types: application/json"
+                }
+            }
+        },
+    },
+    429: {
+        "description": "Rate limited or too many queries queued, retry after the Retry-After delay",
+        "content": {
+            "application/json": {
+                "example": {"detail": "Too many requests, retry later"}
+            }
+        },
+    },
     500: {
         "description": "Server error",
         "content": {"application/json": {"example": {"detail": "some error occurred"}}},
@@ -0,0 +1,199 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Optional, Sequence
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import get_settings
+
+# Request id of the request being handled, attached to every log record
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Attributes present on every LogRecord; anything else was passed via `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(
+                record.created, tz=timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and key != "request_id":
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestQueueHandler(QueueHandler):
+    """
+    Queue handler that defers formatting to the listener thread.
+
+    The stock QueueHandler formats the record in the calling thread; here only
+    the request id is captured (it lives in a context variable, so it must be
+    read before the record leaves the request) and the record is enqueued as is.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+
+class TruncatedResult:
+    """
+    Lazily rendered preview of a query result.
+
+    Rendering happens in the logging thread and only looks at the first rows,
+    so large results are never serialized in full.
+    """
+
+    def __init__(self, rows: Sequence[Any], max_chars: int):
+        self.rows = rows
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        preview = []
+        size = 0
+        for row in self.rows:
+            preview.append(row)
+            size += len(str(row))
+            if size >= self.max_chars:
+                break
+        rendered = str(preview)
+        if len(rendered) > self.max_chars or len(preview) < len(self.rows):
+            return f"{rendered[: self.max_chars]}... ({len(self.rows)} rows)"
+        return rendered
+
+
+def configure_logging():
+    """
+    Route the application's logs through a non-blocking queue handler.
+
+    Records are put on an in-memory queue by the request threads and written
+    to stdout as JSON (or plain text) by a background listener thread. Calling
+    this more than once is a no-op.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    settings = get_settings()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if settings.log_json:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(
+            logging.Formatter(
+                "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+            )
+        )
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    logger = logging.getLogger("app")
+    logger.setLevel(settings.log_level.upper())
+    logger.handlers = [RequestQueueHandler(log_queue)]
+    logger.propagate = False
+
+
+def shutdown_logging():
+    """
+    Flush the queued records and stop the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def new_request_id() -> str:
+    """
+    Generate a new request id.
+
+    Returns:
+        str: A random hex identifier.
+    """
+    return uuid.uuid4().hex
+
+
+class RequestIdMiddleware:
+    """
+    Bind a request id to the logging context and echo it in the response.
+
+    Uses the caller's X-Request-ID header when present. A pure ASGI
+    middleware: the request runs in the caller's task and only the response
+    start message is touched, without wrapping the body stream.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope["headers"]:
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        request_id = request_id or new_request_id()
+
+        async def send_with_request_id(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Request-ID"] = request_id
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+
+def log_result(logger: logging.Logger, rows: Sequence[Any]):
+    """
+    Log a sampled, truncated preview of a query result at DEBUG level.
+
+    Args:
+        logger (logging.Logger): The logger to use.
+        rows (Sequence[Any]): The result rows.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    settings = get_settings()
+    if random.random() >= settings.log_result_sample_rate:  # nosec B311
+        return
+    logger.debug(
+        "Query result: %s",
+        TruncatedResult(rows, settings.log_result_max_chars),
+        extra={"row_count": len(rows)},
+    )
@@ -1,19 +1,187 @@
-from fastapi import FastAPI
+import asyncio
+import logging
+from contextlib import asynccontextmanager, suppress
+from typing import List
+
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
+from pydantic import ValidationError
 
+from app import metrics
+from app.admission import AdmissionMiddleware
 from app.api import router
+from app.changefeed import close_change_feed, open_change_feed, poll_change_history
+from app.config import get_settings
+from app.db import dispose_engine, get_engines, session_scope, warm_up_pool
+from app.docs import webhook_payload_schema_defs
+from app.log import RequestIdMiddleware, configure_logging, shutdown_logging
+from app.models import webhook_payload_adapter
+from app.projection import project_events
+from app.recorder import close_nl_recorder, open_nl_recorder
+from app.replica import close_name_replica, get_name_replica, open_name_replica
+from app.responses import FastJSONResponse
+from app.services import (
+    get_llm_client,
+    ingest_webhook_payloads,
+    preload_translations,
+)
+from app.spool import close_webhook_spool, open_webhook_spool
+from app.static import load_static_assets
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up():
+    """
+    Build the clients and fill the pools and caches used by the endpoints.
+
+    Runs before the app reports itself ready, so that the first requests after
+    a deploy do not pay the cold-start cost.
+    """
+    settings = get_settings()
+    get_llm_client()
+    for engine in get_engines():
+        warm_up_pool(engine, settings.db_pool_warm_connections)
+    preload_translations(settings.warmup_nl_queries)
+    load_static_assets()
+    if settings.name_replica_path:
+        with session_scope() as db:
+            open_name_replica(db)
+
+
+def apply_spooled_webhooks(records: List[bytes]):
+    """
+    Store a batch of spooled webhook records in the database.
+    """
+    payloads = []
+    for record in records:
+        try:
+            payloads.append(webhook_payload_adapter.validate_json(record))
+        except ValidationError:
+            logger.error("Skipping invalid spooled webhook", extra={"record": record})
+    with session_scope() as db:
+        ingest_webhook_payloads(db, payloads)
+
+
+def check_name_replica():
+    """
+    Rebuild the name replica if it drifted from the database.
+    """
+    replica = get_name_replica()
+    if replica is not None:
+        with session_scope() as db:
+            replica.check_drift(db)
+
+
+def project_pending_events():
+    """
+    Fold the events appended to the event log into the people table.
+    """
+    with session_scope() as db:
+        while project_events(db):
+            pass
+
+
+async def run_periodically(func, interval: float):
+    """
+    Run a blocking function in the threadpool every `interval` seconds.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(func)
+        except Exception:
+            logger.exception("Periodic task %s failed", func.__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warm up the app on startup and release its resources on shutdown.
+    """
+    # Route application logs through the non-blocking queue handler
+    configure_logging()
+    app.state.ready = False
+    await run_in_threadpool(warm_up)
+    await run_in_threadpool(open_webhook_spool, apply_spooled_webhooks)
+    change_feed = open_change_feed()
+    open_nl_recorder()
+
+    settings = get_settings()
+    tasks = []
+    if settings.name_replica_path:
+        tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    check_name_replica, settings.name_replica_check_interval
+                )
+            )
+        )
+    if change_feed is not None and change_feed.polls_history:
+        tasks.append(
+            asyncio.create_task(
+                run_periodically(
+                    poll_change_history, settings.change_feed_poll_interval
+                )
+            )
+        )
+    if settings.storage_mode == "event_store":
+        tasks.append(
+            asyncio.create_task(
+                run_periodically(project_pending_events, settings.projection_interval)
+            )
+        )
+
+    app.state.ready = True
+    logger.info("Warm-up complete, ready to serve requests")
+    yield
+    app.state.ready = False
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    await run_in_threadpool(close_webhook_spool)
+    close_change_feed()
+    close_nl_recorder()
+    close_name_replica()
+    dispose_engine()
+    shutdown_logging()
+
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Elysian - Claim Conductor Phonebook Integration",
     description="Service that handles incoming webhook notifications from a phonebook, manages internal state, and allows querying for current user names and other queries via natural language.",
     version="1.0.0",
+    default_response_class=FastJSONResponse,
+    lifespan=lifespan,
 )
+app.state.ready = False
 
 # Include API router
 app.include_router(router)
 
+
+def openapi():
+    """
+    Generate the OpenAPI schema, including the webhook payload models.
+    """
+    if app.openapi_schema is None:
+        schema = FastAPI.openapi(app)
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(
+            webhook_payload_schema_defs
+        )
+    return app.openapi_schema
+
+
+app.openapi = openapi
+
+# Admit requests by priority, webhooks first (inside CORS and request ids, so
+# that rejections carry their headers)
+app.add_middleware(AdmissionMiddleware)
+
 # Enable CORS for frontend access
 app.add_middleware(
     CORSMiddleware,
@@ -23,14 +191,56 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Bind a request id to the logs of every request, outermost
+app.add_middleware(RequestIdMiddleware)
+
 
 @app.get("/nl-to-sql", response_class=HTMLResponse)
-async def serve_nl_to_sql():
+@app.head("/nl-to-sql", include_in_schema=False)
+async def serve_nl_to_sql(request: Request):
     """
     Serve the HTML page for Natural Language to SQL translation.
 
     Returns:
-        HTMLResponse: The HTML content of nl_to_sql.html.
+        Response: The HTML content of nl_to_sql.html, served from memory.
+    """
+    return load_static_assets().response(request, "nl_to_sql.html")
+
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def serve_static(request: Request, path: str):
+    """
+    Serve any other frontend asset from memory.
+
+    Returns:
+        Response: The asset, a 304 if the client's copy is current, or a 404.
+    """
+    return load_static_assets().response(request, path)
+
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    """
+    Liveness probe: the process is up and serving requests.
+    """
+    return {"status": "ok"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """
+    Expose this worker's counters in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """
+    Readiness probe: succeeds once the startup warm-up has completed.
     """
-    with open("nl_to_sql.html") as f:
-        return HTMLResponse(f.read())
+    if not app.state.ready:
+        return FastJSONResponse({"status": "starting"}, status_code=503)
+    return {"status": "ready"}
@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import operator
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.config import get_settings
+from app.db import merge_rows
+from app.models import PeopleHashBucket, Person
+
+logger = logging.getLogger(__name__)
+
+# The leaves of the tree are the ranges of ids sharing their first
+# BUCKET_DIGITS hex digits (4096 ranges); each level up drops a digit
+BUCKET_DIGITS = 3
+HEX_DIGITS = "0123456789abcdef"
+
+# Row hashes keep 63 bits, so that XORing them as (a | b) - (a & b), which
+# SQLite understands too, never overflows a signed BIGINT
+_HASH_MASK = (1 << 63) - 1
+
+
+def row_hash(person_id: str, name: Optional[str]) -> int:
+    """
+    Hash a people row, as peers must to compare range hashes.
+
+    Args:
+        person_id (str): The person id, a lowercase UUID with hyphens.
+        name (Optional[str]): The name.
+
+    Returns:
+        int: The first 8 bytes of the BLAKE2b digest of ``id NUL name``
+            (UTF-8), big-endian, with the top bit cleared.
+    """
+    digest = hashlib.blake2b(
+        f"{person_id}\0{name or ''}".encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big") & _HASH_MASK
+
+
+def bucket_of(person_id: str) -> str:
+    """
+    Find the leaf range of an id.
+
+    Args:
+        person_id (str): The person id.
+
+    Returns:
+        str: The id's first BUCKET_DIGITS hex digits.
+    """
+    return person_id[:BUCKET_DIGITS].lower()
+
+
+def _xor(current, new):
+    return current.op("|")(new) - current.op("&")(new)
+
+
+def leaf_deltas(
+    changes: Iterable[Tuple[str, Optional[str], Optional[str]]],
+) -> Dict[str, Tuple[int, int]]:
+    """
+    Compute how changes to people move the hash and row count of their leaves.
+
+    Args:
+        changes (Iterable[Tuple[str, Optional[str], Optional[str]]]): (person
+            id, name before, name after) of each changed person, None
+            standing for a missing person.
+
+    Returns:
+        Dict[str, Tuple[int, int]]: The hash to XOR into, and the number of
+            rows to add to, each leaf the changes touch.
+    """
+    deltas: Dict[str, Tuple[int, int]] = {}
+    for person_id, before, after in changes:
+        bucket = bucket_of(person_id)
+        digest, count = deltas.get(bucket, (0, 0))
+        if before is not None:
+            digest ^= row_hash(person_id, before)
+            count -= 1
+        if after is not None:
+            digest ^= row_hash(person_id, after)
+            count += 1
+        deltas[bucket] = (digest, count)
+    return deltas
+
+
+def update_range_hashes(
+    db: Session, changes: List[Tuple[str, Optional[str], Optional[str]]]
+):
+    """
+    Update the range hashes with changes made to people, in their transaction.
+
+    Called by the write paths of app.services before they commit. As a leaf
+    hash is the XOR of its row hashes, a change only XORs out the old row's
+    hash and XORs in the new one. Nothing is committed.
+
+    Args:
+        db (Session): The database session.
+        changes (List[Tuple[str, Optional[str], Optional[str]]]): (person id,
+            name before, name after) of each changed person, None standing
+            for a missing person.
+    """
+    if not get_settings().range_hashes_enabled:
+        return
+    merge_rows(
+        db,
+        PeopleHashBucket,
+        [
+            {"bucket": bucket, "hash": digest, "count": count}
+            for bucket, (digest, count) in leaf_deltas(changes).items()
+            if digest or count
+        ],
+        {"hash": _xor, "count": operator.add},
+    )
+
+
+def read_leaves(db: Session) -> Dict[str, Tuple[int, int]]:
+    """
+    Read the hash and row count of every non-empty leaf range.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        Dict[str, Tuple[int, int]]: (hash, row count) by leaf.
+    """
+    return {
+        bucket: (digest, count)
+        for bucket, digest, count in db.query(
+            PeopleHashBucket.bucket, PeopleHashBucket.hash, PeopleHashBucket.count
+        )
+        if digest or count
+    }
+
+
+def range_hash(leaves: Dict[str, Tuple[int, int]], prefix: str) -> Tuple[int, int]:
+    """
+    Combine the leaves of a range of ids into its hash and row count.
+
+    Args:
+        leaves (Dict[str, Tuple[int, int]]): (hash, row count) by leaf.
+        prefix (str): The range: the ids starting with these hex digits.
+
+    Returns:
+        Tuple[int, int]: The XOR of the leaf hashes and the sum of their
+            row counts.
+    """
+    digest = count = 0
+    for bucket, (leaf_digest, leaf_count) in leaves.items():
+        if bucket.startswith(prefix):
+            digest ^= leaf_digest
+            count += leaf_count
+    return digest, count
+
+
+def subrange_hashes(leaves: Dict[str, Tuple[int, int]], prefix: str) -> List[Dict]:
+    """
+    Describe the 16 subranges of a range, one level down the tree.
+
+    Args:
+        leaves (Dict[str, Tuple[int, int]]): (hash, row count) by leaf.
+        prefix (str): The range, shorter than a leaf.
+
+    Returns:
+        List[Dict]: The prefix, hash (16 hex digits) and row count of each
+            subrange.
+    """
+    subranges = []
+    for digit in HEX_DIGITS:
+        digest, count = range_hash(leaves, prefix + digit)
+        subranges.append(
+            {"prefix": prefix + digit, "hash": f"{digest:016x}", "count": count}
+        )
+    return subranges
+
+
+def rebuild_range_hashes(db: Session) -> int:
+    """
+    Recompute the range hashes from a scan of people. Nothing is committed.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        int: The number of rows hashed.
+    """
+    db.query(PeopleHashBucket).delete(synchronize_session=False)
+    leaves: Dict[str, List[int]] = {}
+    rows = 0
+    for person_id, name in db.query(Person.id, Person.name).yield_per(10_000):
+        leaf = leaves.setdefault(bucket_of(person_id), [0, 0])
+        leaf[0] ^= row_hash(person_id, name)
+        leaf[1] += 1
+        rows += 1
+    db.add_all(
+        PeopleHashBucket(bucket=bucket, hash=digest, count=count)
+        for bucket, (digest, count) in leaves.items()
+    )
+    db.flush()
+    logger.info("Rebuilt range hashes", extra={"rows": rows})
+    return rows
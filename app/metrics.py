@@ -0,0 +1,83 @@
+import threading
+from typing import Dict, Tuple
+
+# Counters of this process, keyed by name then by sorted (label, value) pairs
+_counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+_descriptions: Dict[str, str] = {}
+_lock = threading.Lock()
+
+
+def describe(name: str, description: str):
+    """
+    Register the help text of a counter.
+
+    Args:
+        name (str): The counter name.
+        description (str): What the counter counts.
+    """
+    with _lock:
+        _descriptions[name] = description
+        _counters.setdefault(name, {})
+
+
+def inc(name: str, amount: float = 1, **labels: str):
+    """
+    Increment a counter.
+
+    Args:
+        name (str): The counter name.
+        amount (float): How much to add.
+        **labels (str): The labels of the series to increment.
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def value(name: str, **labels: str) -> float:
+    """
+    Read a counter.
+
+    Args:
+        name (str): The counter name.
+        **labels (str): The labels of the series to read.
+
+    Returns:
+        float: The current value, 0 if never incremented.
+    """
+    with _lock:
+        return _counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+
+def render() -> str:
+    """
+    Render every counter in the Prometheus text exposition format.
+
+    Counters are kept per process: with several workers, each one reports its
+    own and the scraper sums them.
+
+    Returns:
+        str: The exposition.
+    """
+    lines = []
+    with _lock:
+        for name in sorted(_counters):
+            if name in _descriptions:
+                lines.append(f"# HELP {name} {_descriptions[name]}")
+            lines.append(f"# TYPE {name} counter")
+            for key, count in sorted(_counters[name].items()):
+                labels = ",".join(f'{label}="{value}"' for label, value in key)
+                lines.append(
+                    f"{name}{{{labels}}} {count:g}" if labels else f"{name} {count:g}"
+                )
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """
+    Zero every counter.
+    """
+    with _lock:
+        for series in _counters.values():
+            series.clear()
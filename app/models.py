@@ -1,9 +1,10 @@
 import uuid
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Literal, Optional, Union
 
-from pydantic import UUID4, BaseModel
-from sqlalchemy import Column, String
+from pydantic import UUID4, BaseModel, Field, TypeAdapter
+from sqlalchemy import BigInteger, Column, Date, DateTime, Integer, String, func
+from typing_extensions import Annotated
 
 from app.db import Base
 
@@ -14,6 +15,72 @@ class Person(Base):
 
     id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     name = Column(String(255), index=True)
+    # Bumped by every update: updates and deletes only apply to the version
+    # read (compare-and-swap), raising StaleDataError if it changed meanwhile
+    version = Column(Integer, nullable=False, server_default="1")
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+class PersonEvent(Base):
+    __tablename__ = "person_events"
+
+    # Position in the event log; SQLite only autoincrements INTEGER keys
+    id = Column(
+        BigInteger().with_variant(Integer, "sqlite"),
+        primary_key=True,
+        autoincrement=True,
+    )
+    person_id = Column(String(36), nullable=False)
+    payload_type = Column(String(32), nullable=False)
+    name = Column(String(255))
+    event_timestamp = Column(DateTime)
+    received_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class ProjectionCheckpoint(Base):
+    __tablename__ = "projection_checkpoints"
+
+    name = Column(String(64), primary_key=True)
+    position = Column(BigInteger, nullable=False, default=0)
+
+
+# Aggregates maintained by the write paths, see app.aggregates. Hot counters
+# are striped over several slot rows, summed when read, so that concurrent
+# writers rarely wait on the same row lock
+class PeopleStat(Base):
+    __tablename__ = "people_stats"
+
+    name = Column(String(32), primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+class DailyEventCount(Base):
+    __tablename__ = "daily_event_counts"
+
+    day = Column(Date, primary_key=True)
+    event_type = Column(String(32), primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(BigInteger, nullable=False, default=0)
+
+
+class FirstNameCount(Base):
+    __tablename__ = "first_name_counts"
+
+    first_name = Column(String(255), primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0, index=True)
+
+
+# Hash of each range of people ids, see app.merkle
+class PeopleHashBucket(Base):
+    __tablename__ = "people_hash_buckets"
+
+    # The ids' leading hex digits
+    bucket = Column(String(8), primary_key=True)
+    # XOR of the 63-bit hashes of the rows in the range
+    hash = Column(BigInteger, nullable=False, default=0)
+    count = Column(BigInteger, nullable=False, default=0)
 
 
 # Pydantic Models
@@ -42,9 +109,28 @@ class PersonRemoved(BaseModel):
     timestamp: datetime
 
 
-class WebhookPayload(BaseModel):
-    payload_type: str
-    payload_content: Dict
+class PersonAddedWebhook(BaseModel):
+    payload_type: Literal["PersonAdded"]
+    payload_content: PersonAdded
+
+
+class PersonRenamedWebhook(BaseModel):
+    payload_type: Literal["PersonRenamed"]
+    payload_content: PersonRenamed
+
+
+class PersonRemovedWebhook(BaseModel):
+    payload_type: Literal["PersonRemoved"]
+    payload_content: PersonRemoved
+
+
+# Webhook payloads, validated in a single pass: `payload_type` selects the
+# model used for `payload_content`
+WebhookPayload = Annotated[
+    Union[PersonAddedWebhook, PersonRenamedWebhook, PersonRemovedWebhook],
+    Field(discriminator="payload_type"),
+]
+webhook_payload_adapter = TypeAdapter(WebhookPayload)
 
 
 class GetNameResponse(BaseModel):
@@ -0,0 +1,202 @@
+import argparse
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.aggregates import rebuild_aggregates
+from app.config import get_settings
+from app.db import run_with_retries
+from app.merkle import rebuild_range_hashes
+from app.models import Person, PersonEvent, ProjectionCheckpoint
+from app.replica import refresh_name_replica
+from app.services import fold_person_events, publish_changes
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = "people"
+
+# Gap in the event ids being waited for: (first missing id, monotonic time)
+_gap: Optional[Tuple[int, float]] = None
+
+
+def _lock_checkpoint(db: Session) -> ProjectionCheckpoint:
+    """
+    Lock the projection checkpoint for this transaction, creating it if needed.
+
+    The row lock is what keeps the projectors of several workers from folding
+    the same events concurrently.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        ProjectionCheckpoint: The locked checkpoint.
+    """
+    checkpoint = (
+        db.query(ProjectionCheckpoint)
+        .filter(ProjectionCheckpoint.name == CHECKPOINT_NAME)
+        .with_for_update()
+        .one_or_none()
+    )
+    if checkpoint is None:
+        checkpoint = ProjectionCheckpoint(name=CHECKPOINT_NAME, position=0)
+        db.add(checkpoint)
+    return checkpoint
+
+
+def _read_events(db: Session, position: int, batch_size: int) -> List[PersonEvent]:
+    return (
+        db.query(PersonEvent)
+        .filter(PersonEvent.id > position)
+        .order_by(PersonEvent.id)
+        .limit(batch_size)
+        .all()
+    )
+
+
+def _contiguous(events: List[PersonEvent], position: int, gap_timeout: float):
+    """
+    Keep the events up to the first gap in their ids that may yet fill.
+
+    Ids are allocated when an insert starts, so a gap may be a transaction
+    that has yet to commit, whose events must not be skipped. A gap is only
+    treated as permanent (a rolled back insert or ids reserved but unused)
+    once it has persisted for `gap_timeout` seconds, each gap being timed
+    from when it was first seen.
+
+    Args:
+        events (List[PersonEvent]): Events following `position`, in id order.
+        position (int): The id of the last projected event.
+        gap_timeout (float): How long to wait for a gap to fill.
+
+    Returns:
+        List[PersonEvent]: The events that can be projected now.
+    """
+    global _gap
+    expected = position + 1
+    for index, event in enumerate(events):
+        if event.id != expected:
+            now = time.monotonic()
+            if _gap is None or _gap[0] != expected:
+                _gap = (expected, now)
+            if now - _gap[1] < gap_timeout:
+                return events[:index]
+            logger.warning(
+                "Skipping gap in the event log",
+                extra={"from_id": expected, "to_id": event.id - 1},
+            )
+            _gap = None
+        expected = event.id + 1
+    return events
+
+
+def project_events(
+    db: Session, batch_size: Optional[int] = None, gap_timeout: Optional[float] = None
+) -> int:
+    """
+    Fold the events appended since the checkpoint into the people table.
+
+    The events and the checkpoint are updated in the same transaction, so
+    the projection always reflects exactly the events up to the checkpoint.
+
+    Args:
+        db (Session): The database session.
+        batch_size (Optional[int]): The maximum number of events to project,
+            defaulting to the configured batch size.
+        gap_timeout (Optional[float]): How long to wait for a gap in the event
+            ids to fill before skipping it, defaulting to the configured one.
+
+    Returns:
+        int: The number of events projected.
+    """
+    settings = get_settings()
+    batch_size = batch_size or settings.projection_batch_size
+    if gap_timeout is None:
+        gap_timeout = settings.projection_gap_timeout
+
+    def project():
+        checkpoint = _lock_checkpoint(db)
+        events = _contiguous(
+            _read_events(db, checkpoint.position, batch_size),
+            checkpoint.position,
+            gap_timeout,
+        )
+        if not events:
+            db.rollback()
+            return 0, []
+        _, changes = fold_person_events(
+            db, [(event.payload_type, event.person_id, event.name) for event in events]
+        )
+        checkpoint.position = events[-1].id
+        db.commit()
+        return len(events), changes
+
+    projected, changes = run_with_retries(db, "project_events", project)
+    publish_changes(changes)
+    return projected
+
+
+def rebuild_projection(db: Session, batch_size: Optional[int] = None) -> int:
+    """
+    Rebuild the people table from the whole event log.
+
+    Runs in a single transaction holding the checkpoint lock, so projection
+    pauses meanwhile and readers see the old table until it commits. The
+    aggregates and range hashes are rebuilt along, and so is the name replica
+    of this host (see refresh_name_replica). The servers are not told
+    otherwise: replicas on other hosts catch up at their next drift check,
+    and change feed subscribers only see the rebuild through history polling
+    (CHANGE_FEED_POLL_INTERVAL, on MariaDB).
+
+    Args:
+        db (Session): The database session.
+        batch_size (Optional[int]): How many events to fold at a time.
+
+    Returns:
+        int: The number of events replayed.
+    """
+    batch_size = batch_size or get_settings().projection_batch_size
+    checkpoint = _lock_checkpoint(db)
+    db.query(Person).delete(synchronize_session=False)
+
+    position = replayed = 0
+    while True:
+        events = _read_events(db, position, batch_size)
+        if not events:
+            break
+        fold_person_events(
+            db, [(event.payload_type, event.person_id, event.name) for event in events]
+        )
+        # The next batch looks up the rows folded so far
+        db.flush()
+        position = events[-1].id
+        replayed += len(events)
+
+    checkpoint.position = position
+    rebuild_aggregates(db)
+    rebuild_range_hashes(db)
+    db.commit()
+    logger.info("Rebuilt people projection", extra={"events": replayed})
+    refresh_name_replica(db)
+    return replayed
+
+
+if __name__ == "__main__":
+    from app.db import session_scope
+
+    parser = argparse.ArgumentParser(
+        description="Maintain the people projection of the event log."
+    )
+    parser.add_argument("command", choices=["rebuild", "catch-up"])
+    args = parser.parse_args()
+
+    with session_scope() as db:
+        if args.command == "rebuild":
+            count = rebuild_projection(db)
+        else:
+            count = 0
+            while projected := project_events(db, gap_timeout=0):
+                count += projected
+    print(f"Projected {count} events")
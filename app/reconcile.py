@@ -0,0 +1,205 @@
+import argparse
+import csv
+import json
+import logging
+import uuid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.aggregates import ADDED, REMOVED, RENAMED
+from app.merkle import bucket_of, read_leaves, row_hash
+from app.models import Person
+from app.replica import refresh_name_replica
+from app.services import apply_person_events
+
+logger = logging.getLogger(__name__)
+
+_STATS = {ADDED: "added", RENAMED: "renamed", REMOVED: "removed"}
+
+
+def read_snapshot(path: str) -> Iterator[Tuple[str, str]]:
+    """
+    Read the people of a phonebook snapshot.
+
+    A ``.csv`` snapshot has a header row naming its ``id`` (or ``person_id``)
+    and ``name`` columns; any other file holds one JSON object with the same
+    keys per line. Rows with an invalid id are logged and skipped. Each id
+    must appear once.
+
+    Args:
+        path (str): The snapshot file.
+
+    Yields:
+        Tuple[str, str]: The id, normalized to a lowercase UUID, and the name
+            of each person.
+    """
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            try:
+                person_id = str(uuid.UUID(str(row.get("id") or row.get("person_id"))))
+            except ValueError:
+                logger.warning(
+                    "Skipping snapshot row with an invalid id", extra={"row": row}
+                )
+                continue
+            yield person_id, row.get("name") or ""
+
+
+def snapshot_leaves(path: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Compute the leaf range hashes of a snapshot, as app.merkle keeps them.
+
+    Args:
+        path (str): The snapshot file.
+
+    Returns:
+        Dict[str, Tuple[int, int]]: (hash, row count) by non-empty leaf.
+    """
+    leaves: Dict[str, Tuple[int, int]] = {}
+    for person_id, name in read_snapshot(path):
+        bucket = bucket_of(person_id)
+        digest, count = leaves.get(bucket, (0, 0))
+        leaves[bucket] = (digest ^ row_hash(person_id, name), count + 1)
+    return leaves
+
+
+def differing_ranges(
+    ours: Dict[str, Tuple[int, int]], theirs: Dict[str, Tuple[int, int]]
+) -> List[str]:
+    """
+    List the leaf ranges whose hash or row count differ.
+
+    Args:
+        ours (Dict[str, Tuple[int, int]]): (hash, row count) by leaf.
+        theirs (Dict[str, Tuple[int, int]]): (hash, row count) by leaf.
+
+    Returns:
+        List[str]: The differing leaves, in order.
+    """
+    return sorted(
+        bucket
+        for bucket in ours.keys() | theirs.keys()
+        if ours.get(bucket, (0, 0)) != theirs.get(bucket, (0, 0))
+    )
+
+
+def repair_events(
+    current: Dict[str, Optional[str]], wanted: Dict[str, str]
+) -> List[Tuple[str, str, Optional[str]]]:
+    """
+    Build the events turning the people of a range into those of the snapshot.
+
+    Args:
+        current (Dict[str, Optional[str]]): Name by id, in the database.
+        wanted (Dict[str, str]): Name by id, in the snapshot.
+
+    Returns:
+        List[Tuple[str, str, Optional[str]]]: (payload type, person id, name)
+            of each event, as fold_person_events takes them.
+    """
+    events = []
+    for person_id, name in sorted(wanted.items()):
+        if person_id not in current:
+            events.append((ADDED, person_id, name))
+        elif current[person_id] != name:
+            events.append((RENAMED, person_id, name))
+    for person_id in sorted(current.keys() - wanted.keys()):
+        events.append((REMOVED, person_id, None))
+    return events
+
+
+def reconcile(
+    db: Session, path: str, batch_size: int = 1000, dry_run: bool = False
+) -> Dict[str, int]:
+    """
+    Bring the people table in line with a phonebook snapshot, range by range.
+
+    The snapshot's range hashes are computed in one pass over the file and
+    compared to those kept by the write paths, without reading people. Only
+    the rows of differing ranges are then read, from the snapshot and the
+    database, and the differences written with apply_person_events, so that
+    the work done grows with the drift rather than the table size, and the
+    aggregates and range hashes are updated along. Webhooks applied meanwhile
+    may leave ranges unresolved; run it again.
+
+    Run from the command line, the repairs are not seen by the servers: the
+    name replica of this host is rebuilt afterwards (see
+    refresh_name_replica), replicas on other hosts catch up at their next
+    drift check, and change feed subscribers only see the repairs through
+    history polling (CHANGE_FEED_POLL_INTERVAL, on MariaDB).
+
+    Args:
+        db (Session): The database session.
+        path (str): The snapshot file (see read_snapshot).
+        batch_size (int): How many repairs to write per transaction.
+        dry_run (bool): Only count the repairs, without writing them.
+
+    Returns:
+        Dict[str, int]: The number of differing ranges, of people added,
+            renamed and removed, and of ranges still differing afterwards.
+    """
+    theirs = snapshot_leaves(path)
+    differing = differing_ranges(read_leaves(db), theirs)
+    stats = {"ranges": len(differing), "added": 0, "renamed": 0, "removed": 0}
+
+    # Second pass over the snapshot, keeping only the rows to compare
+    wanted: Dict[str, Dict[str, str]] = {bucket: {} for bucket in differing}
+    if differing:
+        for person_id, name in read_snapshot(path):
+            if bucket_of(person_id) in wanted:
+                wanted[bucket_of(person_id)][person_id] = name
+
+    events = []
+    for bucket in differing:
+        current = dict(
+            db.query(Person.id, Person.name).filter(Person.id.like(f"{bucket}%"))
+        )
+        events += repair_events(current, wanted[bucket])
+    db.commit()
+    for payload_type, _, _ in events:
+        stats[_STATS[payload_type]] += 1
+
+    if dry_run:
+        stats["unresolved"] = len(differing)
+    else:
+        for start in range(0, len(events), batch_size):
+            apply_person_events(db, events[start : start + batch_size], "reconcile")
+        stats["unresolved"] = len(differing_ranges(read_leaves(db), theirs))
+        db.commit()
+        if events:
+            refresh_name_replica(db)
+    logger.info("Reconciled people with snapshot", extra=stats)
+    return stats
+
+
+if __name__ == "__main__":
+    from app.db import session_scope
+    from app.merkle import rebuild_range_hashes
+
+    parser = argparse.ArgumentParser(
+        description="Reconcile people with a phonebook snapshot."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild", help="Recompute the range hashes from people")
+    reconcile_parser = subparsers.add_parser(
+        "reconcile", help="Repair the ranges differing from a snapshot"
+    )
+    reconcile_parser.add_argument("snapshot", help="CSV or JSON Lines snapshot")
+    reconcile_parser.add_argument("--batch-size", type=int, default=1000)
+    reconcile_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    with session_scope() as db:
+        if args.command == "rebuild":
+            rows = rebuild_range_hashes(db)
+            db.commit()
+            print(f"Hashed {rows} people")
+        else:
+            print(
+                json.dumps(reconcile(db, args.snapshot, args.batch_size, args.dry_run))
+            )
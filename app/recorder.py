@@ -0,0 +1,176 @@
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional
+
+import orjson
+
+from app import metrics
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Records waiting for the writer thread, beyond which new ones are dropped
+_QUEUE_SIZE = 10000
+
+metrics.describe(
+    "nl_records_dropped_total",
+    "NL query records dropped because the recorder's queue was full.",
+)
+
+_recorder: Optional["NLRecorder"] = None
+
+
+class NLRecorder:
+    """
+    Append-only JSON Lines file of the NL queries served, for offline replay.
+
+    Each line holds the question, the raw LLM answer, the parsed template and
+    parameters and the time spent in each stage (see NLTrace), so that
+    benchmarks/replay.py can run the same traffic without OpenAI. Records are
+    put on an in-memory queue by the request threads and serialized and
+    written by a background thread, as app.log does for log records; when the
+    queue is full, records are dropped rather than slowing requests down.
+    """
+
+    def __init__(self, path: str, sample_rate: float = 1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self._file = open(path, "ab")
+        self._queue: queue.Queue = queue.Queue(_QUEUE_SIZE)
+        self._thread = threading.Thread(
+            target=self._run, name="nl-recorder", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, record: Dict):
+        """
+        Queue a record for writing, subject to sampling.
+
+        Args:
+            record (Dict): The record, not to be modified afterwards.
+        """
+        if random.random() >= self.sample_rate:  # nosec B311
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("nl_records_dropped_total")
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                self._file.write(orjson.dumps(record, default=str) + b"\n")
+                # Flush once the queue is drained rather than after each line
+                if self._queue.empty():
+                    self._file.flush()
+            except (OSError, TypeError):
+                logger.warning("Failed to record NL query", exc_info=True)
+        self._file.close()
+
+    def close(self):
+        """
+        Write the queued records, stop the writer thread and close the file.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+class NLTrace:
+    """
+    Timings and intermediate results of one NL query, written to the recorder
+    (if enabled) once the query is done.
+    """
+
+    def __init__(self, question: str):
+        self.record: Dict = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "question": question,
+            "source": "llm",
+            "raw_response": None,
+            "query_template": None,
+            "params": None,
+            "rows": None,
+            "error": None,
+            "timings_ms": {},
+        }
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time a stage of the query, recording the error it raises, if any.
+
+        Args:
+            name (str): The stage: aggregates, translate, parse, execute or
+                render.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.record["timings_ms"][name] = round(elapsed * 1000, 3)
+
+    def save(self):
+        """
+        Hand the trace to the recorder, if enabled.
+        """
+        recorder = _recorder
+        if recorder is None:
+            return
+        total = time.perf_counter() - self._started
+        self.record["timings_ms"]["total"] = round(total * 1000, 3)
+        recorder.write(self.record)
+
+
+def open_nl_recorder() -> Optional[NLRecorder]:
+    """
+    Start recording NL queries, if enabled.
+
+    Each worker records to its own file, the process id being inserted
+    before the extension of the configured path (nl.jsonl becomes
+    nl.<pid>.jsonl).
+
+    Returns:
+        Optional[NLRecorder]: The recorder, or None if it is disabled.
+    """
+    global _recorder
+    settings = get_settings()
+    if not settings.nl_record_path:
+        return None
+    root, extension = os.path.splitext(settings.nl_record_path)
+    path = f"{root}.{os.getpid()}{extension}"
+    _recorder = NLRecorder(path, settings.nl_record_sample_rate)
+    return _recorder
+
+
+def get_nl_recorder() -> Optional[NLRecorder]:
+    """
+    Return the NL query recorder, if enabled.
+
+    Returns:
+        Optional[NLRecorder]: The recorder, or None.
+    """
+    return _recorder
+
+
+def close_nl_recorder():
+    """
+    Stop recording NL queries.
+    """
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
@@ -0,0 +1,638 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+from contextlib import contextmanager, suppress
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.config import get_settings
+from app.merkle import read_leaves, row_hash
+from app.models import Person
+
+logger = logging.getLogger(__name__)
+
+# File layout: header, then `capacity` fixed-size slots, then a heap holding the
+# UTF-8 encoded names. Slots are found by linear probing on the UUID bytes.
+_MAGIC = b"ELYNAME2"
+# magic, seq, retired, capacity, count, used_slots, heap_size, heap_used, then
+# the XOR of the row hashes of the entries (see app.merkle.row_hash) and the
+# offsets from the database's version measured at the last rebuild
+_HEADER = struct.Struct("<8sQQQQQQQQQq")
+# key, heap offset, name length, state
+_SLOT = struct.Struct("<16sIHBx")
+_SEQ_OFFSET = 8
+_RETIRED_OFFSET = 16
+_STATE_OFFSET = 22
+_BASE_OFFSET = 72
+
+_EMPTY, _USED, _DELETED = 0, 1, 2
+_NULL_NAME = 0xFFFF
+_MAX_LOAD = 0.7
+_MIN_CAPACITY = 1024
+_MIN_HEAP = 64 * 1024
+_READ_RETRIES = 100
+# Reads of the database version made by a drift check, at most
+_DRIFT_READS = 3
+# Writes published during a rebuild: key, deleted, name length, then the name
+_JOURNAL = struct.Struct("<16sBH")
+
+_replica: Optional["NameReplica"] = None
+_replica_lock = threading.Lock()
+
+
+class ReplicaFull(Exception):
+    """Raised when the replica has no room left for a write."""
+
+
+def _retired(buf) -> bool:
+    return struct.unpack_from("<Q", buf, _RETIRED_OFFSET)[0] != 0
+
+
+def _key(person_id) -> Optional[bytes]:
+    try:
+        return uuid.UUID(str(person_id)).bytes
+    except ValueError:
+        return None
+
+
+def _slot_offset(index: int) -> int:
+    return _HEADER.size + index * _SLOT.size
+
+
+def _probe(buf, capacity: int, key: bytes):
+    """Yield (index, slot) pairs along the probe sequence of `key`."""
+    index = int.from_bytes(key[:8], "little") & (capacity - 1)
+    for _ in range(capacity):
+        yield index, _SLOT.unpack_from(buf, _slot_offset(index))
+        index = (index + 1) & (capacity - 1)
+
+
+def _set_seq(buf, increment: int):
+    seq = struct.unpack_from("<Q", buf, _SEQ_OFFSET)[0]
+    struct.pack_into("<Q", buf, _SEQ_OFFSET, seq + increment)
+
+
+def _slot_name(buf, capacity: int, offset: int, length: int) -> Optional[bytes]:
+    if length == _NULL_NAME:
+        return None
+    start = _HEADER.size + capacity * _SLOT.size + offset
+    return bytes(buf[start : start + length])
+
+
+def _entry_hash(key: bytes, name: Optional[bytes]) -> int:
+    return row_hash(str(uuid.UUID(bytes=key)), name.decode() if name else None)
+
+
+def _apply(buf, key: bytes, name: Optional[str], delete: bool):
+    header = list(_HEADER.unpack_from(buf))
+    _, seq, retired, capacity, count, used, heap_size, heap_used, digest = header[:9]
+    target = None
+    for index, (slot_key, _, _, state) in _probe(buf, capacity, key):
+        if state == _USED and slot_key == key:
+            target = index
+            break
+        if state == _DELETED and target is None and not delete:
+            target = index
+        if state == _EMPTY:
+            if target is None and not delete:
+                target = index
+            break
+
+    if delete:
+        if target is not None:
+            _, offset, length, _ = _SLOT.unpack_from(buf, _slot_offset(target))
+            digest ^= _entry_hash(key, _slot_name(buf, capacity, offset, length))
+            struct.pack_into("<B", buf, _slot_offset(target) + _STATE_OFFSET, _DELETED)
+            count -= 1
+    else:
+        if target is None:
+            raise ReplicaFull("No free slot")
+        _, offset, length, state = _SLOT.unpack_from(buf, _slot_offset(target))
+        encoded = name.encode() if name is not None else b""
+        if heap_used + len(encoded) > heap_size:
+            raise ReplicaFull("Name heap exhausted")
+        if state == _EMPTY:
+            if used + 1 > capacity * _MAX_LOAD:
+                raise ReplicaFull("Load factor exceeded")
+            used += 1
+        if state == _USED:
+            digest ^= _entry_hash(key, _slot_name(buf, capacity, offset, length))
+        else:
+            count += 1
+        digest ^= _entry_hash(key, encoded)
+        heap_start = _HEADER.size + capacity * _SLOT.size
+        buf[heap_start + heap_used : heap_start + heap_used + len(encoded)] = encoded
+        _SLOT.pack_into(
+            buf,
+            _slot_offset(target),
+            key,
+            heap_used,
+            _NULL_NAME if name is None else len(encoded),
+            _USED,
+        )
+        heap_used += len(encoded)
+
+    header[1:9] = seq, retired, capacity, count, used, heap_size, heap_used, digest
+    _HEADER.pack_into(buf, 0, *header)
+
+
+class NameReplica:
+    """
+    Memory-mapped hash table of the current ``people`` names.
+
+    The table lives in a file (typically under /dev/shm) mapped by every
+    worker on the host, so lookups are plain memory reads shared by all
+    processes. Readers take no lock: writers bump a sequence counter before and
+    after each change (a seqlock) and readers retry if it moved under them.
+    Writers serialize on an flock on a sidecar ``.lock`` file, and rebuilds
+    on one on a ``.rebuild`` file. A rebuild writes a new file without
+    blocking writers, who log their writes to a ``.journal`` file meanwhile;
+    the journal is then replayed on the new file, which is renamed over the
+    old one, and the old one flagged as retired so that every process
+    reopens it.
+
+    The header keeps a fingerprint of the entries, the XOR of their row
+    hashes, to compare with the range hashes of the database (see
+    check_drift).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._journal_path = f"{path}.journal"
+        self._lock_file = open(f"{path}.lock", "a+b")
+        self._thread_lock = threading.Lock()
+        self._rebuild_lock_file = open(f"{path}.rebuild", "a+b")
+        self._rebuild_thread_lock = threading.Lock()
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+
+    # Mapping
+
+    @staticmethod
+    @contextmanager
+    def _flocked(thread_lock: threading.Lock, lock_file):
+        with thread_lock:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _locked(self):
+        """Serialize writers, across threads and across processes."""
+        return self._flocked(self._thread_lock, self._lock_file)
+
+    def _rebuilding(self):
+        """Serialize rebuilds and drift checks, across threads and processes."""
+        return self._flocked(self._rebuild_thread_lock, self._rebuild_lock_file)
+
+    def _open(self) -> bool:
+        # Maps being replaced are not closed: readers in other threads may
+        # still hold them, and they are released once no longer referenced
+        self._map = self._file = None
+        try:
+            f = open(self.path, "r+b")
+        except FileNotFoundError:
+            return False
+        buf = mmap.mmap(f.fileno(), 0)
+        if _HEADER.unpack_from(buf)[0] != _MAGIC:
+            return False
+        self._file, self._map = f, buf
+        return True
+
+    def _current_map(self) -> Optional[mmap.mmap]:
+        buf = self._map
+        if buf is not None and not _retired(buf):
+            return buf
+        # Follow rebuilds made by this or other processes
+        try:
+            replaced = self._file is None or (
+                os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+            )
+        except FileNotFoundError:
+            return None
+        if replaced and self._open() and not _retired(self._map):
+            return self._map
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = self._file = None
+        self._lock_file.close()
+        self._rebuild_lock_file.close()
+
+    @property
+    def available(self) -> bool:
+        return self._current_map() is not None
+
+    # Lookups
+
+    def lookup(self, person_id) -> Tuple[bool, Optional[str]]:
+        """
+        Look up the current name of a person, without taking any lock.
+
+        Args:
+            person_id (UUID4): The UUID of the person.
+
+        Returns:
+            Tuple[bool, Optional[str]]: Whether the person was found, and their name.
+        """
+        buf = self._current_map()
+        key = _key(person_id)
+        if buf is None or key is None:
+            return False, None
+
+        for _ in range(_READ_RETRIES):
+            seq = struct.unpack_from("<Q", buf, _SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            found, name = False, None
+            capacity = _HEADER.unpack_from(buf)[3]
+            for _, (slot_key, offset, length, state) in _probe(buf, capacity, key):
+                if state == _EMPTY:
+                    break
+                if state == _USED and slot_key == key:
+                    found = True
+                    name = _slot_name(buf, capacity, offset, length)
+                    break
+            if struct.unpack_from("<Q", buf, _SEQ_OFFSET)[0] == seq:
+                return found, name.decode() if name is not None else None
+        return False, None
+
+    # Writes
+
+    def _journal(self, key: bytes, name: Optional[str], delete: bool):
+        """Log a write for the rebuild in progress, if any."""
+        try:
+            fd = os.open(self._journal_path, os.O_WRONLY | os.O_APPEND)
+        except FileNotFoundError:
+            return
+        try:
+            encoded = name.encode() if name is not None else b""
+            length = _NULL_NAME if name is None else len(encoded)
+            os.write(fd, _JOURNAL.pack(key, delete, length) + encoded)
+        finally:
+            os.close(fd)
+
+    def _write(self, key: bytes, name: Optional[str], delete: bool):
+        with self._locked():
+            self._journal(key, name, delete)
+            buf = self._current_map()
+            if buf is None:
+                return
+            _set_seq(buf, +1)
+            try:
+                _apply(buf, key, name, delete)
+            finally:
+                _set_seq(buf, +1)
+
+    def put(self, person_id, name: Optional[str]):
+        """
+        Insert or update the name of a person.
+
+        Args:
+            person_id (UUID4): The UUID of the person.
+            name (Optional[str]): The current name.
+
+        Raises:
+            ReplicaFull: If the table must be rebuilt to make room.
+        """
+        key = _key(person_id)
+        if key is not None:
+            self._write(key, name, delete=False)
+
+    def delete(self, person_id):
+        """
+        Remove a person.
+
+        Args:
+            person_id (UUID4): The UUID of the person.
+        """
+        key = _key(person_id)
+        if key is not None:
+            self._write(key, None, delete=True)
+
+    def retire(self):
+        """
+        Stop serving from the current table until it is rebuilt.
+        """
+        with self._locked():
+            buf = self._current_map()
+            if buf is not None:
+                struct.pack_into("<Q", buf, _RETIRED_OFFSET, 1)
+
+    # Building
+
+    def rebuild(self, db: Session):
+        """
+        Rebuild the table from the database and swap it in.
+
+        The rows are read and the new table built without blocking writers:
+        the writes they publish meanwhile are journaled and replayed on the
+        new table before it is swapped in. The session's transaction is
+        committed first, so that the rows are read after the journal started.
+
+        Args:
+            db (Session): The database session, with nothing pending.
+        """
+        with self._rebuilding():
+            self._rebuild(db)
+
+    def _rebuild(self, db: Session):
+        with self._locked():
+            open(self._journal_path, "wb").close()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            db.commit()
+            self._build(db, tmp_path)
+        finally:
+            with suppress(FileNotFoundError):
+                os.unlink(self._journal_path)
+            with suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+
+    def _build(self, db: Session, tmp_path: str):
+        # Read in the same transaction as the rows, so that they agree
+        db_version = _database_version(db)
+        rows = [
+            (key, name)
+            for key, name in (
+                (_key(person_id), name)
+                for person_id, name in db.query(Person.id, Person.name).yield_per(
+                    10_000
+                )
+            )
+            if key is not None
+        ]
+        db.commit()
+        capacity = _MIN_CAPACITY
+        while capacity * _MAX_LOAD < len(rows) * 1.5:
+            capacity *= 2
+        heap_size = max(
+            _MIN_HEAP, 2 * sum(len(name.encode()) for _, name in rows if name)
+        )
+
+        with open(tmp_path, "w+b") as f:
+            f.truncate(_HEADER.size + capacity * _SLOT.size + heap_size)
+            buf = mmap.mmap(f.fileno(), 0)
+            try:
+                _HEADER.pack_into(
+                    buf, 0, _MAGIC, 0, 0, capacity, 0, 0, heap_size, 0, 0, 0, 0
+                )
+                for key, name in rows:
+                    _apply(buf, key, name, delete=False)
+                # The journaled writes move the database and the table alike
+                base = _version_offset(buf, db_version)
+                struct.pack_into("<Qq", buf, _BASE_OFFSET, *base)
+                with self._locked():
+                    replayed = _replay_journal(buf, self._journal_path)
+                    buf.flush()
+                    # Attach to the table being replaced, if not yet, to retire it
+                    self._current_map()
+                    os.replace(tmp_path, self.path)
+                    os.unlink(self._journal_path)
+                    if self._map is not None:
+                        struct.pack_into("<Q", self._map, _RETIRED_OFFSET, 1)
+            finally:
+                buf.close()
+        self._open()
+        logger.info(
+            "Rebuilt name replica",
+            extra={"people": len(rows), "capacity": capacity, "replayed": replayed},
+        )
+        if base != (0, 0):
+            logger.warning(
+                "Range hashes disagree with the people table, "
+                "run python -m app.reconcile rebuild"
+            )
+
+    def _drift(self, db: Session) -> Optional[Tuple[int, ...]]:
+        """
+        Measure how far the table is from the database, relative to the
+        offset measured at the last rebuild.
+
+        Returns:
+            Optional[Tuple[int, ...]]: The offset, () if they agree, or None
+                if there is no table to compare.
+        """
+        db_version = _database_version(db)
+        db.commit()
+        with self._locked():
+            buf = self._current_map()
+            if buf is None:
+                return None
+            offset = _version_offset(buf, db_version)
+            base = struct.unpack_from("<Qq", buf, _BASE_OFFSET)
+        if not get_settings().range_hashes_enabled:
+            offset, base = offset[1:], base[1:]
+        if offset == base:
+            return ()
+        return tuple(a ^ b for a, b in zip(offset, base))
+
+    def check_drift(self, db: Session) -> bool:
+        """
+        Compare the table with the database, rebuilding it if they differ.
+
+        The table's fingerprint and entry count are compared with the range
+        hashes kept by the write paths (see app.merkle), which are cheap to
+        read and change with every write, renames included, whichever
+        process or host made it. With range hashes disabled, only the row
+        count is compared, so missed renames go unnoticed. The comparison is
+        made relative to the offset measured at the last rebuild, so that
+        range hashes already out of line with the people table (say, not
+        rebuilt since the migration) do not cause a rebuild at every check.
+
+        Writes are published to the table after they are committed, so a
+        single comparison cannot tell a missed write from one about to be
+        published. The database is read again after NAME_REPLICA_RECHECK_DELAY
+        seconds, up to a few times: the table is only rebuilt once the same
+        difference is seen twice, and is left for the next check if writes
+        kept it moving.
+
+        Args:
+            db (Session): The database session, with nothing pending.
+
+        Returns:
+            bool: True if the table had drifted and was rebuilt.
+        """
+        delay = get_settings().name_replica_recheck_delay
+        with self._rebuilding():
+            seen = []
+            for read in range(_DRIFT_READS):
+                if read:
+                    time.sleep(delay)
+                drift = self._drift(db)
+                if drift == ():
+                    return False
+                if drift is None or drift in seen:
+                    break
+                seen.append(drift)
+            else:
+                logger.info("Name replica kept moving away from the database")
+                return False
+            logger.warning(
+                "Name replica drifted from the database, rebuilding",
+                extra={"available": drift is not None},
+            )
+            self._rebuild(db)
+            return True
+
+
+def _replay_journal(buf, path: str) -> int:
+    """
+    Apply the writes journaled during a rebuild to the new table.
+
+    A table left without room is retired, to be rebuilt at the next check.
+
+    Returns:
+        int: The number of writes replayed.
+    """
+    with open(path, "rb") as f:
+        journal = f.read()
+    offset = replayed = 0
+    try:
+        while offset + _JOURNAL.size <= len(journal):
+            key, delete, length = _JOURNAL.unpack_from(journal, offset)
+            offset += _JOURNAL.size
+            name = None
+            if length != _NULL_NAME:
+                name = journal[offset : offset + length].decode()
+                offset += length
+            _apply(buf, key, name, bool(delete))
+            replayed += 1
+    except ReplicaFull:
+        logger.warning("Name replica is full after a rebuild, retiring it")
+        struct.pack_into("<Q", buf, _RETIRED_OFFSET, 1)
+    return replayed
+
+
+def _database_version(db: Session) -> Tuple[int, int]:
+    """
+    Read the XOR of the row hashes of people and their count.
+
+    From the range hashes when they are enabled, otherwise only the count
+    is read (one per shard when people are sharded) and the hash is 0.
+    """
+    if not get_settings().range_hashes_enabled:
+        return 0, sum(count for (count,) in db.query(func.count(Person.id)))
+    digest = count = 0
+    for leaf_digest, leaf_count in read_leaves(db).values():
+        digest ^= leaf_digest
+        count += leaf_count
+    return digest, count
+
+
+def _version_offset(buf, db_version: Tuple[int, int]) -> Tuple[int, int]:
+    """How far the table is from the database version: (hash XOR, count diff)."""
+    header = _HEADER.unpack_from(buf)
+    return header[8] ^ db_version[0], header[4] - db_version[1]
+
+
+def open_name_replica(db: Session) -> Optional[NameReplica]:
+    """
+    Attach to the host's name replica, building it if needed.
+
+    Only the first worker to get there builds the table; the others find it
+    in place and check it against the database.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        Optional[NameReplica]: The replica, or None if it is disabled.
+    """
+    global _replica
+    path = get_settings().name_replica_path
+    if not path:
+        return None
+
+    with _replica_lock:
+        if _replica is None:
+            _replica = NameReplica(path)
+    _replica.check_drift(db)
+    return _replica
+
+
+def get_name_replica() -> Optional[NameReplica]:
+    """
+    Return the name replica if it is enabled and attached.
+
+    Returns:
+        Optional[NameReplica]: The replica, or None.
+    """
+    return _replica
+
+
+def close_name_replica():
+    """
+    Detach from the name replica.
+    """
+    global _replica
+    with _replica_lock:
+        if _replica is not None:
+            _replica.close()
+            _replica = None
+
+
+def refresh_name_replica(db: Session) -> bool:
+    """
+    Rebuild the host's name replica after people were written out of band.
+
+    Command line tools (``python -m app.projection rebuild``, ``python -m
+    app.reconcile``) write to people outside the servers, whose change
+    listeners never see the writes: rebuilding the replica file makes every
+    worker on this host serve the new names at once. Workers on other hosts
+    pick them up at their next drift check.
+
+    Args:
+        db (Session): The database session.
+
+    Returns:
+        bool: True if a replica was rebuilt.
+    """
+    if _replica is not None:
+        _replica.rebuild(db)
+        return True
+    path = get_settings().name_replica_path
+    if not path or not os.path.exists(path):
+        return False
+    replica = NameReplica(path)
+    try:
+        replica.rebuild(db)
+    finally:
+        replica.close()
+    return True
+
+
+def sync_name_replica(changes: Iterable[Tuple[str, Optional[str], bool]]):
+    """
+    Apply committed writes to the name replica, if enabled.
+
+    A full table is retired, so that lookups fall back to the database until
+    the next drift check rebuilds it with more room.
+
+    Args:
+        changes (Iterable[Tuple[str, Optional[str], bool]]): (person id, name,
+            deleted) for each changed person.
+    """
+    replica = _replica
+    if replica is None:
+        return
+    try:
+        for person_id, name, deleted in changes:
+            if deleted:
+                replica.delete(person_id)
+            else:
+                replica.put(person_id, name)
+    except ReplicaFull:
+        logger.warning("Name replica is full, retiring it until rebuilt")
+        replica.retire()
@@ -0,0 +1,176 @@
+import hashlib
+from datetime import timedelta
+from decimal import Decimal
+from typing import Any, Iterable, List, Optional, Sequence
+
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import ORJSONResponse, Response
+
+# Media types accepted by the NL query endpoint
+ROWS_JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.elysian.columnar+json"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+RESULT_MEDIA_TYPES = (ROWS_JSON, COLUMNAR_JSON, ARROW_STREAM)
+
+
+def _default(obj: Any) -> Any:
+    """
+    Serialize the values orjson does not handle natively.
+
+    Mirrors FastAPI's jsonable_encoder for the types MariaDB returns.
+    """
+    if isinstance(obj, Decimal):
+        return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def entity_tag(content: Any) -> str:
+    """
+    Compute a strong ETag for a JSON representation.
+
+    Args:
+        content (Any): The content of the response.
+
+    Returns:
+        str: The quoted ETag.
+    """
+    digest = hashlib.blake2b(
+        orjson.dumps(content, default=_default, option=orjson.OPT_SORT_KEYS),
+        digest_size=12,
+    )
+    return f'"{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etags: Iterable[str]) -> bool:
+    """
+    Tell whether an If-None-Match header matches any of the given ETags.
+
+    Uses the weak comparison RFC 9110 prescribes for If-None-Match.
+
+    Args:
+        if_none_match (Optional[str]): The header value.
+        etags (Iterable[str]): The ETags of the current representation(s).
+
+    Returns:
+        bool: True if the client's copy is current.
+    """
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or not tags.isdisjoint(etags)
+
+
+class FastJSONResponse(ORJSONResponse):
+    """
+    JSON response rendered with orjson.
+
+    datetime, date, time and UUID values are serialized natively; Decimal,
+    timedelta and bytes are converted as FastAPI's default encoder would.
+    Returning this response directly from an endpoint skips response model
+    validation, which is meant for trusted, already well-formed content such
+    as rows fetched from the database.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def negotiate_media_type(accept: Optional[str], supported: Sequence[str]) -> str:
+    """
+    Pick the response media type from an Accept header.
+
+    Args:
+        accept (Optional[str]): The value of the Accept header.
+        supported (Sequence[str]): The supported media types, the first being
+            the default.
+
+    Returns:
+        str: The supported media type with the highest quality value.
+
+    Raises:
+        HTTPException: If none of the supported media types is acceptable.
+    """
+    if not accept:
+        return supported[0]
+
+    candidates = []
+    for position, entry in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, media_type.lower()))
+
+    for _, _, media_type in sorted(candidates):
+        if media_type in ("*/*", "application/*"):
+            return supported[0]
+        if media_type in supported:
+            return media_type
+
+    raise HTTPException(
+        status_code=406,
+        detail=f"Not acceptable, supported media types: {', '.join(supported)}",
+    )
+
+
+def columnar_response(columns: List[str], rows: Sequence[Sequence]) -> Response:
+    """
+    Render a result with each column name once, followed by its values.
+
+    Args:
+        columns (List[str]): The column names.
+        rows (Sequence[Sequence]): The result rows.
+
+    Returns:
+        Response: A ``{"columns": [...], "values": [[...], ...]}`` JSON body,
+            where ``values[i]`` holds the values of ``columns[i]``.
+    """
+    values = [list(column) for column in zip(*rows)] if rows else [[] for _ in columns]
+    return FastJSONResponse(
+        {"columns": columns, "values": values}, media_type=COLUMNAR_JSON
+    )
+
+
+def arrow_response(columns: List[str], rows: Sequence[Sequence]) -> Response:
+    """
+    Render a result as an Arrow IPC stream.
+
+    Args:
+        columns (List[str]): The column names.
+        rows (Sequence[Sequence]): The result rows.
+
+    Returns:
+        Response: A single record batch in the Arrow IPC streaming format.
+
+    Raises:
+        HTTPException: If pyarrow is not installed.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise HTTPException(
+            status_code=406, detail="Arrow output is not available on this server"
+        )
+
+    arrays = [pa.array(column) for column in zip(*rows)] if rows else None
+    if arrays is None:
+        arrays = [pa.array([], type=pa.null()) for _ in columns]
+    batch = pa.RecordBatch.from_arrays(arrays, names=columns)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return Response(sink.getvalue().to_pybytes(), media_type=ARROW_STREAM)
@@ -1,15 +1,125 @@
 import json
+import logging
 import re
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import suppress
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
 
-from openai import OpenAI
 from pydantic import UUID4
-from sqlalchemy import text
+from sqlalchemy import insert, text
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
-from app.models import Person, PersonAdded, PersonRemoved, PersonRenamed
+from app.aggregates import ADDED, REMOVED, RENAMED, record_changes
+from app.config import get_settings
+from app.db import run_with_retries
+from app.log import log_result
+from app.merkle import update_range_hashes
+from app.models import (
+    Person,
+    PersonAdded,
+    PersonEvent,
+    PersonRemoved,
+    PersonRenamed,
+    WebhookPayload,
+)
+from app.replica import sync_name_replica
 
-client = OpenAI()
+logger = logging.getLogger(__name__)
+
+# Marks a person absent from the database while folding webhook events
+_MISSING = object()
+
+# Called with the changes committed to people, see add_change_listener
+ChangeListener = Callable[[List[Tuple[str, Optional[str], bool]]], None]
+_change_listeners: List[ChangeListener] = []
+
+# OpenAI client, built on first use (or at startup) by get_llm_client
+client = None
+
+# Raw LLM answers keyed by natural language query, least recently used first
+_translation_cache: OrderedDict = OrderedDict()
+_translation_cache_lock = threading.Lock()
+
+
+def add_change_listener(listener: ChangeListener):
+    """
+    Register a function to be called with the changes committed to people.
+
+    Args:
+        listener (ChangeListener): Called after each commit with (person id,
+            name, deleted) for each changed person. It runs on the writing
+            thread, so it must not block.
+    """
+    _change_listeners.append(listener)
+
+
+def remove_change_listener(listener: ChangeListener):
+    """
+    Unregister a function registered with add_change_listener.
+
+    Args:
+        listener (ChangeListener): The listener.
+    """
+    with suppress(ValueError):
+        _change_listeners.remove(listener)
+
+
+def publish_changes(changes: List[Tuple[str, Optional[str], bool]]):
+    """
+    Propagate changes committed to people to the name replica and listeners.
+
+    Args:
+        changes (List[Tuple[str, Optional[str], bool]]): (person id, name,
+            deleted) for each changed person.
+    """
+    if not changes:
+        return
+    sync_name_replica(changes)
+    for listener in list(_change_listeners):
+        try:
+            listener(changes)
+        except Exception:
+            logger.exception("Change listener failed")
+
+
+def get_llm_client():
+    """
+    Return the OpenAI client, creating it on first use.
+
+    The openai package is imported here rather than at module import, as it is
+    slow to import and only needed by the NL query endpoint.
+
+    Returns:
+        OpenAI: The OpenAI client.
+    """
+    global client
+    if client is None:
+        from openai import OpenAI
+
+        client = OpenAI(api_key=get_settings().openai_api_key)
+    return client
+
+
+def _record_person_changes(
+    db: Session,
+    events: Dict[str, int],
+    changes: List[Tuple[str, Optional[str], Optional[str]]],
+):
+    """
+    Update the aggregates and range hashes with changes about to be committed.
+
+    Args:
+        db (Session): The database session.
+        events (Dict[str, int]): How many additions, renames and removals
+            made the changes, by payload type.
+        changes (List[Tuple[str, Optional[str], Optional[str]]]): (person id,
+            name before, name after) of each changed person, None standing
+            for a missing person.
+    """
+    record_changes(db, events, changes)
+    update_range_hashes(db, changes)
 
 
 def add_person(db: Session, person_data: PersonAdded):
@@ -23,10 +133,17 @@ def add_person(db: Session, person_data: PersonAdded):
     Returns:
         Person: The newly added person.
     """
-    new_person = Person(id=str(person_data.person_id), name=person_data.name)
-    db.add(new_person)
-    db.commit()
-    db.refresh(new_person)
+
+    def add():
+        new_person = Person(id=str(person_data.person_id), name=person_data.name)
+        db.add(new_person)
+        _record_person_changes(db, {ADDED: 1}, [(new_person.id, None, new_person.name)])
+        db.commit()
+        db.refresh(new_person)
+        return new_person
+
+    new_person = run_with_retries(db, "add_person", add)
+    publish_changes([(new_person.id, new_person.name, False)])
     return new_person
 
 
@@ -34,6 +151,9 @@ def rename_person(db: Session, person_data: PersonRenamed):
     """
     Rename an existing person in the database.
 
+    The update only applies if the person was not changed since it was read,
+    and is otherwise retried on the current row.
+
     Args:
         db (Session): The database session.
         person_data (PersonRenamed): The data of the person to rename.
@@ -41,13 +161,26 @@ def rename_person(db: Session, person_data: PersonRenamed):
     Returns:
         Person: The renamed person, or False if the person was not found.
     """
-    person = db.query(Person).filter(Person.id == str(person_data.person_id)).first()
-    if not person:
-        return False
 
-    person.name = person_data.name
-    db.commit()
-    db.refresh(person)
+    def rename():
+        person = (
+            db.query(Person).filter(Person.id == str(person_data.person_id)).first()
+        )
+        if not person:
+            return False
+        _record_person_changes(
+            db,
+            {RENAMED: int(person.name != person_data.name)},
+            [(person.id, person.name, person_data.name)],
+        )
+        person.name = person_data.name
+        db.commit()
+        db.refresh(person)
+        return person
+
+    person = run_with_retries(db, "rename_person", rename)
+    if person:
+        publish_changes([(person.id, person.name, False)])
     return person
 
 
@@ -55,6 +188,9 @@ def remove_person(db: Session, person_data: PersonRemoved):
     """
     Remove an existing person from the database.
 
+    The delete only applies if the person was not changed since it was read,
+    and is otherwise retried on the current row.
+
     Args:
         db (Session): The database session.
         person_data (PersonRemoved): The data of the person to remove.
@@ -62,13 +198,212 @@ def remove_person(db: Session, person_data: PersonRemoved):
     Returns:
         bool: True if the person was removed successfully, otherwise False.
     """
-    person = db.query(Person).filter(Person.id == str(person_data.person_id)).first()
-    if not person:
-        return False
 
-    db.delete(person)
+    def remove():
+        person = (
+            db.query(Person).filter(Person.id == str(person_data.person_id)).first()
+        )
+        if not person:
+            return False
+        db.delete(person)
+        _record_person_changes(db, {REMOVED: 1}, [(person.id, person.name, None)])
+        db.commit()
+        return True
+
+    removed = run_with_retries(db, "remove_person", remove)
+    if removed:
+        publish_changes([(str(person_data.person_id), None, True)])
+    return removed
+
+
+def fold_person_events(
+    db: Session, events: List[Tuple[str, str, Optional[str]]]
+) -> Tuple[int, List[Tuple[str, Optional[str], bool]]]:
+    """
+    Fold a batch of person events, in order, into the people table.
+
+    The events are folded in memory over the current rows of the people they
+    touch, so that each person costs at most one write however many events
+    the batch holds for them. Folding is idempotent, so that replayed events
+    leave the same state: adding an existing person sets their name, and
+    renaming or removing a missing person is skipped. The aggregates and
+    range hashes are updated along (see app.aggregates and app.merkle), with
+    only the events of people whose row changed counted as additions, renames
+    or removals.
+    Nothing is committed.
+
+    Args:
+        db (Session): The database session.
+        events (List[Tuple[str, str, Optional[str]]]): (payload type, person
+            id, name) of each event, in order.
+
+    Returns:
+        Tuple[int, List[Tuple[str, Optional[str], bool]]]: The number of events
+            applied rather than skipped, and (person id, name, deleted) for
+            each person whose row changed.
+    """
+    person_ids = {person_id for _, person_id, _ in events}
+    existing = {
+        person.id: person
+        for person in db.query(Person).filter(Person.id.in_(person_ids))
+    }
+    # Name of each person after the batch, or _MISSING if they do not exist
+    names = {person_id: person.name for person_id, person in existing.items()}
+
+    applied = 0
+    # Additions, renames and removals each person actually went through
+    transitions: Dict[str, Counter] = defaultdict(Counter)
+    for payload_type, person_id, name in events:
+        current = names.get(person_id, _MISSING)
+        if payload_type == "PersonAdded":
+            if current is _MISSING:
+                transitions[person_id][ADDED] += 1
+            elif current != name:
+                transitions[person_id][RENAMED] += 1
+            names[person_id] = name
+        elif current is _MISSING:
+            logger.info(
+                "Skipping event for unknown person",
+                extra={"payload_type": payload_type, "person_id": person_id},
+            )
+            continue
+        elif payload_type == "PersonRenamed":
+            if current != name:
+                transitions[person_id][RENAMED] += 1
+            names[person_id] = name
+        else:
+            transitions[person_id][REMOVED] += 1
+            names[person_id] = _MISSING
+        applied += 1
+
+    changes = []
+    # (person id, name before, name after), None standing for a missing person
+    row_changes = []
+    for person_id, name in names.items():
+        person = existing.get(person_id)
+        if name is _MISSING:
+            if person is not None:
+                db.delete(person)
+                changes.append((person_id, None, True))
+                row_changes.append((person_id, person.name, None))
+        elif person is None:
+            db.add(Person(id=person_id, name=name))
+            changes.append((person_id, name, False))
+            row_changes.append((person_id, None, name))
+        elif person.name != name:
+            row_changes.append((person_id, person.name, name))
+            person.name = name
+            changes.append((person_id, name, False))
+    # A replayed batch leaves no row changed, so none of its events count
+    counts: Counter = Counter()
+    for person_id, _, _ in row_changes:
+        counts.update(transitions[person_id])
+    _record_person_changes(db, counts, row_changes)
+    return applied, changes
+
+
+def apply_person_events(
+    db: Session,
+    events: List[Tuple[str, str, Optional[str]]],
+    operation: str = "apply_person_events",
+) -> int:
+    """
+    Apply a batch of person events in order, in a single transaction.
+
+    Unlike the single-event functions this is idempotent (see
+    fold_person_events), so that it can be used to replay events.
+
+    Args:
+        db (Session): The database session.
+        events (List[Tuple[str, str, Optional[str]]]): (payload type, person
+            id, name) of each event, in order.
+        operation (str): The name of the write, for the metrics.
+
+    Returns:
+        int: The number of events that were applied rather than skipped.
+    """
+
+    def apply():
+        applied, changes = fold_person_events(db, events)
+        db.commit()
+        return applied, changes
+
+    applied, changes = run_with_retries(db, operation, apply)
+    publish_changes(changes)
+    return applied
+
+
+def apply_webhook_payloads(db: Session, payloads: List[WebhookPayload]) -> int:
+    """
+    Apply a batch of webhook payloads in order, in a single transaction.
+
+    See apply_person_events.
+
+    Args:
+        db (Session): The database session.
+        payloads (List[WebhookPayload]): The payloads, in the order received.
+
+    Returns:
+        int: The number of payloads that were applied rather than skipped.
+    """
+    events = [
+        (
+            payload.payload_type,
+            str(payload.payload_content.person_id),
+            getattr(payload.payload_content, "name", None),
+        )
+        for payload in payloads
+    ]
+    return apply_person_events(db, events, "apply_webhook_payloads")
+
+
+def ingest_webhook_payloads(db: Session, payloads: List[WebhookPayload]) -> int:
+    """
+    Store a batch of webhook payloads according to the storage mode.
+
+    In "event_store" mode the payloads are appended to the event log, to be
+    projected into the people table later; otherwise they are applied to it
+    directly.
+
+    Args:
+        db (Session): The database session.
+        payloads (List[WebhookPayload]): The payloads, in the order received.
+
+    Returns:
+        int: The number of payloads stored or applied.
+    """
+    if get_settings().storage_mode == "event_store":
+        return append_events(db, payloads)
+    return apply_webhook_payloads(db, payloads)
+
+
+def append_events(db: Session, payloads: List[WebhookPayload]) -> int:
+    """
+    Append webhook payloads to the event log with a single bulk insert.
+
+    Args:
+        db (Session): The database session.
+        payloads (List[WebhookPayload]): The payloads, in the order received.
+
+    Returns:
+        int: The number of events appended.
+    """
+    if not payloads:
+        return 0
+    db.execute(
+        insert(PersonEvent),
+        [
+            {
+                "person_id": str(payload.payload_content.person_id),
+                "payload_type": payload.payload_type,
+                "name": getattr(payload.payload_content, "name", None),
+                "event_timestamp": payload.payload_content.timestamp,
+            }
+            for payload in payloads
+        ],
+    )
     db.commit()
-    return True
+    return len(payloads)
 
 
 def get_person(db: Session, person_id: UUID4) -> Person:
@@ -85,41 +420,212 @@ def get_person(db: Session, person_id: UUID4) -> Person:
     return db.query(Person).filter(Person.id == str(person_id)).first()
 
 
+def get_person_name(db: Session, person_id: UUID4) -> Tuple[bool, Optional[str]]:
+    """
+    Look up the name of a person, without loading the whole row as an object.
+
+    Args:
+        db (Session): The database session.
+        person_id (UUID4): The UUID of the person.
+
+    Returns:
+        Tuple[bool, Optional[str]]: Whether the person was found, and their name.
+    """
+    row = db.query(Person.name).filter(Person.id == str(person_id)).first()
+    return (True, row.name) if row is not None else (False, None)
+
+
 def translate_nl_to_sql(nl_query: str) -> dict:
     """
     Translate a natural language query to SQL using OpenAI.
 
+    Answers are kept in a bounded LRU cache, so repeated questions skip the
+    OpenAI round trip. Questions are keyed with their whitespace collapsed
+    but their case kept, as it may belong to a literal ("named McDonald").
+
     Args:
         nl_query (str): The natural language query.
 
     Returns:
-        dict: The SQL information obtained from the query.
+        str: The raw answer of the model, to be parsed by parse_openai_response.
+
+    Raises:
+        ValueError: If the model gave no valid translation.
     """
-    system_message = """
-    Given the following SQL table in MariaDb, your job is to write safe queries given a user's request. \n
-    Ensure that no dangerous operations can be performed on the database (like SQL injection or deletion of records). \n
-        CREATE TABLE people (
-        id VARCHAR(36) PRIMARY KEY,
-        name VARCHAR(255)
-    )
-    WITH SYSTEM VERSIONING
+    cache_key = " ".join(nl_query.split())
+    with _translation_cache_lock:
+        if cache_key in _translation_cache:
+            _translation_cache.move_to_end(cache_key)
+            return _translation_cache[cache_key]
+
+    sql_info = _request_translation(nl_query)
+
+    cache_size = get_settings().translation_cache_size
+    if cache_size > 0:
+        with _translation_cache_lock:
+            _translation_cache[cache_key] = sql_info
+            while len(_translation_cache) > cache_size:
+                _translation_cache.popitem(last=False)
+    return sql_info
+
+
+def preload_translations(nl_queries: List[str]):
     """
-    user_message = f"For the following question, write a valid MariaDB SQL query with placeholders for parameters and provide the parameters separately in JSON: {nl_query}"
+    Translate frequent queries ahead of time to fill the translation cache.
+
+    Failures are logged and skipped, so that an unavailable LLM does not
+    prevent the service from starting.
+
+    Args:
+        nl_queries (List[str]): The natural language queries to translate.
+    """
+    for nl_query in nl_queries:
+        try:
+            translate_nl_to_sql(nl_query)
+        except Exception:
+            logger.warning("Failed to preload translation", exc_info=True)
+
+
+def clear_translation_cache():
+    """
+    Empty the translation cache.
+    """
+    with _translation_cache_lock:
+        _translation_cache.clear()
+
+
+# Kept short: every token of the prompt is paid on each uncached query
+_TRANSLATION_PROMPT = (
+    "Translate the user's question into one read-only MariaDB SELECT on:\n"
+    "people(id VARCHAR(36) PRIMARY KEY, name VARCHAR(255)) WITH SYSTEM VERSIONING\n"
+    "Never modify data. Use :placeholders for every literal value."
+)
+_FENCED_FORMAT = (
+    "\nAnswer with the query in a ```sql block and its parameters as a JSON "
+    "object in a ```json block."
+)
+
+# Strict schemas cannot have free-form objects, so params are a list of pairs
+TRANSLATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "sql_translation",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "query_template": {"type": "string"},
+                "params": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "name": {"type": "string"},
+                            "value": {"type": ["string", "number", "boolean", "null"]},
+                        },
+                        "required": ["name", "value"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["query_template", "params"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def _request_translation(nl_query: str) -> str:
+    """
+    Ask OpenAI to translate a natural language query to SQL.
+
+    An answer that cannot be parsed is sent back to the model once, along
+    with the parsing error, for it to repair.
+
+    Args:
+        nl_query (str): The natural language query.
+
+    Returns:
+        str: The raw answer of the model, known to parse.
+
+    Raises:
+        ValueError: If the model refused, or its repaired answer is still invalid.
+    """
+    settings = get_settings()
+    structured = settings.translation_mode == "structured"
     messages = [
-        {"role": "system", "content": system_message},
-        {"role": "user", "content": user_message},
+        {
+            "role": "system",
+            "content": _TRANSLATION_PROMPT + ("" if structured else _FENCED_FORMAT),
+        },
+        {"role": "user", "content": nl_query},
     ]
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo", messages=messages, temperature=0, max_tokens=256
-    )
-    sql_info = response.choices[0].message.content
-    return sql_info.strip()
+    options = {"response_format": TRANSLATION_RESPONSE_FORMAT} if structured else {}
+
+    for attempt in range(2):
+        response = get_llm_client().chat.completions.create(
+            model=settings.openai_model,
+            messages=messages,
+            temperature=0,
+            max_tokens=settings.translation_max_tokens,
+            **options,
+        )
+        message = response.choices[0].message
+        if not message.content:
+            raise ValueError(
+                f"No translation returned: {getattr(message, 'refusal', None)}"
+            )
+        sql_info = message.content.strip()
+        try:
+            parse_openai_response(sql_info)
+            return sql_info
+        except ValueError as e:
+            if attempt:
+                raise
+            logger.info("Repairing invalid NL query translation: %s", e)
+            messages += [
+                {"role": "assistant", "content": sql_info},
+                {
+                    "role": "user",
+                    "content": f"Invalid answer ({e}). Reply in the required format.",
+                },
+            ]
+
+
+def _parse_structured_response(response: str) -> dict:
+    """
+    Parse a structured-output answer, see TRANSLATION_RESPONSE_FORMAT.
+
+    Args:
+        response (str): The OpenAI response, a JSON document.
+
+    Returns:
+        dict: The SQL template and optionally the parameters.
+
+    Raises:
+        ValueError: If the answer does not match the schema.
+    """
+    answer = json.loads(response)
+    if not isinstance(answer, dict):
+        raise ValueError("Translation is not a JSON object")
+    sql_template = answer.get("query_template")
+    if not isinstance(sql_template, str) or not sql_template.strip():
+        raise ValueError("SQL template not found in response")
+    params = {}
+    for param in answer.get("params") or []:
+        if not isinstance(param, dict) or not isinstance(param.get("name"), str):
+            raise ValueError("Invalid parameter in response")
+        params[param["name"]] = param.get("value")
+    return {"query_template": sql_template.strip(), "params": params or None}
 
 
 def parse_openai_response(response: str) -> dict:
     """
     Parse the response from OpenAI to extract SQL template and parameters.
 
+    Handles both structured-output (JSON) answers and answers with fenced
+    ```sql and ```json blocks.
+
     Args:
         response (str): The OpenAI response.
 
@@ -130,6 +636,8 @@ def parse_openai_response(response: str) -> dict:
         ValueError: If the SQL template or JSON parameters are not found.
     """
     response = response.strip()
+    if response.startswith("{"):
+        return _parse_structured_response(response)
 
     # Extract SQL template
     sql_template_match = re.search(r"```sql\n(.*?)\n```", response, re.DOTALL)
@@ -148,16 +656,16 @@ def parse_openai_response(response: str) -> dict:
     return {"query_template": sql_template, "params": params}
 
 
-def format_and_execute_sql(db: Session, sql_info: dict):
+def execute_sql(db: Session, sql_info: dict) -> Tuple[List[str], List[Sequence]]:
     """
-    Format and execute the provided SQL query.
+    Execute the provided SQL query and return its raw result.
 
     Args:
         db (Session): The database session.
         sql_info (dict): The SQL template and optionally parameters.
 
     Returns:
-        dict: The formatted results to be returned.
+        Tuple[List[str], List[Sequence]]: The column names and the result rows.
 
     Raises:
         SQLAlchemyError: If an SQL execution error occurs.
@@ -167,9 +675,10 @@ def format_and_execute_sql(db: Session, sql_info: dict):
     params = sql_info.get("params")
 
     try:
-        # Print the template and parameters for debugging purposes
-        print(f"Query template: {query_template}")
-        print(f"Parameters: {params}")
+        logger.debug(
+            "Executing NL query",
+            extra={"query_template": query_template, "params": params},
+        )
 
         # Create a text query using SQLAlchemy's text construct
         query = text(query_template)
@@ -180,20 +689,40 @@ def format_and_execute_sql(db: Session, sql_info: dict):
         else:
             result = db.execute(query)
 
-        db.commit()
-
-        # Fetch and format result rows
+        # Fetch result rows before committing, as committing releases the
+        # connection (and with it the cursor) back to the pool
         rows = result.fetchall()
-        columns = result.keys()
-        results = [dict(zip(columns, row)) for row in rows]
-        print(results)
-        if not results:
-            return "No results found."
+        columns = list(result.keys())
+        db.commit()
 
-        return results
+        log_result(logger, rows)
+        return columns, rows
     except SQLAlchemyError as e:
         db.rollback()
         raise e  # Raise SQLAlchemyError to be caught in endpoint
     except Exception as e:
         db.rollback()
         raise e  # Raise Exception to be caught in endpoint
+
+
+def format_and_execute_sql(db: Session, sql_info: dict):
+    """
+    Format and execute the provided SQL query.
+
+    Args:
+        db (Session): The database session.
+        sql_info (dict): The SQL template and optionally parameters.
+
+    Returns:
+        dict: The formatted results to be returned.
+
+    Raises:
+        SQLAlchemyError: If an SQL execution error occurs.
+        Exception: For any other exceptions.
+    """
+    columns, rows = execute_sql(db, sql_info)
+    results = [dict(zip(columns, row)) for row in rows]
+    if not results:
+        return "No results found."
+
+    return results
@@ -0,0 +1,296 @@
+import argparse
+import bisect
+import hashlib
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import (
+    BinaryExpression,
+    BindParameter,
+    BooleanClauseList,
+    TextClause,
+)
+
+from app.models import Person
+
+logger = logging.getLogger(__name__)
+
+# Shard holding every table but people (event log, checkpoints, ...)
+PRIMARY_SHARD = "shard-0"
+
+_PEOPLE_TABLE = re.compile(r"\bpeople\b", re.IGNORECASE)
+# Raw SQL whose per-shard results cannot simply be concatenated
+_CROSS_SHARD_SQL = re.compile(
+    r"\b(?:count|sum|avg|min|max|group_concat|distinct|group\s+by|having"
+    r"|order\s+by|limit|offset|fetch|union|intersect|except)\b",
+    re.IGNORECASE,
+)
+
+
+class ScatterUnsupported(ValueError):
+    """Raised for raw SQL whose results cannot be gathered across shards."""
+
+
+def shard_names(count: int) -> List[str]:
+    """
+    Name the shards of a database list.
+
+    Shards are named after their position, so that appending a database to
+    the list keeps the names, and hence the ring points, of the others.
+
+    Args:
+        count (int): The number of databases.
+
+    Returns:
+        List[str]: The shard names.
+    """
+    return [f"shard-{index}" for index in range(count)]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping person ids to shards.
+
+    Each shard owns `virtual_nodes` points on the ring, and a key belongs to
+    the shard owning the first point at or after the key's hash. Adding a
+    shard thus only moves the keys falling just before its points, about
+    1/N of them, instead of rehashing everything.
+    """
+
+    def __init__(self, shards: Sequence[str], virtual_nodes: int = 100):
+        if not shards:
+            raise ValueError("A hash ring needs at least one shard")
+        points = sorted(
+            (_hash(f"{shard}#{vnode}"), shard)
+            for shard in shards
+            for vnode in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+        self.shards = list(shards)
+
+    def shard_for(self, key) -> str:
+        """
+        Find the shard owning a key.
+
+        Args:
+            key: The key, typically a person id.
+
+        Returns:
+            str: The name of the shard.
+        """
+        index = bisect.bisect_left(self._hashes, _hash(str(key)))
+        return self._shards[index % len(self._shards)]
+
+    def shards_for(self, keys: Iterable) -> List[str]:
+        """
+        Find the shards owning any of the keys.
+
+        Args:
+            keys (Iterable): The keys.
+
+        Returns:
+            List[str]: The names of the shards, in ring order.
+        """
+        owners = {self.shard_for(key) for key in keys}
+        return [shard for shard in self.shards if shard in owners]
+
+
+def _person_ids(statement) -> Optional[List[str]]:
+    """
+    Extract the person ids a statement is restricted to.
+
+    Only criteria every row must meet are considered: the where clause
+    itself, or one of the terms of a top-level AND. A comparison nested
+    under an OR (``id = :a OR name = :b``) or a NOT does not restrict the
+    rows to any shard.
+
+    Args:
+        statement: The statement about to be executed.
+
+    Returns:
+        Optional[List[str]]: The ids compared to people.id with = or IN, or
+            None if the statement is not restricted by id.
+    """
+    whereclause = getattr(statement, "whereclause", None)
+    if whereclause is None:
+        return None
+    criteria = [whereclause]
+    if (
+        isinstance(whereclause, BooleanClauseList)
+        and whereclause.operator is operators.and_
+    ):
+        criteria = list(whereclause.clauses)
+    id_column = Person.__table__.c.id
+    for element in criteria:
+        # ORM queries compare annotated copies of the column
+        if (
+            isinstance(element, BinaryExpression)
+            and id_column.shares_lineage(element.left)
+            and isinstance(element.right, BindParameter)
+            and element.operator in (operators.eq, operators.in_op)
+        ):
+            value = element.right.effective_value
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            # Only narrow on the first such criterion, as in a plain lookup
+            return [str(v) for v in values]
+    return None
+
+
+def make_sharded_sessionmaker(
+    engines: Dict[str, Engine], ring: HashRing, **kwargs
+) -> sessionmaker:
+    """
+    Build a session factory routing people rows to their shard.
+
+    Writes of a person go to the shard owning their id. Queries on people
+    restricted by id (``id = ...`` or ``id IN (...)``) only hit the owning
+    shards; any other query on people, including raw SQL such as the NL
+    queries, is scattered to every shard and the results concatenated. As
+    concatenating is only right for plain row selections, raw SQL mentioning
+    people and using aggregates, DISTINCT, GROUP BY, ORDER BY, LIMIT or set
+    operations raises ScatterUnsupported rather than return per-shard
+    answers. Raw SQL not mentioning people, like all other tables, goes to
+    the primary shard.
+
+    Args:
+        engines (Dict[str, Engine]): The engine of each shard.
+        ring (HashRing): The ring assigning person ids to shards.
+        **kwargs: Further options for the sessions.
+
+    Returns:
+        sessionmaker: The session factory.
+    """
+    person_mapper = Person.__mapper__
+
+    def shard_chooser(mapper, instance, clause=None):
+        if mapper is person_mapper and instance is not None:
+            return ring.shard_for(instance.id)
+        return PRIMARY_SHARD
+
+    def id_chooser(query, ident):
+        if query.column_descriptions[0]["entity"] is Person:
+            return [ring.shard_for(ident[0])]
+        return [PRIMARY_SHARD]
+
+    def execute_chooser(orm_context):
+        mapper = orm_context.bind_mapper
+        if mapper is not None and mapper is not person_mapper:
+            return [PRIMARY_SHARD]
+        statement = orm_context.statement
+        if mapper is person_mapper:
+            ids = _person_ids(statement)
+            if ids is not None:
+                return ring.shards_for(ids) or [ring.shard_for(ids[0])]
+        elif isinstance(statement, TextClause) and len(ring.shards) > 1:
+            if not _PEOPLE_TABLE.search(statement.text):
+                return [PRIMARY_SHARD]
+            if _CROSS_SHARD_SQL.search(statement.text):
+                raise ScatterUnsupported(
+                    "Aggregating, sorting or limiting people is not supported "
+                    "across shards"
+                )
+        return ring.shards
+
+    return sessionmaker(
+        class_=ShardedSession,
+        shards=engines,
+        shard_chooser=shard_chooser,
+        id_chooser=id_chooser,
+        execute_chooser=execute_chooser,
+        # Commit the shards of a transaction together (XA on MariaDB)
+        twophase=not any(
+            engine.dialect.name == "sqlite" for engine in engines.values()
+        ),
+        **kwargs,
+    )
+
+
+def reshard(
+    old_engines: Dict[str, Engine],
+    new_engines: Dict[str, Engine],
+    virtual_nodes: int = 100,
+    batch_size: int = 1000,
+) -> int:
+    """
+    Move the people rows whose owning shard changed between two layouts.
+
+    Rows are copied to their new shard (updating any copy already there)
+    before being deleted from the old one, so that an interrupted run can be
+    restarted. Writes should be paused while it runs.
+
+    Args:
+        old_engines (Dict[str, Engine]): The engine of each current shard.
+        new_engines (Dict[str, Engine]): The engine of each shard of the new
+            layout, which may share databases with the current one.
+        virtual_nodes (int): The virtual nodes per shard of both rings.
+        batch_size (int): How many rows to move per transaction.
+
+    Returns:
+        int: The number of rows moved.
+    """
+    new_ring = HashRing(list(new_engines), virtual_nodes)
+    table = Person.__table__
+    moved = 0
+    for old_shard, old_engine in old_engines.items():
+        # Rows whose new shard is the database they are already in stay put
+        with old_engine.connect() as source:
+            rows = [
+                row
+                for row in source.execute(table.select())
+                if str(new_engines[new_ring.shard_for(row.id)].url)
+                != str(old_engine.url)
+            ]
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start : start + batch_size]
+            by_target: Dict[str, list] = {}
+            for row in batch:
+                by_target.setdefault(new_ring.shard_for(row.id), []).append(row)
+            for target, target_rows in by_target.items():
+                with new_engines[target].begin() as destination:
+                    ids = [row.id for row in target_rows]
+                    destination.execute(table.delete().where(table.c.id.in_(ids)))
+                    destination.execute(
+                        table.insert(), [dict(row._mapping) for row in target_rows]
+                    )
+            with old_engine.begin() as source:
+                source.execute(
+                    table.delete().where(table.c.id.in_([row.id for row in batch]))
+                )
+            moved += len(batch)
+        logger.info("Resharded %s", old_shard, extra={"moved": moved})
+    return moved
+
+
+if __name__ == "__main__":
+    from app.db import engine_factory
+
+    parser = argparse.ArgumentParser(
+        description="Move people rows between shard layouts."
+    )
+    parser.add_argument(
+        "--from", dest="old", required=True, nargs="+", help="Current shard URLs"
+    )
+    parser.add_argument(
+        "--to", dest="new", required=True, nargs="+", help="New shard URLs"
+    )
+    parser.add_argument("--virtual-nodes", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    def engines(urls):
+        return dict(zip(shard_names(len(urls)), map(engine_factory, urls)))
+
+    count = reshard(
+        engines(args.old), engines(args.new), args.virtual_nodes, args.batch_size
+    )
+    print(f"Moved {count} people")
@@ -0,0 +1,450 @@
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Callable, List, Optional, Tuple
+
+from app import metrics
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+# Each record is framed as: payload length, CRC32 of the payload, payload.
+# Records are never empty, so that zeroed bytes are not taken for records.
+_FRAME = struct.Struct("<II")
+_SEGMENT_SUFFIX = ".seg"
+_MAX_BACKOFF = 30.0
+# Bytes scanned at a time when looking for the record following a corrupt one
+_RESYNC_CHUNK = 64 * 1024
+
+metrics.describe(
+    "webhook_spool_skipped_bytes_total",
+    "Corrupt bytes of the webhook spool skipped by the replayer.",
+)
+
+_spool: Optional["WebhookSpool"] = None
+
+
+def _segment_name(number: int) -> str:
+    return f"{number:012d}{_SEGMENT_SUFFIX}"
+
+
+def _read_frame(f, offset: int) -> Optional[bytes]:
+    """Read the record framed at `offset`, or None if there is no valid one."""
+    f.seek(offset)
+    frame = f.read(_FRAME.size)
+    if len(frame) < _FRAME.size:
+        return None
+    length, crc = _FRAME.unpack(frame)
+    payload = f.read(length) if length else b""
+    if not payload or len(payload) < length or zlib.crc32(payload) != crc:
+        return None
+    return payload
+
+
+def _next_frame(f, offset: int) -> Optional[int]:
+    """
+    Find the next valid record after the invalid bytes at `offset`.
+
+    Scans forward for a frame header whose length fits in the segment and
+    whose CRC matches the payload that follows.
+
+    Args:
+        f: The segment file, opened for binary reading.
+        offset (int): Where the invalid bytes start.
+
+    Returns:
+        Optional[int]: The offset of the next valid record, or None if none
+            follows (yet).
+    """
+    size = os.fstat(f.fileno()).st_size
+    start = offset + 1
+    while start + _FRAME.size <= size:
+        f.seek(start)
+        chunk = f.read(_RESYNC_CHUNK + _FRAME.size)
+        for i in range(min(_RESYNC_CHUNK, len(chunk) - _FRAME.size + 1)):
+            length, _ = _FRAME.unpack_from(chunk, i)
+            if length and start + i + _FRAME.size + length <= size:
+                if _read_frame(f, start + i) is not None:
+                    return start + i
+        start += _RESYNC_CHUNK
+    return None
+
+
+def _read_records(f, offset: int, limit: int) -> Tuple[List[bytes], int, int]:
+    """
+    Read up to `limit` complete records from a segment.
+
+    Corrupt bytes in between records are skipped, resynchronising on the next
+    valid record (see _next_frame). Reading stops at the end of the valid
+    records, before a record still being written or a torn one.
+
+    Args:
+        f: The segment file, opened for binary reading.
+        offset (int): Where to start reading.
+        limit (int): The maximum number of records to read.
+
+    Returns:
+        Tuple[List[bytes], int, int]: The records, the offset following the
+            last one, and the number of corrupt bytes skipped.
+    """
+    records = []
+    skipped = 0
+    while len(records) < limit:
+        payload = _read_frame(f, offset)
+        if payload is None:
+            next_offset = _next_frame(f, offset)
+            if next_offset is None:
+                break
+            skipped += next_offset - offset
+            offset = next_offset
+            continue
+        records.append(payload)
+        offset += _FRAME.size + len(payload)
+    return records, offset, skipped
+
+
+class _FileLock:
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+
+
+class WebhookSpool:
+    """
+    Durable, segmented append-only log of accepted webhook payloads.
+
+    Appends from every worker on the host go to the same directory, serialized
+    by an flock, so events are replayed in the order they were acknowledged.
+    An append returns once its record is on disk: a flusher thread fsyncs
+    whatever was written since its last pass, so that concurrent appends share
+    one fsync (group commit). Segments are rotated once they reach the
+    configured size.
+
+    One worker at a time (whichever holds ``replayer.lock``) replays the log
+    into the database in order, records its position in a checkpoint file and
+    deletes the segments it has fully applied. After a crash, replay resumes
+    from the last checkpoint, so events may be applied twice and must be
+    applied idempotently.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_max_bytes: int,
+        fsync_interval: float,
+        batch_size: int,
+    ):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        os.makedirs(directory, exist_ok=True)
+
+        self._append_lock_file = open(self._path("append.lock"), "a+b")
+        self._replayer_lock_file = open(self._path("replayer.lock"), "a+b")
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._appended = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+        # Segment this process appends to, and append/fsync tickets
+        self._segment: Optional[int] = None
+        self._fd: Optional[int] = None
+        self._written = 0
+        self._flushed = 0
+
+        with self._append_locked():
+            self._recover()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _segments(self) -> List[int]:
+        return sorted(
+            int(name[: -len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(_SEGMENT_SUFFIX)
+        )
+
+    def _append_locked(self):
+        return _FileLock(self._append_lock_file)
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # Appending
+
+    def _recover(self):
+        """
+        Drop a torn record left at the end of the log by a crash.
+
+        Only the bytes following the last valid record are dropped: corrupt
+        records in between valid ones are left for the replayer to skip, so
+        that no record appended after them is lost.
+        """
+        segments = self._segments()
+        if not segments:
+            return
+        path = self._path(_segment_name(segments[-1]))
+        with open(path, "rb") as f:
+            offset = 0
+            while True:
+                records, offset, _ = _read_records(f, offset, 10_000)
+                if not records:
+                    break
+        if offset < os.path.getsize(path):
+            logger.warning(
+                "Truncating torn record at the end of the webhook spool",
+                extra={"segment": path, "offset": offset},
+            )
+            os.truncate(path, offset)
+
+    def _switch_segment(self, number: int, create: bool):
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+        flags = os.O_WRONLY | os.O_APPEND | (os.O_CREAT if create else 0)
+        self._fd = os.open(self._path(_segment_name(number)), flags, 0o644)
+        self._segment = number
+        if create:
+            self._fsync_directory()
+
+    def _current_segment(self):
+        """
+        Move to the newest segment, rotating it if it is full.
+
+        Other workers rotate segments too, and the replayer deletes those it
+        has applied, so the segment this process last appended to may be far
+        behind or gone: the newest segment is looked up again at every append
+        (under the append lock), and a segment is never created behind an
+        existing one or the checkpoint, where it would not be replayed.
+        """
+        segments = self._segments()
+        newest = segments[-1] if segments else self._read_checkpoint()[0]
+        if self._segment != newest:
+            self._switch_segment(newest, create=True)
+        if os.fstat(self._fd).st_size >= self.segment_max_bytes:
+            self._switch_segment(newest + 1, create=True)
+
+    def append(self, payload: bytes):
+        """
+        Append a record and wait until it is durable.
+
+        Args:
+            payload (bytes): The record to append.
+        """
+        record = _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            with self._append_locked():
+                self._current_segment()
+                os.write(self._fd, record)
+            self._written += 1
+            ticket = self._written
+            self._synced.notify_all()
+            while self._flushed < ticket:
+                self._synced.wait()
+        self._appended.set()
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while self._flushed == self._written:
+                    if self._stopping.is_set():
+                        return
+                    self._synced.wait()
+            # Let concurrent appends join this fsync
+            self._stopping.wait(self.fsync_interval)
+            with self._lock:
+                ticket = self._written
+                fd = os.dup(self._fd)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self._lock:
+                self._flushed = max(self._flushed, ticket)
+                self._synced.notify_all()
+
+    # Replaying
+
+    def _read_checkpoint(self) -> Tuple[int, int]:
+        try:
+            with open(self._path("checkpoint")) as f:
+                checkpoint = json.load(f)
+            return checkpoint["segment"], checkpoint["offset"]
+        except FileNotFoundError:
+            segments = self._segments()
+            return (segments[0] if segments else 1), 0
+
+    def _write_checkpoint(self, segment: int, offset: int):
+        tmp_path = self._path("checkpoint.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path("checkpoint"))
+
+    def _replay_loop(self, apply_batch: Callable[[List[bytes]], None]):
+        # Only one worker on the host replays; the others stand by
+        while not self._stopping.is_set():
+            try:
+                fcntl.flock(self._replayer_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._stopping.wait(1.0)
+                continue
+            try:
+                self._replay(apply_batch)
+            finally:
+                fcntl.flock(self._replayer_lock_file, fcntl.LOCK_UN)
+
+    def _skip_corrupt(self, segment: int, offset: int, skipped: int):
+        if skipped > 0:
+            logger.error(
+                "Skipping corrupt bytes in the webhook spool",
+                extra={"segment": segment, "offset": offset, "bytes": skipped},
+            )
+            metrics.inc("webhook_spool_skipped_bytes_total", skipped)
+
+    def _replay(self, apply_batch: Callable[[List[bytes]], None]):
+        segment, offset = self._read_checkpoint()
+        backoff = self.fsync_interval or 0.01
+        while not self._stopping.is_set():
+            # Whether a newer segment exists must be known before reading, so
+            # that reaching the end of this one means it is complete
+            has_next = os.path.exists(self._path(_segment_name(segment + 1)))
+            try:
+                with open(self._path(_segment_name(segment)), "rb") as f:
+                    records, next_offset, skipped = _read_records(
+                        f, offset, self.batch_size
+                    )
+                    size = os.fstat(f.fileno()).st_size
+            except FileNotFoundError:
+                records, next_offset, skipped, size = [], offset, 0, offset
+
+            if records:
+                try:
+                    apply_batch(records)
+                except Exception:
+                    logger.exception(
+                        "Failed to apply spooled webhooks, retrying",
+                        extra={"retry_in": backoff},
+                    )
+                    self._stopping.wait(backoff)
+                    backoff = min(backoff * 2, _MAX_BACKOFF)
+                    continue
+                backoff = self.fsync_interval or 0.01
+                self._skip_corrupt(segment, offset, skipped)
+                offset = next_offset
+                self._write_checkpoint(segment, offset)
+                continue
+
+            if has_next:
+                # Nothing valid follows in this complete segment
+                self._skip_corrupt(segment, offset, size - offset)
+                segment, offset = segment + 1, 0
+                self._write_checkpoint(segment, offset)
+                for number in self._segments():
+                    if number < segment:
+                        os.remove(self._path(_segment_name(number)))
+                continue
+
+            self._appended.wait(0.5)
+            self._appended.clear()
+
+    # Lifecycle
+
+    def start(self, apply_batch: Callable[[List[bytes]], None]):
+        """
+        Start the flusher and replayer threads.
+
+        Args:
+            apply_batch (Callable[[List[bytes]], None]): Applies records, in
+                order, to the database. Raising makes the batch be retried.
+        """
+        self._threads = [
+            threading.Thread(target=self._flush_loop, name="spool-flusher"),
+            threading.Thread(
+                target=self._replay_loop, args=(apply_batch,), name="spool-replayer"
+            ),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """
+        Stop the background threads and close the spool.
+        """
+        self._stopping.set()
+        with self._lock:
+            self._synced.notify_all()
+        self._appended.set()
+        for thread in self._threads:
+            thread.join()
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        self._append_lock_file.close()
+        self._replayer_lock_file.close()
+
+
+def open_webhook_spool(
+    apply_batch: Callable[[List[bytes]], None],
+) -> Optional[WebhookSpool]:
+    """
+    Open the webhook spool and start replaying it, if enabled.
+
+    Args:
+        apply_batch (Callable[[List[bytes]], None]): Applies records to the
+            database.
+
+    Returns:
+        Optional[WebhookSpool]: The spool, or None if it is disabled.
+    """
+    global _spool
+    settings = get_settings()
+    if not settings.webhook_spool_dir:
+        return None
+    _spool = WebhookSpool(
+        settings.webhook_spool_dir,
+        settings.webhook_spool_segment_bytes,
+        settings.webhook_spool_fsync_interval,
+        settings.webhook_spool_batch_size,
+    )
+    _spool.start(apply_batch)
+    return _spool
+
+
+def get_webhook_spool() -> Optional[WebhookSpool]:
+    """
+    Return the webhook spool if it is enabled.
+
+    Returns:
+        Optional[WebhookSpool]: The spool, or None.
+    """
+    return _spool
+
+
+def close_webhook_spool():
+    """
+    Stop the webhook spool.
+    """
+    global _spool
+    if _spool is not None:
+        _spool.stop()
+        _spool = None
@@ -0,0 +1,161 @@
+import gzip
+import hashlib
+import mimetypes
+import threading
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+from fastapi import Request, Response
+
+from app.config import get_settings
+from app.responses import etag_matches
+
+DEFAULT_FRONTEND_DIR = Path(__file__).resolve().parent.parent / "frontend"
+
+# Compressed variants are only kept when they save at least this fraction
+_MIN_COMPRESSION_GAIN = 0.1
+
+_assets: Optional["StaticAssets"] = None
+_assets_lock = threading.Lock()
+
+
+class StaticAsset(NamedTuple):
+    media_type: str
+    # Body and ETag of each representation, keyed by content coding
+    variants: Dict[str, bytes]
+    etags: Dict[str, str]
+
+
+def _compress(content: bytes) -> Dict[str, bytes]:
+    """
+    Compute the compressed variants of a file worth serving.
+
+    Args:
+        content (bytes): The file content.
+
+    Returns:
+        Dict[str, bytes]: The compressed bodies keyed by content coding.
+    """
+    variants = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+
+        variants["br"] = brotli.compress(content, quality=11)
+    except ImportError:
+        pass
+    return {
+        coding: body
+        for coding, body in variants.items()
+        if len(body) <= len(content) * (1 - _MIN_COMPRESSION_GAIN)
+    }
+
+
+def _accepted_codings(accept_encoding: Optional[str]) -> Dict[str, float]:
+    """
+    Parse an Accept-Encoding header.
+
+    Args:
+        accept_encoding (Optional[str]): The header value.
+
+    Returns:
+        Dict[str, float]: The quality value of each listed coding.
+    """
+    codings = {}
+    for entry in (accept_encoding or "").split(","):
+        coding, *params = [part.strip() for part in entry.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding.lower()] = quality
+    return codings
+
+
+class StaticAssets:
+    """
+    Frontend files held in memory, with precomputed compressed variants.
+
+    Every file under the frontend directory is read once, hashed for a strong
+    ETag and compressed with gzip (and brotli, when installed), so that
+    serving it costs neither disk I/O nor compression time.
+    """
+
+    def __init__(self, directory: Path):
+        self.assets: Dict[str, StaticAsset] = {}
+        for path in sorted(directory.rglob("*")):
+            if path.is_file():
+                self.assets[path.relative_to(directory).as_posix()] = self._load(path)
+
+    @staticmethod
+    def _load(path: Path) -> StaticAsset:
+        content = path.read_bytes()
+        media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type == "application/javascript":
+            media_type += "; charset=utf-8"
+
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        variants = {"identity": content, **_compress(content)}
+        etags = {
+            coding: f'"{digest}"' if coding == "identity" else f'"{digest}-{coding}"'
+            for coding in variants
+        }
+        return StaticAsset(media_type, variants, etags)
+
+    def response(self, request: Request, name: str) -> Response:
+        """
+        Serve an asset, honouring Accept-Encoding and If-None-Match.
+
+        Args:
+            request (Request): The incoming request.
+            name (str): The path of the asset, relative to the frontend directory.
+
+        Returns:
+            Response: The asset, a 304 if the client's copy is current, or a 404.
+        """
+        asset = self.assets.get(name)
+        if asset is None:
+            return Response(status_code=404)
+
+        accepted = _accepted_codings(request.headers.get("accept-encoding"))
+        coding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and accepted.get(candidate, 0) > 0:
+                coding = candidate
+                break
+
+        headers = {
+            "ETag": asset.etags[coding],
+            "Cache-Control": get_settings().static_cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request.headers.get("if-none-match"), asset.etags.values()):
+            return Response(status_code=304, headers=headers)
+
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+        return Response(
+            asset.variants[coding], media_type=asset.media_type, headers=headers
+        )
+
+
+def load_static_assets() -> StaticAssets:
+    """
+    Load the frontend assets into memory, if not done already.
+
+    Returns:
+        StaticAssets: The loaded assets.
+    """
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            directory = get_settings().frontend_dir
+            _assets = StaticAssets(
+                Path(directory) if directory else DEFAULT_FRONTEND_DIR
+            )
+    return _assets
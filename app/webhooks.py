@@ -0,0 +1,104 @@
+import zlib
+from typing import Optional
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+
+from app.config import get_settings
+from app.models import WebhookPayload, webhook_payload_adapter
+
+JSON_MEDIA_TYPES = ("application/json",)
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def _decompress(body: bytes, content_encoding: Optional[str]) -> bytes:
+    """
+    Undo the Content-Encoding of a webhook body.
+
+    Args:
+        body (bytes): The raw request body.
+        content_encoding (Optional[str]): The Content-Encoding header.
+
+    Returns:
+        bytes: The decoded body.
+
+    Raises:
+        HTTPException: If the encoding is unsupported, the body is corrupt or
+            it inflates past the configured limit.
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return body
+    if encoding not in ("gzip", "x-gzip"):
+        raise HTTPException(status_code=415, detail="Unsupported content encoding")
+
+    max_size = get_settings().webhook_max_body_bytes
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        decoded = decompressor.decompress(body, max_size + 1)
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Invalid input")
+    if len(decoded) > max_size or decompressor.unconsumed_tail:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    return decoded
+
+
+def decode_webhook_payload(
+    body: bytes, content_type: Optional[str], content_encoding: Optional[str]
+) -> WebhookPayload:
+    """
+    Decode and validate a webhook body in a single pass.
+
+    JSON bodies are validated straight from bytes; MessagePack bodies are
+    unpacked (with the optional msgpack package) and validated from the
+    resulting objects. Either may be gzip-compressed.
+
+    Args:
+        body (bytes): The raw request body.
+        content_type (Optional[str]): The Content-Type header.
+        content_encoding (Optional[str]): The Content-Encoding header.
+
+    Returns:
+        WebhookPayload: The typed payload.
+
+    Raises:
+        HTTPException: If the body cannot be decoded or is invalid.
+    """
+    if len(body) > get_settings().webhook_max_body_bytes:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    body = _decompress(body, content_encoding)
+    media_type = (content_type or JSON_MEDIA_TYPES[0]).split(";")[0].strip().lower()
+
+    try:
+        if media_type in JSON_MEDIA_TYPES:
+            return webhook_payload_adapter.validate_json(body)
+        if media_type in MSGPACK_MEDIA_TYPES:
+            try:
+                import msgpack
+            except ImportError:
+                raise HTTPException(
+                    status_code=415, detail="MessagePack is not supported"
+                )
+            return webhook_payload_adapter.validate_python(
+                msgpack.unpackb(body, timestamp=3)
+            )
+    except (ValidationError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid input")
+    raise HTTPException(status_code=415, detail="Unsupported media type")
+
+
+async def webhook_payload(request: Request) -> WebhookPayload:
+    """
+    Dependency reading the webhook payload from the request body.
+
+    Args:
+        request (Request): The incoming request.
+
+    Returns:
+        WebhookPayload: The typed payload.
+    """
+    return decode_webhook_payload(
+        await request.body(),
+        request.headers.get("content-type"),
+        request.headers.get("content-encoding"),
+    )
@@ -0,0 +1,308 @@
+"""
+Replay recorded NL query traffic through the non-LLM pipeline.
+
+Reads a recording made with ``NL_RECORD_PATH`` (see app.recorder) and runs
+every query again, offline: ``translate_nl_to_sql`` gets the recorded LLM
+answers from a stubbed OpenAI client, then ``parse_openai_response`` and
+``format_and_execute_sql`` run against a local database (a temporary SQLite
+database unless ``--database-url`` points at, say, a copy of production).
+Queries answered from the aggregates go through ``answer_from_aggregates``.
+Throughput and latencies are reported per stage, in the format of
+benchmarks/run.py, so that runs can be compared and regressions flagged:
+
+    python -m benchmarks.replay nl.jsonl --people 10000 --output baseline.json
+    python -m benchmarks.replay nl.jsonl --people 10000 --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from unittest.mock import MagicMock, patch
+
+from benchmarks.run import compare_results, git_commit, seed_people, summarize
+
+STAGES = ("aggregates", "translate", "parse", "execute", "total")
+
+
+def load_recording(path: str) -> List[Dict]:
+    """
+    Read the replayable records of a recording.
+
+    Records without an LLM answer (translation failures) cannot be replayed
+    and are skipped, as are unreadable lines.
+
+    Args:
+        path (str): The JSON Lines recording.
+
+    Returns:
+        List[Dict]: The records, in recording order.
+    """
+    records = []
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(record, dict) or not record.get("question"):
+                continue
+            if record.get("source") == "aggregates" or record.get("raw_response"):
+                records.append(record)
+    return records
+
+
+def recorded_client(records: List[Dict]) -> MagicMock:
+    """
+    Build an OpenAI client stub answering each question as recorded.
+
+    Args:
+        records (List[Dict]): The records.
+
+    Returns:
+        MagicMock: The client stub; unknown questions get an empty answer.
+    """
+    answers = {
+        record["question"]: record["raw_response"]
+        for record in records
+        if record.get("raw_response")
+    }
+
+    def create(messages, **kwargs):
+        response = MagicMock()
+        response.choices = [MagicMock()]
+        response.choices[0].message = MagicMock(
+            content=answers.get(messages[-1]["content"]), refusal=None
+        )
+        return response
+
+    client = MagicMock()
+    client.chat.completions.create.side_effect = create
+    return client
+
+
+def replay(
+    records: List[Dict], session_factory, repeat: int = 1, cold_cache: bool = False
+) -> Dict[str, Dict]:
+    """
+    Run the records through the pipeline and time each stage.
+
+    A record failing at a stage is counted as an error of that stage and of
+    the total, and skips its later stages.
+
+    Args:
+        records (List[Dict]): The records.
+        session_factory: A sessionmaker bound to the database to query.
+        repeat (int): How many times to replay the whole recording.
+        cold_cache (bool): Empty the translation cache before each query, so
+            that every translation goes through the (stubbed) LLM client.
+
+    Returns:
+        Dict[str, Dict]: The summary produced by ``summarize`` for each stage
+            any record went through.
+    """
+    from app.aggregates import answer_from_aggregates
+    from app.services import (
+        clear_translation_cache,
+        format_and_execute_sql,
+        parse_openai_response,
+        translate_nl_to_sql,
+    )
+
+    latencies: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    errors = dict.fromkeys(STAGES, 0)
+
+    def timed(stage, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        except Exception:
+            errors[stage] += 1
+            raise
+        finally:
+            latencies[stage].append(time.perf_counter() - started)
+
+    clear_translation_cache()
+    db = session_factory()
+    started = time.perf_counter()
+    try:
+        with patch("app.services.client", recorded_client(records)):
+            for _ in range(repeat):
+                for record in records:
+                    if cold_cache:
+                        clear_translation_cache()
+                    query_started = time.perf_counter()
+                    try:
+                        if record.get("source") == "aggregates":
+                            timed(
+                                "aggregates",
+                                answer_from_aggregates,
+                                db,
+                                record["question"],
+                            )
+                        else:
+                            raw = timed(
+                                "translate", translate_nl_to_sql, record["question"]
+                            )
+                            sql_info = timed("parse", parse_openai_response, raw)
+                            timed("execute", format_and_execute_sql, db, sql_info)
+                    except Exception:
+                        errors["total"] += 1
+                        db.rollback()
+                    latencies["total"].append(time.perf_counter() - query_started)
+    finally:
+        db.close()
+        clear_translation_cache()
+    elapsed = time.perf_counter() - started
+
+    return {
+        stage: summarize(latencies[stage], errors[stage], elapsed)
+        for stage in STAGES
+        if latencies[stage]
+    }
+
+
+def recorded_timings(records: List[Dict]) -> Dict[str, Dict]:
+    """
+    Summarize the stage latencies measured when the traffic was recorded.
+
+    Args:
+        records (List[Dict]): The records.
+
+    Returns:
+        Dict[str, Dict]: The summary produced by ``summarize`` for each stage,
+            without throughput.
+    """
+    latencies: Dict[str, List[float]] = {}
+    for record in records:
+        for stage, ms in (record.get("timings_ms") or {}).items():
+            latencies.setdefault(stage, []).append(ms / 1000)
+    return {
+        stage: summarize(samples, errors=0, elapsed=0)
+        for stage, samples in latencies.items()
+    }
+
+
+def run_replay(args: argparse.Namespace) -> Dict:
+    """
+    Set up the database, then replay the recording.
+
+    Args:
+        args (argparse.Namespace): The parsed command line arguments.
+
+    Returns:
+        dict: The full replay report.
+    """
+    from sqlalchemy.orm import sessionmaker
+
+    from app.aggregates import rebuild_aggregates
+    from app.db import Base, engine_factory
+
+    records = load_recording(args.recording)
+
+    connect_args = {}
+    if args.database_url.startswith("sqlite"):
+        connect_args["check_same_thread"] = False
+    engine = engine_factory(args.database_url, connect_args=connect_args)
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    if args.people:
+        seed_people(session_factory, args.people)
+        db = session_factory()
+        try:
+            rebuild_aggregates(db)
+            db.commit()
+        finally:
+            db.close()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "database": engine.dialect.name,
+            "recording": os.path.basename(args.recording),
+            "records": len(records),
+            "people": args.people,
+            "repeat": args.repeat,
+            "cold_cache": args.cold_cache,
+        },
+        "scenarios": replay(records, session_factory, args.repeat, args.cold_cache),
+        "recorded": recorded_timings(records),
+    }
+    engine.dispose()
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("recording", help="JSON Lines file written by NL_RECORD_PATH.")
+    parser.add_argument(
+        "--database-url",
+        help="Database to query (default: a temporary SQLite file).",
+    )
+    parser.add_argument(
+        "--people",
+        type=int,
+        default=1000,
+        help="Rows to seed first (0 to query the database as is).",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Times to replay the recording."
+    )
+    parser.add_argument(
+        "--cold-cache",
+        action="store_true",
+        help="Empty the translation cache before each query.",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--compare", help="Baseline JSON report to compare with.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change tolerated before flagging a regression.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    workdir = tempfile.TemporaryDirectory()
+    if not args.database_url:
+        args.database_url = f"sqlite:///{os.path.join(workdir.name, 'replay.db')}"
+
+    # app.config requires these to be set; the OpenAI client is stubbed anyway
+    os.environ.setdefault("DATABASE_URL", args.database_url)
+    os.environ.setdefault("OPENAI_API_KEY", "replay-api-key")
+
+    try:
+        report = run_replay(args)
+    finally:
+        workdir.cleanup()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, report, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
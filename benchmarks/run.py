@@ -0,0 +1,458 @@
+"""
+Load and latency benchmark for the Elysian API.
+
+Runs the FastAPI app in-process against SQLite (or any database reachable
+through ``--database-url``) with a stubbed OpenAI client, drives each endpoint
+at a configurable concurrency and reports requests per second together with
+p50/p95/p99 latencies. Results are written as JSON so that runs can be compared
+and regressions flagged:
+
+    python -m benchmarks.run --people 10000 --concurrency 32 --output new.json
+    python -m benchmarks.run --compare baseline.json --output new.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess  # nosec B404
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+from unittest.mock import MagicMock, patch
+
+SCENARIOS = ("webhook", "get_name", "nl_query")
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """
+    Compute a percentile of the given samples using the nearest-rank method.
+
+    Args:
+        samples (List[float]): The samples, in any order.
+        pct (float): The percentile to compute, between 0 and 100.
+
+    Returns:
+        float: The percentile value, or 0.0 if there are no samples.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    """
+    Summarize the latencies of one scenario run.
+
+    Args:
+        latencies (List[float]): Per-request latencies in seconds.
+        errors (int): The number of requests that did not succeed.
+        elapsed (float): The wall-clock duration of the run in seconds.
+
+    Returns:
+        dict: Throughput and latency percentiles (in milliseconds).
+    """
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "rps": round(count / elapsed, 2) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float) -> List[str]:
+    """
+    Compare two benchmark reports and list the regressions.
+
+    A scenario regresses when its throughput drops, or its p95/p99 latency grows,
+    by more than ``threshold`` (a fraction, e.g. 0.1 for 10%).
+
+    Args:
+        baseline (dict): The reference report.
+        current (dict): The report to check.
+        threshold (float): The tolerated relative change.
+
+    Returns:
+        List[str]: A human readable description of each regression.
+    """
+    regressions = []
+    for name, now in current.get("scenarios", {}).items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        if before["rps"] and now["rps"] < before["rps"] * (1 - threshold):
+            regressions.append(f"{name}: rps {before['rps']} -> {now['rps']}")
+        for key in ("p95_ms", "p99_ms"):
+            if before[key] and now[key] > before[key] * (1 + threshold):
+                regressions.append(f"{name}: {key} {before[key]} -> {now[key]}")
+    return regressions
+
+
+def stub_openai_response(result_rows: int) -> str:
+    """
+    Build the canned LLM answer used for NL query runs.
+
+    Args:
+        result_rows (int): How many rows the generated query should return.
+
+    Returns:
+        str: A response in the format produced by ``translate_nl_to_sql``.
+    """
+    return f"""
+```sql
+SELECT id, name FROM people LIMIT :limit;
+```
+
+```json
+{{"limit": {result_rows}}}
+```
+"""
+
+
+def stub_openai_client(result_rows: int) -> MagicMock:
+    """
+    Build an OpenAI client stub, mirroring the ``mock_openai_client`` test fixture.
+
+    Args:
+        result_rows (int): How many rows the generated query should return.
+
+    Returns:
+        MagicMock: The client stub.
+    """
+    mock_client = MagicMock()
+    mock_response = MagicMock()
+    mock_response.choices = [MagicMock()]
+    mock_response.choices[0].message = MagicMock(
+        content=stub_openai_response(result_rows)
+    )
+    mock_client.chat.completions.create.return_value = mock_response
+    return mock_client
+
+
+def seed_people(session_factory, count: int) -> List[str]:
+    """
+    Insert ``count`` people and return their ids.
+
+    Args:
+        session_factory: A sessionmaker bound to the benchmark database.
+        count (int): The number of people to insert.
+
+    Returns:
+        List[str]: The ids of the inserted people.
+    """
+    from app.models import Person
+
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    db = session_factory()
+    try:
+        for start in range(0, count, 1000):
+            db.bulk_save_objects(
+                [
+                    Person(id=person_id, name=f"Person {start + i}")
+                    for i, person_id in enumerate(ids[start : start + 1000])
+                ]
+            )
+            db.commit()
+    finally:
+        db.close()
+    return ids
+
+
+def build_requests(scenario: str, seeded_ids: List[str]) -> Callable[[int], Dict]:
+    """
+    Return a function producing the i-th request of a scenario.
+
+    Args:
+        scenario (str): One of ``SCENARIOS``.
+        seeded_ids (List[str]): The ids of the seeded people.
+
+    Returns:
+        Callable[[int], dict]: Keyword arguments for ``httpx.AsyncClient.request``.
+    """
+    rng = random.Random(42)  # nosec B311
+
+    if scenario == "webhook":
+
+        def webhook(i: int) -> Dict:
+            timestamp = datetime.now(timezone.utc).isoformat()
+            if i % 2 and seeded_ids:
+                payload_type = "PersonRenamed"
+                content = {"person_id": rng.choice(seeded_ids), "name": f"R{i}"}
+            else:
+                payload_type = "PersonAdded"
+                content = {"person_id": str(uuid.uuid4()), "name": f"A{i}"}
+            content["timestamp"] = timestamp
+            return {
+                "method": "POST",
+                "url": "/accept_webhook",
+                "json": {"payload_type": payload_type, "payload_content": content},
+            }
+
+        return webhook
+
+    if scenario == "get_name":
+        return lambda i: {
+            "method": "GET",
+            "url": "/get_name",
+            "params": {"person_id": rng.choice(seeded_ids)},
+        }
+
+    if scenario == "nl_query":
+        return lambda i: {
+            "method": "POST",
+            "url": "/execute_custom_nl_query",
+            "json": {"natural_language_query": "List people"},
+        }
+
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def run_scenario(
+    client, make_request: Callable[[int], Dict], requests: int, concurrency: int
+) -> Dict:
+    """
+    Issue ``requests`` requests with ``concurrency`` concurrent workers.
+
+    Args:
+        client (httpx.AsyncClient): The client bound to the app.
+        make_request (Callable[[int], dict]): Produces the i-th request.
+        requests (int): The total number of requests.
+        concurrency (int): The number of concurrent workers.
+
+    Returns:
+        dict: The summary produced by ``summarize``.
+    """
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            kwargs = make_request(i)
+            started = time.perf_counter()
+            response = await client.request(**kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run_benchmarks(args: argparse.Namespace) -> Dict:
+    """
+    Set up the app and database, then run every requested scenario.
+
+    Args:
+        args (argparse.Namespace): The parsed command line arguments.
+
+    Returns:
+        dict: The full benchmark report.
+    """
+    import httpx
+    from sqlalchemy.orm import sessionmaker
+
+    from app.db import Base, engine_factory, get_db
+    from app.main import app
+
+    connect_args = {}
+    if args.database_url.startswith("sqlite"):
+        connect_args["check_same_thread"] = False
+    engine = engine_factory(args.database_url, connect_args=connect_args)
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    seeded_ids = seed_people(session_factory, args.people)
+
+    replica = None
+    if args.name_replica:
+        from app.replica import NameReplica
+
+        replica = NameReplica(os.path.join(args.workdir, "names"))
+        db = session_factory()
+        try:
+            replica.rebuild(db)
+        finally:
+            db.close()
+
+    spool = None
+    if args.webhook_spool:
+        from app.models import webhook_payload_adapter
+        from app.services import apply_webhook_payloads
+        from app.spool import WebhookSpool
+
+        def apply_batch(records):
+            db = session_factory()
+            try:
+                apply_webhook_payloads(
+                    db, [webhook_payload_adapter.validate_json(r) for r in records]
+                )
+            finally:
+                db.close()
+
+        spool = WebhookSpool(
+            os.path.join(args.workdir, "spool"),
+            64 * 1024 * 1024,
+            0.002,
+            batch_size=500,
+        )
+        spool.start(apply_batch)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "database": engine.dialect.name,
+            "people": args.people,
+            "result_rows": args.result_rows,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "name_replica": args.name_replica,
+            "webhook_spool": args.webhook_spool,
+        },
+        "scenarios": {},
+    }
+
+    transport = httpx.ASGITransport(app=app)
+    with patch("app.services.client", stub_openai_client(args.result_rows)), patch(
+        "app.replica._replica", replica
+    ), patch("app.api.get_webhook_spool", return_value=spool):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            for scenario in args.scenarios:
+                make_request = build_requests(scenario, seeded_ids)
+                # Warm up code paths and connections before measuring
+                await run_scenario(
+                    client, make_request, min(args.concurrency, args.requests), 1
+                )
+                report["scenarios"][scenario] = await run_scenario(
+                    client, make_request, args.requests, args.concurrency
+                )
+
+    app.dependency_overrides.pop(get_db, None)
+    if replica is not None:
+        replica.close()
+    if spool is not None:
+        spool.stop()
+    engine.dispose()
+    return report
+
+
+def git_commit() -> Optional[str]:
+    """
+    Return the current git commit hash, if available.
+
+    Returns:
+        Optional[str]: The commit hash, or None outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(  # nosec B603 B607
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--database-url",
+        help="Database to benchmark against (default: a temporary SQLite file).",
+    )
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=SCENARIOS,
+        default=list(SCENARIOS),
+        help="Scenarios to run.",
+    )
+    parser.add_argument("--people", type=int, default=1000, help="Rows to seed.")
+    parser.add_argument(
+        "--result-rows",
+        type=int,
+        default=100,
+        help="Rows returned by each NL query.",
+    )
+    parser.add_argument("--requests", type=int, default=500, help="Per scenario.")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--name-replica",
+        action="store_true",
+        help="Serve /get_name from the shared-memory name replica.",
+    )
+    parser.add_argument(
+        "--webhook-spool",
+        action="store_true",
+        help="Acknowledge webhooks once written to the durable spool.",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--compare", help="Baseline JSON report to compare with.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change tolerated before flagging a regression.",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    workdir = tempfile.TemporaryDirectory()
+    args.workdir = workdir.name
+    if not args.database_url:
+        args.database_url = f"sqlite:///{os.path.join(args.workdir, 'bench.db')}"
+
+    # app.config requires these to be set; the OpenAI client is stubbed anyway
+    os.environ.setdefault("DATABASE_URL", args.database_url)
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark-api-key")
+
+    try:
+        report = asyncio.run(run_benchmarks(args))
+    finally:
+        workdir.cleanup()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, report, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
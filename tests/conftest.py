@@ -7,9 +7,11 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
 os.environ["OPENAI_API_KEY"] = "test-api-key"
+os.environ["NAME_REPLICA_RECHECK_DELAY"] = "0"
 
 from app.db import Base, engine_factory, get_db
 from app.main import app
+from app.services import clear_translation_cache
 
 SQLALCHEMY_DATABASE_URL = "sqlite://"
 
@@ -100,3 +102,11 @@ def db_session(setup_database):
         yield db
     finally:
         db.close()
+
+
+# Keep cached NL translations from leaking between tests
+@pytest.fixture(autouse=True)
+def translation_cache():
+    clear_translation_cache()
+    yield
+    clear_translation_cache()
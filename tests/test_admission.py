@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import uuid
+from unittest.mock import patch
+
+import anyio
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.admission import (
+    AdmissionMiddleware,
+    PriorityLimiter,
+    Rejected,
+    TokenBuckets,
+)
+from app.config import get_settings
+from app.main import app
+
+
+def make_limiter(capacity=1, limits=None, queue_size=10, timeout=1.0):
+    classes = ("webhook", "lookup", "nl")
+    return PriorityLimiter(
+        capacity,
+        limits or {},
+        {cls: queue_size for cls in classes},
+        {cls: timeout for cls in classes},
+    )
+
+
+def test_freed_slots_go_to_the_highest_priority_waiter():
+    async def scenario():
+        limiter = make_limiter(capacity=1)
+        order = []
+
+        async def request(cls):
+            await limiter.acquire(cls)
+            order.append(cls)
+            await asyncio.sleep(0)
+            limiter.release(cls)
+
+        await limiter.acquire("nl")
+        waiting = [
+            asyncio.create_task(request(cls)) for cls in ("nl", "lookup", "webhook")
+        ]
+        await asyncio.sleep(0)
+        limiter.release("nl")
+        await asyncio.gather(*waiting)
+        return order
+
+    assert asyncio.run(scenario()) == ["webhook", "lookup", "nl"]
+
+
+def test_class_limits_keep_slots_for_higher_classes():
+    async def scenario():
+        limiter = make_limiter(capacity=2, limits={"nl": 1}, timeout=0.01)
+        await limiter.acquire("nl")
+        with pytest.raises(Rejected) as rejected:
+            await limiter.acquire("nl")
+        assert rejected.value.reason == "queue_timeout"
+        # The slot left is still available to webhooks
+        await limiter.acquire("webhook")
+        assert limiter.active == 2
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_at_once():
+    async def scenario():
+        limiter = make_limiter(capacity=1, queue_size=1)
+        await limiter.acquire("lookup")
+        waiting = asyncio.create_task(limiter.acquire("lookup"))
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as rejected:
+            await limiter.acquire("lookup")
+        assert rejected.value.reason == "queue_full"
+        limiter.release("lookup")
+        await waiting
+
+    asyncio.run(scenario())
+
+
+def test_token_buckets():
+    buckets = TokenBuckets(rate=0.5, burst=2)
+    assert buckets.take("a") is None
+    assert buckets.take("a") is None
+    assert buckets.take("a") == 2
+    assert buckets.take("b") is None
+
+
+def test_nl_queries_are_rate_limited_per_client():
+    settings = get_settings().model_copy(
+        update={"nl_rate_limit_per_second": 0.01, "nl_rate_limit_burst": 1}
+    )
+    app = FastAPI()
+
+    @app.post("/execute_custom_nl_query")
+    async def nl_query():
+        return {"result": []}
+
+    with patch("app.admission.get_settings", return_value=settings):
+        app.add_middleware(AdmissionMiddleware)
+        client = TestClient(app)
+        assert client.post("/execute_custom_nl_query").status_code == 200
+        response = client.post("/execute_custom_nl_query")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_webhooks_are_admitted_while_nl_translation_is_slow(
+    setup_database, mock_openai_client
+):
+    translating, release = threading.Event(), threading.Event()
+
+    def slow_translation(nl_query):
+        translating.set()
+        release.wait(10)
+        raise ValueError("Translation abandoned")
+
+    # Serve every request on one event loop, as a worker does
+    with anyio.from_thread.start_blocking_portal() as portal, patch(
+        "app.api.translate_nl_to_sql", side_effect=slow_translation
+    ):
+        client = TestClient(app)
+        client.portal = portal
+        nl_query = threading.Thread(
+            target=client.post,
+            args=("/execute_custom_nl_query",),
+            kwargs={"json": {"natural_language_query": "Who joined most recently?"}},
+        )
+        nl_query.start()
+        try:
+            assert translating.wait(5)
+            webhook = {}
+            sender = threading.Thread(
+                target=lambda: webhook.update(
+                    response=client.post(
+                        "/accept_webhook",
+                        json={
+                            "payload_type": "PersonAdded",
+                            "payload_content": {
+                                "person_id": str(uuid.uuid4()),
+                                "name": "Admitted User",
+                                "timestamp": "2023-10-10T12:34:56Z",
+                            },
+                        },
+                    )
+                )
+            )
+            sender.start()
+            sender.join(5)
+            # Answered while the translation is still blocked
+            assert not release.is_set()
+            assert webhook["response"].status_code == 200
+        finally:
+            release.set()
+            nl_query.join(10)
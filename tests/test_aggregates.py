@@ -0,0 +1,258 @@
+import uuid
+from datetime import date, datetime, timezone
+
+import pytest
+from sqlalchemy import text
+
+from app import aggregates as aggregates_module
+from app.aggregates import (
+    ADDED,
+    REMOVED,
+    RENAMED,
+    answer_from_aggregates,
+    count_events,
+    count_people,
+    history_event_counts,
+    rebuild_aggregates,
+    top_first_names,
+)
+from app.models import (
+    FirstNameCount,
+    PeopleStat,
+    Person,
+    PersonAdded,
+    PersonRemoved,
+    PersonRenamed,
+    webhook_payload_adapter,
+)
+from app.services import (
+    add_person,
+    apply_webhook_payloads,
+    remove_person,
+    rename_person,
+)
+
+
+def today():
+    return datetime.now(timezone.utc).date()
+
+
+@pytest.fixture
+def aggregates(db_session):
+    # Start from the people left by other tests
+    rebuild_aggregates(db_session)
+    db_session.commit()
+
+
+def test_write_paths_update_aggregates(db_session, aggregates):
+    people = count_people(db_session)
+    renames = count_events(db_session, RENAMED, today())
+    person_id = uuid.uuid4()
+
+    add_person(
+        db_session,
+        PersonAdded(person_id=person_id, name="Zelda Fitz", timestamp=datetime.now()),
+    )
+    assert count_people(db_session) == people + 1
+    assert ("Zelda", 1) in top_first_names(db_session, 100)
+
+    rename_person(
+        db_session,
+        PersonRenamed(person_id=person_id, name="Yara Fitz", timestamp=datetime.now()),
+    )
+    assert count_events(db_session, RENAMED, today()) == renames + 1
+    names = dict(top_first_names(db_session, 100))
+    assert "Zelda" not in names and names["Yara"] == 1
+
+    remove_person(
+        db_session, PersonRemoved(person_id=person_id, timestamp=datetime.now())
+    )
+    assert count_people(db_session) == people
+    assert "Yara" not in dict(top_first_names(db_session, 100))
+
+
+def test_folded_batches_update_aggregates(db_session, aggregates):
+    people = count_people(db_session)
+    added = count_events(db_session, ADDED, today())
+    removed = count_events(db_session, REMOVED, today())
+    first, second = str(uuid.uuid4()), str(uuid.uuid4())
+
+    def payload(payload_type, person_id, name=None):
+        content = {"person_id": person_id, "timestamp": datetime.now().isoformat()}
+        if name is not None:
+            content["name"] = name
+        return webhook_payload_adapter.validate_python(
+            {"payload_type": payload_type, "payload_content": content}
+        )
+
+    apply_webhook_payloads(
+        db_session,
+        [
+            payload("PersonAdded", first, "Xavier One"),
+            payload("PersonAdded", second, "Xavier Two"),
+            payload("PersonRenamed", second, "Wanda Two"),
+            payload("PersonRemoved", str(uuid.uuid4())),  # skipped
+        ],
+    )
+    assert count_people(db_session) == people + 2
+    assert count_events(db_session, ADDED, today()) == added + 2
+    assert count_events(db_session, REMOVED, today()) == removed
+    names = dict(top_first_names(db_session, 100))
+    assert names["Xavier"] == 1 and names["Wanda"] == 1
+
+
+def test_replayed_events_are_counted_once(db_session, aggregates):
+    added = count_events(db_session, ADDED, today())
+    renamed = count_events(db_session, RENAMED, today())
+    person_id = str(uuid.uuid4())
+
+    def payload(payload_type, name):
+        return webhook_payload_adapter.validate_python(
+            {
+                "payload_type": payload_type,
+                "payload_content": {
+                    "person_id": person_id,
+                    "name": name,
+                    "timestamp": datetime.now().isoformat(),
+                },
+            }
+        )
+
+    batch = [payload("PersonAdded", "Vera One"), payload("PersonRenamed", "Vera Two")]
+    apply_webhook_payloads(db_session, batch)
+    apply_webhook_payloads(db_session, batch)
+    assert count_events(db_session, ADDED, today()) == added + 1
+    assert count_events(db_session, RENAMED, today()) == renamed + 1
+
+    # Adding an existing person renames them, unless the name is the same
+    apply_webhook_payloads(db_session, [payload("PersonAdded", "Vera Three")])
+    apply_webhook_payloads(db_session, [payload("PersonAdded", "Vera Three")])
+    assert count_events(db_session, ADDED, today()) == added + 1
+    assert count_events(db_session, RENAMED, today()) == renamed + 2
+    assert dict(top_first_names(db_session, 100))["Vera"] == 1
+
+
+def test_rebuild_aggregates_recomputes_counters(db_session, aggregates):
+    people = count_people(db_session)
+    db_session.query(PeopleStat).update({PeopleStat.value: 12345})
+    db_session.commit()
+
+    rebuild_aggregates(db_session)
+    db_session.commit()
+    assert count_people(db_session) == people
+
+
+@pytest.fixture
+def case_insensitive_first_names(db_session):
+    # Collate first names the way MariaDB does by default, case-insensitively
+    table = FirstNameCount.__table__
+    table.drop(db_session.get_bind())
+    db_session.execute(
+        text(
+            "CREATE TABLE first_name_counts (first_name VARCHAR(255) COLLATE NOCASE"
+            " PRIMARY KEY, count BIGINT NOT NULL)"
+        )
+    )
+    db_session.commit()
+    yield
+    db_session.execute(text("DROP TABLE first_name_counts"))
+    db_session.commit()
+    table.create(db_session.get_bind())
+
+
+def test_rebuild_aggregates_merges_collated_first_names(
+    db_session, case_insensitive_first_names
+):
+    for name in ("Anna Upper", "anna Lower", "ANNA Shout"):
+        db_session.add(Person(id=str(uuid.uuid4()), name=name))
+    db_session.commit()
+
+    rebuild_aggregates(db_session)
+    db_session.commit()
+    assert (
+        sum(
+            count
+            for name, count in top_first_names(db_session, 100)
+            if name.lower() == "anna"
+        )
+        == 3
+    )
+    assert (
+        db_session.query(FirstNameCount)
+        .filter(FirstNameCount.first_name == "anna")
+        .count()
+        == 1
+    )
+
+
+def test_answer_from_aggregates(db_session, aggregates):
+    people = count_people(db_session)
+    assert answer_from_aggregates(db_session, "How many people are there?") == (
+        ["count"],
+        [(people,)],
+    )
+    assert answer_from_aggregates(db_session, "  what is the NUMBER of people ") == (
+        ["count"],
+        [(people,)],
+    )
+
+    columns, rows = answer_from_aggregates(
+        db_session, "How many renames happened this week?"
+    )
+    assert columns == ["count"] and rows[0][0] >= 0
+    assert (
+        answer_from_aggregates(
+            db_session, "how many people were removed in the last 7 days"
+        )
+        is not None
+    )
+
+    columns, rows = answer_from_aggregates(
+        db_session, "What are the top 3 most common first names?"
+    )
+    assert columns == ["first_name", "count"] and len(rows) <= 3
+
+    assert answer_from_aggregates(db_session, "What's the name of person 42?") is None
+    assert answer_from_aggregates(db_session, "How many people are named Jane?") is None
+
+
+def test_aggregates_are_unused_until_rebuilt(db_session, monkeypatch):
+    monkeypatch.setattr(aggregates_module, "_rebuilt", False)
+    db_session.query(PeopleStat).delete()
+    db_session.commit()
+    assert answer_from_aggregates(db_session, "How many people are there?") is None
+
+    rebuild_aggregates(db_session)
+    db_session.commit()
+    assert answer_from_aggregates(db_session, "How many people are there?") == (
+        ["count"],
+        [(count_people(db_session),)],
+    )
+
+
+def test_nl_query_fast_path_skips_llm(client, mock_openai_client, db_session):
+    rebuild_aggregates(db_session)
+    db_session.commit()
+    mock_openai_client.chat.completions.create.reset_mock()
+
+    response = client.post(
+        "/execute_custom_nl_query",
+        json={"natural_language_query": "How many people are there?"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"result": [{"count": count_people(db_session)}]}
+    mock_openai_client.chat.completions.create.assert_not_called()
+
+
+def test_history_event_counts():
+    monday, tuesday = datetime(2026, 10, 19, 9), datetime(2026, 10, 20, 9)
+    rows = [
+        ("a", monday, tuesday),  # added, then renamed
+        ("a", tuesday, None),
+        ("b", monday, tuesday),  # added, then removed
+    ]
+    assert history_event_counts(rows) == {
+        (date(2026, 10, 19), ADDED): 2,
+        (date(2026, 10, 20), RENAMED): 1,
+        (date(2026, 10, 20), REMOVED): 1,
+    }
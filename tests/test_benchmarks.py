@@ -0,0 +1,63 @@
+import json
+
+from benchmarks.replay import load_recording, replay
+from benchmarks.run import compare_results, percentile, summarize
+from tests.conftest import TestingSessionLocal
+
+
+def test_percentile():
+    samples = [float(i) for i in range(1, 101)]
+    assert percentile(samples, 50) == 50.0
+    assert percentile(samples, 95) == 95.0
+    assert percentile(samples, 99) == 99.0
+    assert percentile([], 50) == 0.0
+
+
+def test_summarize():
+    summary = summarize([0.01, 0.02, 0.03, 0.04], errors=1, elapsed=2.0)
+    assert summary["requests"] == 4
+    assert summary["errors"] == 1
+    assert summary["rps"] == 2.0
+    assert summary["p50_ms"] == 20.0
+    assert summary["p99_ms"] == 40.0
+
+
+def test_compare_results_flags_regressions():
+    baseline = {
+        "scenarios": {"get_name": {"rps": 100.0, "p95_ms": 10.0, "p99_ms": 20.0}}
+    }
+    current = {"scenarios": {"get_name": {"rps": 80.0, "p95_ms": 10.5, "p99_ms": 30.0}}}
+    regressions = compare_results(baseline, current, threshold=0.1)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("get_name: rps")
+    assert regressions[1].startswith("get_name: p99_ms")
+    assert compare_results(baseline, baseline, threshold=0.1) == []
+
+
+def test_replay_recording(setup_database, tmp_path):
+    path = tmp_path / "nl.jsonl"
+    raw = '```sql\nSELECT COUNT(*) AS count FROM people WHERE name = :name;\n```\n\n```json\n{"name": "Nobody"}\n```'
+    records = [
+        {
+            "question": "How many are called Nobody?",
+            "source": "llm",
+            "raw_response": raw,
+        },
+        {"question": "How many people are there?", "source": "aggregates"},
+        {"question": "Untranslatable", "source": "llm", "raw_response": None},
+    ]
+    path.write_text(
+        "\n".join(json.dumps(record) for record in records) + "\nnot json\n"
+    )
+
+    loaded = load_recording(str(path))
+    assert [record["question"] for record in loaded] == [
+        "How many are called Nobody?",
+        "How many people are there?",
+    ]
+
+    scenarios = replay(loaded, TestingSessionLocal, repeat=2)
+    assert set(scenarios) == {"aggregates", "translate", "parse", "execute", "total"}
+    assert scenarios["execute"]["requests"] == 2
+    assert scenarios["total"]["requests"] == 4
+    assert all(summary["errors"] == 0 for summary in scenarios.values())
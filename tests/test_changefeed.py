@@ -0,0 +1,136 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import orjson
+
+from app.changefeed import (
+    ChangeFeed,
+    close_change_feed,
+    get_change_feed,
+    history_changes,
+    open_change_feed,
+    stream_changes,
+)
+from app.config import get_settings
+from app.models import PersonAdded, PersonRemoved
+from app.services import (
+    add_change_listener,
+    add_person,
+    remove_change_listener,
+    remove_person,
+)
+
+
+def test_history_changes():
+    t0 = datetime(2024, 6, 17, 12, 0, 0)
+    since = t0 + timedelta(seconds=1)
+    rows = [
+        # Renamed after `since`
+        ("a", "Old", t0, t0 + timedelta(seconds=2)),
+        ("a", "New", t0 + timedelta(seconds=2), None),
+        # Added, then removed, after `since`
+        ("b", "Gone", t0 + timedelta(seconds=3), t0 + timedelta(seconds=4)),
+    ]
+    assert [
+        (change["op"], change["person_id"], change["name"])
+        for change in history_changes(rows, since)
+    ] == [("upsert", "a", "New"), ("upsert", "b", "Gone"), ("delete", "b", None)]
+    # Timestamped like live changes
+    assert history_changes(rows, since)[0]["timestamp"] == "2024-06-17T12:00:02+00:00"
+
+
+def test_subscribers_receive_committed_changes(db_session):
+    async def scenario():
+        feed = ChangeFeed(buffer_size=10, subscriber_buffer_size=10)
+        subscriber, backlog = feed.subscribe()
+        assert backlog == []
+        person_id = str(uuid.uuid4())
+        add_change_listener(feed.publish)
+        try:
+            add_person(
+                db_session,
+                PersonAdded(person_id=person_id, name="Fed", timestamp=datetime.now()),
+            )
+            remove_person(
+                db_session, PersonRemoved(person_id=person_id, timestamp=datetime.now())
+            )
+        finally:
+            remove_change_listener(feed.publish)
+        added = await asyncio.wait_for(subscriber.queue.get(), 1)
+        removed = await asyncio.wait_for(subscriber.queue.get(), 1)
+        assert (added["op"], added["name"]) == ("upsert", "Fed")
+        assert (removed["op"], removed["person_id"]) == ("delete", person_id)
+
+        # A later subscriber resumes from the buffer
+        _, backlog = feed.subscribe(after_seq=added["seq"])
+        assert backlog == [removed]
+        assert feed.parse_cursor(feed.cursor(removed)) == removed["seq"]
+        assert feed.parse_cursor("another-feed:1") is None
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscribers_are_disconnected():
+    async def scenario():
+        feed = ChangeFeed(buffer_size=10, subscriber_buffer_size=1)
+        subscriber, _ = feed.subscribe()
+        feed.publish([("a", "A", False), ("b", "B", False)])
+        await asyncio.sleep(0)
+        assert subscriber.overflowed
+        events = [event async for event in stream_changes(feed, subscriber, [], 1)]
+        assert events[-1].startswith(b"event: overflow")
+        assert feed._subscribers == []
+
+    asyncio.run(scenario())
+
+
+def test_stream_changes_renders_server_sent_events():
+    async def scenario():
+        feed = ChangeFeed(buffer_size=10, subscriber_buffer_size=10)
+        subscriber, _ = feed.subscribe()
+        feed.publish([("a", "A", False)])
+        stream = stream_changes(feed, subscriber, [], 1)
+        event = await stream.__anext__()
+        await stream.aclose()
+        return feed, event
+
+    feed, event = asyncio.run(scenario())
+    lines = event.decode().strip().split("\n")
+    assert lines[0] == "event: change"
+    assert lines[1] == f"id: {feed.id}:1"
+    assert orjson.loads(lines[2].removeprefix("data: "))["name"] == "A"
+
+
+def test_change_feed_is_only_opened_when_complete():
+    settings = get_settings()
+    try:
+        # Other workers' changes cannot be read from SQLite
+        assert open_change_feed() is None
+        assert get_change_feed() is None
+
+        single_writer = settings.model_copy(update={"change_feed_single_writer": True})
+        with patch("app.changefeed.get_settings", return_value=single_writer):
+            feed = open_change_feed()
+        assert feed is get_change_feed() and not feed.polls_history
+        close_change_feed()
+
+        mariadb = MagicMock()
+        mariadb.dialect.name = "mariadb"
+        with patch("app.changefeed.get_engines", return_value=[mariadb]):
+            assert open_change_feed().polls_history
+    finally:
+        close_change_feed()
+
+
+def test_changes_endpoint_errors(client):
+    assert client.get("/changes").status_code == 503
+    feed = ChangeFeed(buffer_size=10, subscriber_buffer_size=10)
+    with patch("app.api.get_change_feed", return_value=feed):
+        # Cursor from another worker, and no time to backfill from
+        response = client.get("/changes", headers={"Last-Event-ID": "other:3"})
+        assert response.status_code == 410
+        # No history to backfill from on SQLite
+        response = client.get("/changes", params={"since": "2024-06-17T12:00:00"})
+        assert response.status_code == 410
@@ -1,8 +1,18 @@
-from unittest.mock import patch
+import json
+import os
+from unittest.mock import MagicMock, patch
+
+import pytest
 
 from sqlalchemy.exc import SQLAlchemyError
 
 from app.models import QueryRequest
+from app.recorder import (
+    NLRecorder,
+    close_nl_recorder,
+    get_nl_recorder,
+    open_nl_recorder,
+)
 
 
 def test_execute_custom_nl_query(client, mock_openai_client, db_session):
@@ -24,6 +34,42 @@ def test_execute_custom_nl_query(client, mock_openai_client, db_session):
     assert result[0]["name"] == "Test User"
 
 
+def test_execute_custom_nl_query_columnar(client, mock_openai_client):
+    query_request = QueryRequest(natural_language_query="What's the name?")
+    response = client.post(
+        "/execute_custom_nl_query",
+        json=query_request.model_dump(),
+        headers={"Accept": "application/vnd.elysian.columnar+json"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/vnd.elysian.columnar+json"
+    assert response.json() == {"columns": ["name"], "values": [["Test User"]]}
+
+
+def test_execute_custom_nl_query_arrow(client, mock_openai_client):
+    pa = pytest.importorskip("pyarrow")
+    query_request = QueryRequest(natural_language_query="What's the name?")
+    response = client.post(
+        "/execute_custom_nl_query",
+        json=query_request.model_dump(),
+        headers={"Accept": "application/vnd.apache.arrow.stream"},
+    )
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.column_names == ["name"]
+    assert table.column("name").to_pylist() == ["Test User"]
+
+
+def test_execute_custom_nl_query_not_acceptable(client, mock_openai_client):
+    query_request = QueryRequest(natural_language_query="What's the name?")
+    response = client.post(
+        "/execute_custom_nl_query",
+        json=query_request.model_dump(),
+        headers={"Accept": "text/csv"},
+    )
+    assert response.status_code == 406
+
+
 def test_sql_execution_error(client, mock_openai_client):
     query_request = QueryRequest(
         natural_language_query="What's the previous name of person id: d59abfc4-3aae-4e29-875b-7b56e021ad42?"
@@ -47,3 +93,54 @@ def test_invalid_sql_query(client, mock_openai_error_client):
     response = client.post("/execute_custom_nl_query", json=query_request.model_dump())
     assert response.status_code == 400
     assert "detail" in response.json()
+
+
+def test_execute_custom_nl_query_is_recorded(client, mock_openai_client, tmp_path):
+    path = str(tmp_path / "nl.jsonl")
+    recorder = NLRecorder(path)
+    # The error client of the previous test is still patched in
+    with patch("app.services.client", mock_openai_client), patch(
+        "app.recorder._recorder", recorder
+    ):
+        response = client.post(
+            "/execute_custom_nl_query",
+            json={"natural_language_query": "What's the name?"},
+        )
+    recorder.close()
+    assert response.status_code == 200
+
+    with open(path) as f:
+        (record,) = [json.loads(line) for line in f]
+    assert record["question"] == "What's the name?"
+    assert record["source"] == "llm"
+    assert "```sql" in record["raw_response"]
+    assert record["query_template"].startswith("SELECT name FROM people")
+    assert record["rows"] == 1 and record["error"] is None
+    assert set(record["timings_ms"]) == {
+        "aggregates",
+        "translate",
+        "parse",
+        "execute",
+        "total",
+    }
+
+
+def test_nl_recorder_writes_per_worker_file_in_background(tmp_path):
+    settings = MagicMock(
+        nl_record_path=str(tmp_path / "nl.jsonl"), nl_record_sample_rate=1.0
+    )
+    with patch("app.recorder.get_settings", return_value=settings):
+        recorder = open_nl_recorder()
+    try:
+        assert recorder.path == str(tmp_path / f"nl.{os.getpid()}.jsonl")
+        assert get_nl_recorder() is recorder
+        for i in range(100):
+            recorder.write({"question": f"q{i}"})
+    finally:
+        close_nl_recorder()
+    assert get_nl_recorder() is None
+
+    with open(recorder.path) as f:
+        assert [json.loads(line)["question"] for line in f] == [
+            f"q{i}" for i in range(100)
+        ]
@@ -0,0 +1,37 @@
+import json
+import logging
+
+from app.log import JsonFormatter, RequestQueueHandler, TruncatedResult, request_id_var
+
+
+def test_json_formatter_includes_request_id_and_extra():
+    record = logging.makeLogRecord(
+        {"name": "app.services", "levelname": "DEBUG", "msg": "Executing %s"}
+    )
+    record.args = ("query",)
+    record.params = {"id": 1}
+
+    token = request_id_var.set("abc123")
+    try:
+        record = RequestQueueHandler(None).prepare(record)
+    finally:
+        request_id_var.reset(token)
+
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["message"] == "Executing query"
+    assert entry["request_id"] == "abc123"
+    assert entry["params"] == {"id": 1}
+
+
+def test_truncated_result_limits_output():
+    rows = [{"id": i, "name": "x" * 50} for i in range(10_000)]
+    rendered = str(TruncatedResult(rows, max_chars=200))
+    assert len(rendered) < 300
+    assert rendered.endswith("(10000 rows)")
+    assert str(TruncatedResult(rows[:1], max_chars=200)) == str(rows[:1])
+
+
+def test_request_id_header(client):
+    response = client.get("/nl-to-sql", headers={"X-Request-ID": "req-1"})
+    assert response.headers["X-Request-ID"] == "req-1"
+    assert client.get("/nl-to-sql").headers["X-Request-ID"]
@@ -1,9 +1,15 @@
+import gzip
+import json
 import uuid
+from unittest.mock import patch
 
 import pytest
+from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
 
+from app.main import app
 from app.models import Person
+from tests.conftest import engine
 
 
 @pytest.fixture
@@ -56,12 +62,88 @@ def test_accept_webhook_remove(client, seed_person):
     assert response.json() == {"detail": "Webhook processed successfully"}
 
 
+def test_accept_webhook_gzip(client):
+    payload = {
+        "payload_type": "PersonAdded",
+        "payload_content": {
+            "person_id": str(uuid.uuid4()),
+            "name": "Test User",
+            "timestamp": "2023-10-10T12:34:56Z",
+        },
+    }
+    response = client.post(
+        "/accept_webhook",
+        content=gzip.compress(json.dumps(payload).encode()),
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Webhook processed successfully"}
+
+
+def test_accept_webhook_msgpack(client, seed_person):
+    msgpack = pytest.importorskip("msgpack")
+    payload = {
+        "payload_type": "PersonRenamed",
+        "payload_content": {
+            "person_id": seed_person,
+            "name": "Packed User",
+            "timestamp": "2023-10-11T12:34:56Z",
+        },
+    }
+    response = client.post(
+        "/accept_webhook",
+        content=gzip.compress(msgpack.packb(payload)),
+        headers={"Content-Type": "application/msgpack", "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 200
+    assert client.get(f"/get_name?person_id={seed_person}").json() == {
+        "name": "Packed User"
+    }
+
+
+def test_accept_webhook_unsupported_media_type(client):
+    response = client.post(
+        "/accept_webhook",
+        content=b"payload_type=PersonAdded",
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    assert response.status_code == 415
+
+
+def test_accept_webhook_payload_too_large(client):
+    response = client.post(
+        "/accept_webhook",
+        content=gzip.compress(b" " * (2 * 1024 * 1024)),
+        headers={"Content-Type": "application/json", "Content-Encoding": "gzip"},
+    )
+    assert response.status_code == 413
+
+
 def test_get_name(client, seed_person):
     response = client.get(f"/get_name?person_id={seed_person}")
     assert response.status_code == 200
     assert response.json() == {"name": "Test User"}
 
 
+def test_get_name_revalidation(client, db_session, seed_person):
+    etag = client.get(f"/get_name?person_id={seed_person}").headers["ETag"]
+    response = client.get(
+        f"/get_name?person_id={seed_person}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    db_session.query(Person).filter(Person.id == seed_person).one().name = "Renamed"
+    db_session.commit()
+    response = client.get(
+        f"/get_name?person_id={seed_person}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"name": "Renamed"}
+    assert response.headers["ETag"] != etag
+
+
 def test_get_name_not_found(client):
     response = client.get("/get_name", params={"person_id": str(uuid.uuid4())})
     assert response.status_code == 404
@@ -150,3 +232,40 @@ def test_serve_nl_to_sql_html(client):
     assert response.status_code == 200
     assert "text/html" in response.headers["content-type"]
     assert "<!DOCTYPE html>" in response.text
+
+
+def test_ready_after_warm_up(setup_database, mock_openai_client):
+    assert TestClient(app).get("/ready").status_code == 503
+    with patch("app.main.get_engines", return_value=[engine]), patch(
+        "app.main.dispose_engine"
+    ):
+        with TestClient(app) as client:
+            assert client.get("/ready").json() == {"status": "ready"}
+            assert client.get("/health").status_code == 200
+
+
+def test_serve_nl_to_sql_compressed(client):
+    response = client.get("/nl-to-sql", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == "no-cache"
+    assert "<!DOCTYPE html>" in response.text
+
+
+def test_serve_nl_to_sql_not_modified(client):
+    etag = client.get("/nl-to-sql").headers["etag"]
+    response = client.get("/nl-to-sql", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+
+def test_serve_static_not_found(client):
+    assert client.get("/static/missing.js").status_code == 404
+
+
+def test_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE db_write_conflicts_total counter" in response.text
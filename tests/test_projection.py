@@ -0,0 +1,174 @@
+import uuid
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from app.config import get_settings
+from app.models import (
+    Person,
+    PersonEvent,
+    ProjectionCheckpoint,
+    webhook_payload_adapter,
+)
+from app.projection import project_events, rebuild_projection
+from app.replica import NameReplica
+from app.services import append_events, get_person
+
+
+def event(payload_type, person_id, name=None):
+    content = {"person_id": person_id, "timestamp": datetime.now().isoformat()}
+    if name is not None:
+        content["name"] = name
+    return webhook_payload_adapter.validate_python(
+        {"payload_type": payload_type, "payload_content": content}
+    )
+
+
+@pytest.fixture
+def event_log(db_session):
+    db_session.query(PersonEvent).delete()
+    db_session.query(ProjectionCheckpoint).delete()
+    db_session.commit()
+    yield
+    db_session.query(PersonEvent).delete()
+    db_session.query(ProjectionCheckpoint).delete()
+    db_session.commit()
+
+
+def test_events_are_projected_incrementally(db_session, event_log):
+    renamed, removed = str(uuid.uuid4()), str(uuid.uuid4())
+    append_events(
+        db_session,
+        [
+            event("PersonAdded", renamed, "Original Name"),
+            event("PersonAdded", removed, "Removed Person"),
+            event("PersonRenamed", renamed, "Updated Name"),
+        ],
+    )
+    assert get_person(db_session, renamed) is None
+
+    assert project_events(db_session) == 3
+    assert get_person(db_session, renamed).name == "Updated Name"
+    assert get_person(db_session, removed).name == "Removed Person"
+
+    append_events(db_session, [event("PersonRemoved", removed)])
+    assert project_events(db_session) == 1
+    assert get_person(db_session, removed) is None
+    assert project_events(db_session) == 0
+
+
+def test_projection_waits_for_gaps_to_fill(db_session, event_log):
+    person_id = str(uuid.uuid4())
+    append_events(db_session, [event("PersonAdded", person_id, "First")])
+    project_events(db_session)
+    position = db_session.query(ProjectionCheckpoint).one().position
+
+    # An insert with a lower id that has yet to commit
+    db_session.add(
+        PersonEvent(
+            id=position + 2,
+            person_id=person_id,
+            payload_type="PersonRenamed",
+            name="Second",
+        )
+    )
+    db_session.commit()
+    assert project_events(db_session, gap_timeout=60) == 0
+    assert get_person(db_session, person_id).name == "First"
+
+    assert project_events(db_session, gap_timeout=0) == 1
+    assert get_person(db_session, person_id).name == "Second"
+
+
+def test_projection_times_each_gap_separately(db_session, event_log):
+    person_id = str(uuid.uuid4())
+    append_events(db_session, [event("PersonAdded", person_id, "First")])
+    project_events(db_session)
+    position = db_session.query(ProjectionCheckpoint).one().position
+
+    # Gaps at position + 1 and position + 4
+    for offset, name in [(2, "Second"), (3, "Third"), (5, "Fifth")]:
+        db_session.add(
+            PersonEvent(
+                id=position + offset,
+                person_id=person_id,
+                payload_type="PersonRenamed",
+                name=name,
+            )
+        )
+    db_session.commit()
+    with patch("app.projection.time") as clock:
+        clock.monotonic.return_value = 1000.0
+        assert project_events(db_session, gap_timeout=60) == 0
+
+        # The first gap timed out, the second one was only just seen
+        clock.monotonic.return_value = 1061.0
+        assert project_events(db_session, gap_timeout=60) == 2
+        assert get_person(db_session, person_id).name == "Third"
+        assert project_events(db_session, gap_timeout=60) == 0
+
+        clock.monotonic.return_value = 1122.0
+        assert project_events(db_session, gap_timeout=60) == 1
+    assert get_person(db_session, person_id).name == "Fifth"
+
+
+def test_rebuild_projection_replays_the_log(db_session, event_log):
+    person_id = str(uuid.uuid4())
+    append_events(
+        db_session,
+        [
+            event("PersonAdded", person_id, "Original Name"),
+            event("PersonRenamed", person_id, "Updated Name"),
+        ],
+    )
+    project_events(db_session)
+    # Damage the projection, then rebuild it
+    db_session.query(Person).filter(Person.id == person_id).delete()
+    db_session.add(Person(id=str(uuid.uuid4()), name="Stray Row"))
+    db_session.commit()
+
+    assert rebuild_projection(db_session, batch_size=1) == 2
+    assert db_session.query(Person).count() == 1
+    assert get_person(db_session, person_id).name == "Updated Name"
+    assert project_events(db_session) == 0
+
+
+def test_rebuild_projection_refreshes_host_replica(db_session, event_log, tmp_path):
+    person_id = str(uuid.uuid4())
+    append_events(db_session, [event("PersonAdded", person_id, "Original Name")])
+    project_events(db_session)
+    # The replica of a server worker on this host
+    server_replica = NameReplica(str(tmp_path / "names"))
+    server_replica.rebuild(db_session)
+    append_events(db_session, [event("PersonRenamed", person_id, "Updated Name")])
+
+    settings = get_settings().model_copy(
+        update={"name_replica_path": server_replica.path}
+    )
+    with patch("app.replica.get_settings", return_value=settings):
+        rebuild_projection(db_session)
+    assert server_replica.lookup(person_id) == (True, "Updated Name")
+    server_replica.close()
+
+
+def test_accept_webhook_appends_to_event_log(client, db_session, event_log):
+    settings = get_settings().model_copy(update={"storage_mode": "event_store"})
+    person_id = str(uuid.uuid4())
+    with patch("app.api.get_settings", return_value=settings):
+        response = client.post(
+            "/accept_webhook",
+            json={
+                "payload_type": "PersonAdded",
+                "payload_content": {
+                    "person_id": person_id,
+                    "name": "Event Sourced",
+                    "timestamp": "2024-06-17T12:00:00",
+                },
+            },
+        )
+    assert response.status_code == 202
+    assert get_person(db_session, person_id) is None
+
+    project_events(db_session)
+    assert get_person(db_session, person_id).name == "Event Sourced"
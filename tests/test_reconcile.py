@@ -0,0 +1,124 @@
+import csv
+import uuid
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from app.config import get_settings
+from app.merkle import read_leaves, rebuild_range_hashes
+from app.models import Person, PersonAdded, PersonRemoved, PersonRenamed
+from app.reconcile import reconcile
+from app.replica import NameReplica
+from app.services import add_person, get_person, remove_person, rename_person
+
+
+@pytest.fixture
+def range_hashes(db_session):
+    rebuild_range_hashes(db_session)
+    db_session.commit()
+
+
+def write_snapshot(path, people):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name"])
+        writer.writerows(sorted(people.items()))
+    return str(path)
+
+
+def test_write_paths_maintain_range_hashes(db_session, range_hashes):
+    person_id = uuid.uuid4()
+    add_person(
+        db_session,
+        PersonAdded(person_id=person_id, name="Hash Me", timestamp=datetime.now()),
+    )
+    rename_person(
+        db_session,
+        PersonRenamed(person_id=person_id, name="Hash You", timestamp=datetime.now()),
+    )
+    add_person(
+        db_session,
+        PersonAdded(person_id=uuid.uuid4(), name="Kept", timestamp=datetime.now()),
+    )
+    remove_person(
+        db_session, PersonRemoved(person_id=person_id, timestamp=datetime.now())
+    )
+    maintained = read_leaves(db_session)
+
+    rebuild_range_hashes(db_session)
+    db_session.commit()
+    assert read_leaves(db_session) == maintained
+
+
+def test_reconcile_repairs_only_differing_ranges(db_session, range_hashes, tmp_path):
+    kept, renamed, removed = (str(uuid.uuid4()) for _ in range(3))
+    for person_id in (kept, renamed, removed):
+        add_person(
+            db_session,
+            PersonAdded(person_id=person_id, name="Before", timestamp=datetime.now()),
+        )
+    snapshot = {person.id: person.name for person in db_session.query(Person)}
+    added = str(uuid.uuid4())
+    snapshot[added] = "New Person"
+    snapshot[renamed] = "After"
+    del snapshot[removed]
+    path = write_snapshot(tmp_path / "phonebook.csv", snapshot)
+
+    stats = reconcile(db_session, path, dry_run=True)
+    assert stats["added"] == stats["renamed"] == stats["removed"] == 1
+    assert get_person(db_session, added) is None
+
+    stats = reconcile(db_session, path)
+    assert 1 <= stats["ranges"] <= 3
+    assert stats["added"] == stats["renamed"] == stats["removed"] == 1
+    assert stats["unresolved"] == 0
+    assert get_person(db_session, added).name == "New Person"
+    assert get_person(db_session, renamed).name == "After"
+    assert get_person(db_session, removed) is None
+    assert get_person(db_session, kept).name == "Before"
+
+    assert reconcile(db_session, path)["ranges"] == 0
+
+
+def test_reconcile_refreshes_host_replica(db_session, range_hashes, tmp_path):
+    person_id = str(uuid.uuid4())
+    add_person(
+        db_session,
+        PersonAdded(person_id=person_id, name="Stale", timestamp=datetime.now()),
+    )
+    # The replica of a server worker on this host
+    server_replica = NameReplica(str(tmp_path / "names"))
+    server_replica.rebuild(db_session)
+    snapshot = {person.id: person.name for person in db_session.query(Person)}
+    snapshot[person_id] = "Fresh"
+    path = write_snapshot(tmp_path / "phonebook.csv", snapshot)
+
+    settings = get_settings().model_copy(
+        update={"name_replica_path": server_replica.path}
+    )
+    with patch("app.replica.get_settings", return_value=settings):
+        reconcile(db_session, path)
+    assert server_replica.lookup(person_id) == (True, "Fresh")
+    server_replica.close()
+
+
+def test_get_range_hashes(client, db_session, range_hashes):
+    response = client.get("/range_hashes")
+    assert response.status_code == 200
+    root = response.json()
+    assert root["prefix"] == "" and root["depth"] == 3
+    assert [r["prefix"] for r in root["ranges"]] == list("0123456789abcdef")
+    assert sum(r["count"] for r in root["ranges"]) == root["count"]
+    digest = 0
+    for subrange in root["ranges"]:
+        digest ^= int(subrange["hash"], 16)
+    assert f"{digest:016x}" == root["hash"]
+
+    response = client.get("/range_hashes", params={"prefix": "a"})
+    assert response.status_code == 200
+    assert response.json()["ranges"][0]["prefix"] == "a0"
+
+    for prefix in ("abc", "zz"):
+        response = client.get("/range_hashes", params={"prefix": prefix})
+        assert response.status_code == 400
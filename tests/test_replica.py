@@ -0,0 +1,172 @@
+import os
+import uuid
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app import replica as replica_module
+from app import services
+from app.models import Person, PersonAdded, PersonRenamed
+from app.replica import NameReplica, ReplicaFull, sync_name_replica
+
+
+@pytest.fixture
+def replica(db_session: Session, tmp_path):
+    replica = NameReplica(str(tmp_path / "names"))
+    replica.rebuild(db_session)
+    yield replica
+    replica.close()
+
+
+def add_person(db_session: Session, name: str) -> str:
+    person_id = str(uuid.uuid4())
+    db_session.add(Person(id=person_id, name=name))
+    db_session.commit()
+    return person_id
+
+
+def test_lookup_after_build(db_session: Session, tmp_path):
+    person_id = add_person(db_session, "Test User")
+    replica = NameReplica(str(tmp_path / "names"))
+    replica.rebuild(db_session)
+    assert replica.lookup(person_id) == (True, "Test User")
+    assert replica.lookup(uuid.uuid4()) == (False, None)
+    replica.close()
+
+
+def test_writes_are_shared_between_processes(replica: NameReplica, tmp_path):
+    other_worker = NameReplica(replica.path)
+    person_id = str(uuid.uuid4())
+
+    replica.put(person_id, "Added")
+    assert other_worker.lookup(person_id) == (True, "Added")
+    other_worker.put(person_id, "Renamed")
+    assert replica.lookup(person_id) == (True, "Renamed")
+    replica.delete(person_id)
+    assert other_worker.lookup(person_id) == (False, None)
+    other_worker.close()
+
+
+def test_rebuild_is_followed_by_other_processes(db_session: Session, replica):
+    other_worker = NameReplica(replica.path)
+    person_id = str(uuid.uuid4())
+    services.add_person(
+        db_session,
+        PersonAdded(person_id=person_id, name="Late User", timestamp=datetime.now()),
+    )
+    assert other_worker.lookup(person_id) == (False, None)
+
+    assert replica.check_drift(db_session) is True
+    assert other_worker.lookup(person_id) == (True, "Late User")
+    assert replica.check_drift(db_session) is False
+    other_worker.close()
+
+
+def test_rename_behind_replica_is_detected(db_session: Session, replica):
+    person_id = str(uuid.uuid4())
+    services.add_person(
+        db_session,
+        PersonAdded(person_id=person_id, name="Old Name", timestamp=datetime.now()),
+    )
+    assert replica.check_drift(db_session) is True
+
+    # Renamed by another worker, whose change never reached this replica
+    services.rename_person(
+        db_session,
+        PersonRenamed(person_id=person_id, name="New Name", timestamp=datetime.now()),
+    )
+    assert replica.lookup(person_id) == (True, "Old Name")
+    assert replica.check_drift(db_session) is True
+    assert replica.lookup(person_id) == (True, "New Name")
+
+    # Writes that did reach the replica are not drift
+    replica.put(person_id, "Newer Name")
+    services.rename_person(
+        db_session,
+        PersonRenamed(person_id=person_id, name="Newer Name", timestamp=datetime.now()),
+    )
+    assert replica.check_drift(db_session) is False
+
+
+def test_writes_in_flight_are_not_drift(db_session: Session, replica):
+    person_id = str(uuid.uuid4())
+    # Committed, and published to the replica only during the check
+    services.add_person(
+        db_session,
+        PersonAdded(person_id=person_id, name="In Flight", timestamp=datetime.now()),
+    )
+    with patch(
+        "app.replica.time.sleep",
+        side_effect=lambda _: replica.put(person_id, "In Flight"),
+    ):
+        assert replica.check_drift(db_session) is False
+
+    # A difference that keeps moving is left for the next check
+    def another_write(_):
+        services.add_person(
+            db_session,
+            PersonAdded(person_id=uuid.uuid4(), name="Busy", timestamp=datetime.now()),
+        )
+
+    another_write(None)
+    with patch("app.replica.time.sleep", side_effect=another_write) as sleep:
+        assert replica.check_drift(db_session) is False
+    assert sleep.call_count == 2
+    assert replica.check_drift(db_session) is True
+
+
+def test_writes_during_rebuild_are_replayed(db_session: Session, replica):
+    other_worker = NameReplica(replica.path)
+    person_id = str(uuid.uuid4())
+    read_version = replica_module._database_version
+
+    def write_while_reading(db):
+        # Writers are not blocked while the rows are read
+        other_worker.put(person_id, "During Rebuild")
+        return read_version(db)
+
+    with patch("app.replica._database_version", side_effect=write_while_reading):
+        replica.rebuild(db_session)
+    assert replica.lookup(person_id) == (True, "During Rebuild")
+    assert other_worker.lookup(person_id) == (True, "During Rebuild")
+    assert not os.path.exists(f"{replica.path}.journal")
+    other_worker.close()
+
+
+def test_full_replica_is_retired(replica: NameReplica):
+    person_id = str(uuid.uuid4())
+    replica.put(person_id, "Test User")
+    with patch("app.replica._replica", replica), patch(
+        "app.replica._apply", side_effect=ReplicaFull
+    ):
+        sync_name_replica([(str(uuid.uuid4()), "No Room", False)])
+    assert replica.available is False
+    assert replica.lookup(person_id) == (False, None)
+
+
+def test_get_name_served_from_replica(client, replica: NameReplica):
+    person_id = str(uuid.uuid4())
+    replica.put(person_id, "Replica User")
+    with patch("app.api.get_name_replica", return_value=replica):
+        response = client.get("/get_name", params={"person_id": person_id})
+    assert response.status_code == 200
+    assert response.json() == {"name": "Replica User"}
+
+
+def test_write_paths_update_replica(client, replica: NameReplica):
+    person_id = str(uuid.uuid4())
+    with patch("app.replica._replica", replica):
+        client.post(
+            "/accept_webhook",
+            json={
+                "payload_type": "PersonAdded",
+                "payload_content": {
+                    "person_id": person_id,
+                    "name": "Webhook User",
+                    "timestamp": "2023-10-10T12:34:56Z",
+                },
+            },
+        )
+    assert replica.lookup(person_id) == (True, "Webhook User")
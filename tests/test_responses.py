@@ -0,0 +1,32 @@
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from app.responses import FastJSONResponse
+
+
+def test_fast_json_response_serializes_database_types():
+    response = FastJSONResponse(
+        {
+            "result": [
+                {
+                    "count": Decimal("3"),
+                    "ratio": Decimal("0.5"),
+                    "row_start": datetime(2023, 1, 1, 12, 0, 0),
+                    "duration": timedelta(minutes=1),
+                    "raw": b"bytes",
+                }
+            ]
+        }
+    )
+    assert json.loads(response.body) == {
+        "result": [
+            {
+                "count": 3,
+                "ratio": 0.5,
+                "row_start": "2023-01-01T12:00:00",
+                "duration": 60.0,
+                "raw": "bytes",
+            }
+        ]
+    }
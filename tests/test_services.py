@@ -1,8 +1,14 @@
 import uuid
 from datetime import datetime
+from unittest.mock import MagicMock, patch
 
+import pytest
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
 
+from app import metrics
+from app.config import get_settings
+from app.db import run_with_retries
 from app.models import Person, PersonAdded, PersonRemoved, PersonRenamed
 from app.services import (
     add_person,
@@ -13,6 +19,7 @@ from app.services import (
     rename_person,
     translate_nl_to_sql,
 )
+from tests.conftest import TestingSessionLocal
 
 
 def test_add_person(db_session: Session):
@@ -73,6 +80,16 @@ def test_translate_nl_to_sql(mock_openai_client, mock_openai_response):
     assert sql_info_raw.strip() == mock_openai_response.strip()
 
 
+def test_translate_nl_to_sql_cached(mock_openai_client, mock_openai_response):
+    calls = mock_openai_client.chat.completions.create.call_count
+    assert translate_nl_to_sql("How many people?") == mock_openai_response.strip()
+    assert translate_nl_to_sql(" How many\tpeople? ") == mock_openai_response.strip()
+    assert mock_openai_client.chat.completions.create.call_count == calls + 1
+    # The case may be that of a literal
+    translate_nl_to_sql("how many people?")
+    assert mock_openai_client.chat.completions.create.call_count == calls + 2
+
+
 def test_parse_openai_response(mock_openai_response):
     sql_info = parse_openai_response(mock_openai_response)
     assert "query_template" in sql_info
@@ -80,6 +97,53 @@ def test_parse_openai_response(mock_openai_response):
     assert sql_info["params"]["person_id"] == "d59abfc4-3aae-4e29-875b-7b56e021ad42"
 
 
+def test_parse_structured_openai_response():
+    sql_info = parse_openai_response(
+        '{"query_template": "SELECT name FROM people WHERE id = :person_id",'
+        ' "params": [{"name": "person_id", "value": "d59abfc4"}]}'
+    )
+    assert sql_info == {
+        "query_template": "SELECT name FROM people WHERE id = :person_id",
+        "params": {"person_id": "d59abfc4"},
+    }
+    assert (
+        parse_openai_response('{"query_template": "SELECT 1", "params": []}')["params"]
+        is None
+    )
+
+
+def test_translate_nl_to_sql_repairs_invalid_answer(mock_openai_response):
+    def answer(content):
+        response = MagicMock()
+        response.choices = [MagicMock()]
+        response.choices[0].message = MagicMock(content=content)
+        return response
+
+    with patch("app.services.client") as mock_client:
+        mock_client.chat.completions.create.side_effect = [
+            answer('{"params": []}'),
+            answer(mock_openai_response),
+        ]
+        assert translate_nl_to_sql("Who?") == mock_openai_response.strip()
+        calls = mock_client.chat.completions.create.call_args_list
+    assert len(calls) == 2
+    repair = calls[1].kwargs["messages"]
+    assert repair[-2] == {"role": "assistant", "content": '{"params": []}'}
+    assert "SQL template not found" in repair[-1]["content"]
+    assert "response_format" in calls[0].kwargs
+
+
+def test_translate_nl_to_sql_repairs_only_once():
+    response = MagicMock()
+    response.choices = [MagicMock()]
+    response.choices[0].message = MagicMock(content="Not a query")
+    with patch("app.services.client") as mock_client:
+        mock_client.chat.completions.create.return_value = response
+        with pytest.raises(ValueError):
+            translate_nl_to_sql("Who?")
+        assert mock_client.chat.completions.create.call_count == 2
+
+
 def test_format_and_execute_sql(db_session: Session):
     person_id = str(uuid.uuid4())
     person = Person(id=person_id, name="Test User")
@@ -95,3 +159,50 @@ def test_format_and_execute_sql(db_session: Session):
     assert len(result) == 1
     assert result[0]["id"] == person_id
     assert result[0]["name"] == "Test User"
+
+
+def test_rename_person_retries_stale_update(db_session: Session):
+    person_id = str(uuid.uuid4())
+    db_session.add(Person(id=person_id, name="Original Name"))
+    db_session.commit()
+    # Read the person, then let another writer rename them meanwhile
+    person = get_person(db_session, person_id)
+    assert person.version == 1
+    other = TestingSessionLocal()
+    other.query(Person).filter(Person.id == person_id).one().name = "Other Name"
+    other.commit()
+    other.close()
+
+    conflicts = metrics.value(
+        "db_write_conflicts_total", operation="rename_person", kind="stale"
+    )
+    person_data = PersonRenamed(
+        person_id=uuid.UUID(person_id), name="Updated Name", timestamp=datetime.now()
+    )
+    renamed_person = rename_person(db_session, person_data)
+    assert renamed_person is person
+    assert renamed_person.name == "Updated Name"
+    assert renamed_person.version == 3
+    assert (
+        metrics.value(
+            "db_write_conflicts_total", operation="rename_person", kind="stale"
+        )
+        == conflicts + 1
+    )
+
+
+def test_run_with_retries_gives_up_on_persistent_deadlocks(db_session: Session):
+    deadlock = OperationalError("UPDATE people", {}, Exception(1213, "Deadlock found"))
+    func = MagicMock(side_effect=deadlock)
+    with patch("app.db.time.sleep") as sleep:
+        with pytest.raises(OperationalError):
+            run_with_retries(db_session, "test", func)
+    assert func.call_count == get_settings().db_write_retries + 1
+    assert sleep.call_count == get_settings().db_write_retries
+    assert metrics.value("db_write_retries_exhausted_total", operation="test") == 1
+
+    # Other errors are not retried
+    func = MagicMock(side_effect=OperationalError("SELECT", {}, Exception(2006)))
+    with pytest.raises(OperationalError):
+        run_with_retries(db_session, "other", func)
+    assert func.call_count == 1
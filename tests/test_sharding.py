@@ -0,0 +1,204 @@
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, or_, text
+
+from app.db import Base, engine_factory
+from app.models import Person, PersonAdded, PersonEvent, webhook_payload_adapter
+from app.services import (
+    add_person,
+    append_events,
+    apply_webhook_payloads,
+    execute_sql,
+    get_person,
+    get_person_name,
+)
+from app.sharding import (
+    HashRing,
+    ScatterUnsupported,
+    make_sharded_sessionmaker,
+    reshard,
+    shard_names,
+)
+
+
+def make_engines(tmp_path, count, prefix="shard"):
+    engines = {}
+    for name in shard_names(count):
+        engine = engine_factory(f"sqlite:///{tmp_path / f'{prefix}-{name}.db'}")
+        Base.metadata.create_all(bind=engine)
+        engines[name] = engine
+    return engines
+
+
+def shard_ids(engine):
+    with engine.connect() as connection:
+        return {row.id for row in connection.execute(text("SELECT id FROM people"))}
+
+
+@pytest.fixture
+def engines(tmp_path):
+    engines = make_engines(tmp_path, 2)
+    yield engines
+    for engine in engines.values():
+        engine.dispose()
+
+
+@pytest.fixture
+def sharded_session(engines):
+    ring = HashRing(list(engines))
+    db = make_sharded_sessionmaker(engines, ring, autoflush=False)()
+    yield db, ring
+    db.close()
+
+
+def test_hash_ring_moves_few_keys_when_growing():
+    keys = [str(uuid.uuid4()) for _ in range(5000)]
+    before = HashRing(shard_names(4))
+    after = HashRing(shard_names(5))
+    owners = Counter(before.shard_for(key) for key in keys)
+    assert min(owners.values()) > len(keys) / 4 * 0.7
+    moved = [key for key in keys if before.shard_for(key) != after.shard_for(key)]
+    assert all(after.shard_for(key) == "shard-4" for key in moved)
+    assert len(moved) < len(keys) / 5 * 1.4
+
+
+def test_people_are_routed_to_their_shard(engines, sharded_session):
+    db, ring = sharded_session
+    person_ids = [str(uuid.uuid4()) for _ in range(20)]
+    for person_id in person_ids:
+        add_person(
+            db,
+            PersonAdded(
+                person_id=person_id, name=f"P{person_id[:4]}", timestamp=datetime.now()
+            ),
+        )
+
+    for name, engine in engines.items():
+        assert shard_ids(engine) == {
+            person_id for person_id in person_ids if ring.shard_for(person_id) == name
+        }
+    assert get_person(db, person_ids[0]).name == f"P{person_ids[0][:4]}"
+    assert get_person(db, str(uuid.uuid4())) is None
+
+    # Raw queries are scattered to every shard and gathered
+    columns, rows = execute_sql(db, {"query_template": "SELECT id FROM people"})
+    assert columns == ["id"]
+    assert sorted(row[0] for row in rows) == sorted(person_ids)
+
+
+def test_lookups_by_id_query_one_shard(engines, sharded_session):
+    db, ring = sharded_session
+    person_id = str(uuid.uuid4())
+    add_person(
+        db, PersonAdded(person_id=person_id, name="Routed", timestamp=datetime.now())
+    )
+    db.expunge_all()
+
+    queried = Counter()
+    for name, engine in engines.items():
+        event.listen(
+            engine,
+            "before_cursor_execute",
+            lambda *args, name=name: queried.update([name]),
+        )
+    assert get_person(db, person_id).name == "Routed"
+    assert get_person_name(db, person_id) == (True, "Routed")
+    assert len(db.query(Person).filter(Person.id.in_([person_id])).all()) == 1
+    assert queried == {ring.shard_for(person_id): 3}
+
+
+def test_lookups_under_or_are_scattered(engines, sharded_session):
+    db, ring = sharded_session
+    person_ids = [str(uuid.uuid4()) for _ in range(20)]
+    for person_id in person_ids:
+        db.add(Person(id=person_id, name="Other"))
+    db.commit()
+    person_id = person_ids[0]
+    elsewhere = next(
+        p for p in person_ids if ring.shard_for(p) != ring.shard_for(person_id)
+    )
+    db.query(Person).filter(Person.id == elsewhere).update({Person.name: "Wanted"})
+    db.commit()
+    db.expunge_all()
+
+    found = db.query(Person).filter(
+        or_(Person.id == person_id, Person.name == "Wanted")
+    )
+    assert {person.id for person in found} == {person_id, elsewhere}
+    # Top-level conjunctions still narrow to the owning shard
+    narrowed = db.query(Person).filter(Person.id == elsewhere, Person.name == "Wanted")
+    assert [person.id for person in narrowed] == [elsewhere]
+
+
+def test_scattered_sql_cannot_aggregate(engines, sharded_session):
+    db, _ = sharded_session
+    for person_id in (str(uuid.uuid4()) for _ in range(10)):
+        db.add(Person(id=person_id, name="Scattered"))
+    db.commit()
+
+    for query in (
+        "SELECT COUNT(*) FROM people",
+        "SELECT SUM(version) FROM people",
+        "SELECT name FROM people ORDER BY name LIMIT 3",
+        "SELECT DISTINCT name FROM people",
+    ):
+        with pytest.raises(ScatterUnsupported):
+            execute_sql(db, {"query_template": query})
+    # Tables other than people are only on the primary shard
+    _, rows = execute_sql(db, {"query_template": "SELECT COUNT(*) FROM person_events"})
+    assert len(rows) == 1
+
+
+def test_batches_span_shards_and_other_tables_stay_on_primary(engines, sharded_session):
+    db, ring = sharded_session
+    person_ids = [str(uuid.uuid4()) for _ in range(10)]
+    payloads = [
+        webhook_payload_adapter.validate_python(
+            {
+                "payload_type": "PersonAdded",
+                "payload_content": {
+                    "person_id": person_id,
+                    "name": "Batch",
+                    "timestamp": "2024-06-17T12:00:00",
+                },
+            }
+        )
+        for person_id in person_ids
+    ]
+    assert apply_webhook_payloads(db, payloads) == 10
+    assert set().union(*map(shard_ids, engines.values())) == set(person_ids)
+
+    append_events(db, payloads)
+    assert db.query(PersonEvent).count() == 10
+    with engines["shard-1"].connect() as connection:
+        assert (
+            connection.execute(text("SELECT COUNT(*) FROM person_events")).scalar() == 0
+        )
+
+
+def test_reshard_moves_only_remapped_rows(tmp_path, engines, sharded_session):
+    db, _ = sharded_session
+    person_ids = [str(uuid.uuid4()) for _ in range(200)]
+    for person_id in person_ids:
+        db.add(Person(id=person_id, name="Moving"))
+    db.commit()
+
+    new_engines = dict(engines)
+    new_engines.update({"shard-2": make_engines(tmp_path, 3, prefix="new")["shard-2"]})
+    new_ring = HashRing(list(new_engines))
+    moved = reshard(engines, new_engines)
+    assert moved == sum(
+        new_ring.shard_for(person_id) == "shard-2" for person_id in person_ids
+    )
+
+    for name, engine in new_engines.items():
+        assert shard_ids(engine) == {
+            person_id
+            for person_id in person_ids
+            if new_ring.shard_for(person_id) == name
+        }
+    # Running it again has nothing left to move
+    assert reshard(engines, new_engines) == 0
@@ -0,0 +1,212 @@
+import os
+import time
+import uuid
+from unittest.mock import patch
+
+import pytest
+
+from app import metrics
+from app.models import webhook_payload_adapter
+from app.services import apply_webhook_payloads, get_person
+from app.spool import WebhookSpool
+from tests.conftest import TestingSessionLocal
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def spool_dir(tmp_path):
+    return str(tmp_path / "spool")
+
+
+def open_spool(spool_dir, apply_batch, segment_max_bytes=1024 * 1024):
+    spool = WebhookSpool(spool_dir, segment_max_bytes, 0.001, batch_size=10)
+    spool.start(apply_batch)
+    return spool
+
+
+def test_records_are_replayed_in_order(spool_dir):
+    applied = []
+    spool = open_spool(spool_dir, applied.extend, segment_max_bytes=64)
+    records = [f"event-{i}".encode() for i in range(50)]
+    for record in records:
+        spool.append(record)
+    wait_for(lambda: len(applied) == len(records))
+    spool.stop()
+
+    assert applied == records
+    # Fully applied segments are deleted
+    segments = [name for name in os.listdir(spool_dir) if name.endswith(".seg")]
+    assert len(segments) == 1
+
+
+def test_failed_batches_are_retried(spool_dir):
+    applied = []
+    failures = iter([True, True])
+
+    def apply_batch(records):
+        if next(failures, False):
+            raise ConnectionError("Database unavailable")
+        applied.extend(records)
+
+    spool = open_spool(spool_dir, apply_batch)
+    spool.append(b"event")
+    wait_for(lambda: applied == [b"event"])
+    spool.stop()
+
+
+def test_replay_resumes_after_crash(spool_dir):
+    applied = []
+    spool = open_spool(spool_dir, applied.extend)
+    spool.append(b"applied-before-crash")
+    wait_for(lambda: len(applied) == 1)
+    spool.stop()
+
+    # Simulate a crash while the database is down: a record acknowledged but
+    # not applied, followed by a torn write
+    def database_down(records):
+        raise ConnectionError("Database unavailable")
+
+    spool = open_spool(spool_dir, database_down)
+    spool.append(b"pending")
+    spool.stop()
+    with open(os.path.join(spool_dir, "000000000001.seg"), "ab") as f:
+        f.write(b"\x10\x00\x00\x00torn")
+
+    applied.clear()
+    spool = open_spool(spool_dir, applied.extend)
+    wait_for(lambda: applied == [b"pending"])
+    spool.append(b"after-restart")
+    wait_for(lambda: applied == [b"pending", b"after-restart"])
+    spool.stop()
+
+
+def test_appends_follow_segments_rotated_by_other_workers(spool_dir):
+    applied = []
+    first = open_spool(spool_dir, applied.extend, segment_max_bytes=100)
+    first.append(b"first-worker")
+    wait_for(lambda: applied == [b"first-worker"])
+
+    # Another worker rotates past the first one's segment, which is replayed
+    # and deleted
+    second = open_spool(spool_dir, applied.extend, segment_max_bytes=100)
+    records = [f"second-worker-{i}".encode() for i in range(30)]
+    for record in records:
+        second.append(record)
+    wait_for(lambda: len(applied) == 31)
+
+    def segments():
+        return [name for name in os.listdir(spool_dir) if name.endswith(".seg")]
+
+    wait_for(lambda: len(segments()) == 1)
+    first.append(b"late-from-first-worker")
+    wait_for(lambda: applied[-1:] == [b"late-from-first-worker"])
+    first.stop()
+    second.stop()
+    assert applied == [b"first-worker"] + records + [b"late-from-first-worker"]
+
+
+def corrupt_record(spool_dir, segment, index):
+    """Flip a payload byte of the index-th record of a segment."""
+    path = os.path.join(spool_dir, f"{segment:012d}.seg")
+    with open(path, "r+b") as f:
+        offset = 0
+        for _ in range(index):
+            f.seek(offset)
+            offset += 8 + int.from_bytes(f.read(4), "little")
+        f.seek(offset + 8)
+        byte = f.read(1)
+        f.seek(offset + 8)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+@pytest.mark.parametrize("rotated", [False, True])
+def test_corrupt_record_in_the_middle_is_skipped(spool_dir, rotated):
+    def database_down(records):
+        raise ConnectionError("Database unavailable")
+
+    spool = open_spool(spool_dir, database_down)
+    for i in range(5):
+        spool.append(f"event-{i}".encode())
+    spool.stop()
+    corrupt_record(spool_dir, 1, 2)
+    if rotated:
+        with open(os.path.join(spool_dir, "000000000002.seg"), "wb"):
+            pass
+
+    # Reopening keeps the records following the corrupt one
+    applied = []
+    skipped = metrics.value("webhook_spool_skipped_bytes_total")
+    spool = open_spool(spool_dir, applied.extend)
+    expected = [b"event-0", b"event-1", b"event-3", b"event-4"]
+    wait_for(lambda: applied == expected)
+    spool.append(b"after-restart")
+    wait_for(lambda: applied == expected + [b"after-restart"])
+    spool.stop()
+    assert metrics.value("webhook_spool_skipped_bytes_total") - skipped == 15
+
+
+def test_apply_webhook_payloads_is_idempotent(db_session):
+    person_id = str(uuid.uuid4())
+    payloads = [
+        webhook_payload_adapter.validate_python(
+            {
+                "payload_type": payload_type,
+                "payload_content": {
+                    "person_id": person_id,
+                    "name": name,
+                    "timestamp": "2023-10-10T12:34:56Z",
+                },
+            }
+        )
+        for payload_type, name in [
+            ("PersonAdded", "Added"),
+            ("PersonRenamed", "Renamed"),
+            ("PersonRemoved", None),
+            ("PersonAdded", "Added Again"),
+        ]
+    ]
+    assert apply_webhook_payloads(db_session, payloads) == 4
+    assert get_person(db_session, person_id).name == "Added Again"
+    # Replaying the same events leaves the same state
+    assert apply_webhook_payloads(db_session, payloads) == 4
+    assert get_person(db_session, person_id).name == "Added Again"
+
+
+def test_accept_webhook_spooled(client, spool_dir):
+    def apply_batch(records):
+        db = TestingSessionLocal()
+        try:
+            apply_webhook_payloads(
+                db, [webhook_payload_adapter.validate_json(r) for r in records]
+            )
+        finally:
+            db.close()
+
+    spool = open_spool(spool_dir, apply_batch)
+    person_id = str(uuid.uuid4())
+    with patch("app.api.get_webhook_spool", return_value=spool):
+        response = client.post(
+            "/accept_webhook",
+            json={
+                "payload_type": "PersonAdded",
+                "payload_content": {
+                    "person_id": person_id,
+                    "name": "Spooled User",
+                    "timestamp": "2023-10-10T12:34:56Z",
+                },
+            },
+        )
+    assert response.status_code == 202
+    assert response.json() == {"detail": "Webhook accepted for processing"}
+
+    def applied():
+        return client.get("/get_name", params={"person_id": person_id}).json()
+
+    wait_for(lambda: applied() == {"name": "Spooled User"})
+    spool.stop()